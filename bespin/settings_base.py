@@ -142,3 +142,60 @@ JWT_AUTH = {
     'JWT_ALLOW_REFRESH': True,
     'JWT_EXPIRATION_DELTA': datetime.timedelta(seconds=7200),
 }
+
+# Number of email messages claimed and sent over one mail server connection by the batch sender
+BESPIN_MAILER_BATCH_SIZE = 100
+# Seconds the sendemails worker waits between checks for new email messages
+BESPIN_MAILER_POLL_SECONDS = 30
+# Seconds an EmailTemplate looked up by name is reused before being read from the database again
+BESPIN_MAILER_TEMPLATE_CACHE_SECONDS = 60
+# When set, job notifications are buffered per recipient for this many seconds and sent as a single
+# digest email by the sendemails worker. None sends one email per notification.
+BESPIN_MAILER_DIGEST_SECONDS = None
+# Name of the EmailTemplate used to render digest emails
+BESPIN_MAILER_DIGEST_TEMPLATE_NAME = 'job-digest'
+# When True the mailer queue receives one pickled {"send_email": id} message per email instead of
+# versioned JSON payloads holding many ids. Set to False once all bespin-mailer consumers read the JSON format.
+BESPIN_MAILER_LEGACY_QUEUE_PAYLOAD = True
+# Number of failed attempts after which an email message is moved to the dead state instead of retried
+BESPIN_MAILER_MAX_ATTEMPTS = 5
+# Seconds before the first retry of a failed email message, doubled for each further attempt
+BESPIN_MAILER_RETRY_BASE_SECONDS = 60
+# Upper limit on the seconds between retries of a failed email message
+BESPIN_MAILER_RETRY_MAX_SECONDS = 3600
+# Seconds resolved workflow tags (version, configuration and user fields) are shared between requests.
+# Saving a Workflow, WorkflowVersion or WorkflowConfiguration clears the cache in that process. 0 disables.
+BESPIN_WORKFLOW_CONFIGURATION_CACHE_SECONDS = 0
+# Maximum number of Duke DS projects fetched at the same time when building stage groups from dds:// paths
+BESPIN_DDS_LOOKUP_WORKERS = 8
+# How job volume sizes are chosen: 'static' uses the volume size base and factor of the questionnaire or
+# VM strategy, 'predicted' fits sizes to the disk usage (Job.volume_size_used) reported by finished jobs of the
+# workflow version when there are enough of them, never exceeding the static size
+BESPIN_VOLUME_SIZING_MODE = 'static'
+# Fraction added to predicted volume sizes
+BESPIN_VOLUME_SIZE_MARGIN = 0.25
+# Finished jobs of a workflow version with a reported volume_size_used required before volume sizes are predicted
+BESPIN_VOLUME_SIZE_MIN_JOBS = 10
+# Most recent finished jobs of a workflow version used to predict volume sizes
+BESPIN_VOLUME_SIZE_MAX_JOBS = 200
+# Id of the DDSUserCredential workers use to store job output, when None the first DDSUserCredential is used
+BESPIN_WORKER_DDS_USER_CREDENTIAL_ID = None
+# Seconds the worker DDSUserCredential is reused before being read from the database again.
+# Saving or deleting a DDSUserCredential clears it sooner in that process only.
+BESPIN_WORKER_DDS_USER_CREDENTIAL_CACHE_SECONDS = 60
+# Directory parsed CWL document summaries are cached in, keyed by url and content. None disables the cache.
+# The key only covers the top level document so only enable this when importing packed CWL documents; a document
+# that references other files with run or $import is not re-parsed when only those files change.
+BESPIN_CWL_CACHE_DIR = None
+# Maximum number of DOI citations fetched at the same time when building methods documents
+BESPIN_DOI_LOOKUP_WORKERS = 8
+# Seconds the runimporttasks command waits between checks for new workflow import tasks
+BESPIN_IMPORT_TASK_POLL_SECONDS = 10
+# Seconds a workflow import task may stay running before runimporttasks marks it as an error,
+# e.g. when the process running it was stopped
+BESPIN_IMPORT_TASK_TIMEOUT_SECONDS = 3600
+# Directory of an artifact mirror filled by the prefetchartifacts command. When set, imports read CWL documents,
+# methods templates and DOI citations from the mirror before the network. None always uses the network.
+BESPIN_ARTIFACT_MIRROR_DIR = None
+# When True, imports fail instead of using the network for artifacts missing from BESPIN_ARTIFACT_MIRROR_DIR
+BESPIN_ARTIFACT_OFFLINE = False
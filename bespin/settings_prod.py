@@ -59,3 +59,27 @@ REQUIRED_GROUP_MANAGER_GROUP = os.getenv('BESPIN_REQUIRED_GROUPMANAGER_GROUP')
 REQUIRE_JOB_TOKENS = False
 if os.getenv('BESPIN_REQUIRE_JOB_TOKENS'):
     REQUIRE_JOB_TOKENS = True
+
+if os.getenv('BESPIN_MAILER_DIGEST_SECONDS'):
+    BESPIN_MAILER_DIGEST_SECONDS = int(os.getenv('BESPIN_MAILER_DIGEST_SECONDS'))
+
+if os.getenv('BESPIN_MAILER_JSON_QUEUE_PAYLOAD'):
+    BESPIN_MAILER_LEGACY_QUEUE_PAYLOAD = False
+
+if os.getenv('BESPIN_WORKFLOW_CONFIGURATION_CACHE_SECONDS'):
+    BESPIN_WORKFLOW_CONFIGURATION_CACHE_SECONDS = int(os.getenv('BESPIN_WORKFLOW_CONFIGURATION_CACHE_SECONDS'))
+
+if os.getenv('BESPIN_VOLUME_SIZING_MODE'):
+    BESPIN_VOLUME_SIZING_MODE = os.getenv('BESPIN_VOLUME_SIZING_MODE')
+
+if os.getenv('BESPIN_WORKER_DDS_USER_CREDENTIAL_ID'):
+    BESPIN_WORKER_DDS_USER_CREDENTIAL_ID = int(os.getenv('BESPIN_WORKER_DDS_USER_CREDENTIAL_ID'))
+
+if os.getenv('BESPIN_CWL_CACHE_DIR'):
+    BESPIN_CWL_CACHE_DIR = os.getenv('BESPIN_CWL_CACHE_DIR')
+
+if os.getenv('BESPIN_ARTIFACT_MIRROR_DIR'):
+    BESPIN_ARTIFACT_MIRROR_DIR = os.getenv('BESPIN_ARTIFACT_MIRROR_DIR')
+
+if os.getenv('BESPIN_ARTIFACT_OFFLINE'):
+    BESPIN_ARTIFACT_OFFLINE = True
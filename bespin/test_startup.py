@@ -0,0 +1,42 @@
+from django.conf import settings
+from django.test import SimpleTestCase
+import json
+import os
+import subprocess
+import sys
+
+# Loads the WSGI application and url configuration the way a web worker does on its first request
+WEB_WORKER_STARTUP_SCRIPT = """
+import json, sys, time
+start_time = time.time()
+from django.core.wsgi import get_wsgi_application
+get_wsgi_application()
+import bespin.urls
+print(json.dumps({'seconds': time.time() - start_time, 'modules': sorted(sys.modules.keys())}))
+"""
+# Packages only needed to import workflows that must not slow down web worker startup
+WORKFLOW_IMPORT_PACKAGES = ['cwltool', 'habanero', 'jinja2']
+
+
+class WebWorkerStartupTestCase(SimpleTestCase):
+    @staticmethod
+    def run_web_worker_startup():
+        """
+        Run WEB_WORKER_STARTUP_SCRIPT in a new python process so modules imported by other tests do not count
+        :return: dict: seconds startup took and the names of all modules imported
+        """
+        env = dict(os.environ, DJANGO_SETTINGS_MODULE=settings.SETTINGS_MODULE)
+        process = subprocess.run([sys.executable, '-c', WEB_WORKER_STARTUP_SCRIPT], env=env,
+                                 stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+        if process.returncode != 0:
+            raise AssertionError("Web worker startup failed:\n{}".format(process.stderr))
+        return json.loads(process.stdout.splitlines()[-1])
+
+    def test_workflow_import_packages_not_loaded(self):
+        startup = self.run_web_worker_startup()
+        self.assertIn('data.api', startup['modules'])
+        self.assertIn('data.importers', startup['modules'])
+        imported_packages = set(module_name.split('.')[0] for module_name in startup['modules'])
+        self.assertEqual(imported_packages.intersection(WORKFLOW_IMPORT_PACKAGES), set(),
+                         "Workflow import packages were loaded during web worker startup "
+                         "({:.2f}s)".format(startup['seconds']))
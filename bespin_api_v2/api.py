@@ -6,7 +6,7 @@ from django.db import transaction
 from django_filters.rest_framework import DjangoFilterBackend
 from bespin_api_v2.serializers import AdminWorkflowSerializer, AdminWorkflowVersionSerializer, VMStrategySerializer, \
     WorkflowConfigurationSerializer, JobTemplateMinimalSerializer, JobTemplateSerializer, WorkflowVersionSerializer, \
-    ShareGroupSerializer, JobTemplateValidatingSerializer
+    ShareGroupSerializer, JobTemplateValidatingSerializer, JobTemplateBatchSerializer, DDSStageGroupSerializer
 from data.serializers import JobSerializer
 from data.models import Workflow, WorkflowVersion, VMStrategy, WorkflowConfiguration, JobFileStageGroup, ShareGroup
 from data.exceptions import BespinAPIException
@@ -93,3 +93,23 @@ class JobTemplateCreateJobView(generics.CreateAPIView):
     def perform_create(self, serializer):
         job_template = serializer.save()
         job_template.create_and_populate_job(self.request.user)
+
+
+class JobTemplateCreateJobsView(generics.CreateAPIView):
+    """
+    Creates a job for each entry in a list that shares a single workflow tag
+    """
+    permission_classes = (permissions.IsAuthenticated,)
+    serializer_class = JobTemplateBatchSerializer
+
+    def perform_create(self, serializer):
+        job_template_batch = serializer.save()
+        job_template_batch.create_jobs(self.request.user)
+
+
+class JobTemplateCreateStageGroupView(generics.CreateAPIView):
+    """
+    Creates a stage group containing the DukeDS files referenced by dds:// paths in a job order
+    """
+    permission_classes = (permissions.IsAuthenticated,)
+    serializer_class = DDSStageGroupSerializer
@@ -1,9 +1,18 @@
-from data.jobfactory import JobFactory
+from data.jobfactory import JobFactory, JobBatchFactory
 from data.exceptions import InvalidWorkflowTagException
-from data.models import WorkflowVersion, WorkflowConfiguration
+from data.models import Workflow, WorkflowVersion, WorkflowConfiguration, JobFileStageGroup, DDSJobInputFile
+from data.util import get_user_project_files_by_path
+from django.conf import settings
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
 from rest_framework.fields import Field
 from rest_framework.serializers import ValidationError
 import six
+import time
+import json
+import hashlib
+import copy
 
 DUKEDS_PATH_PREFIX = "dds://"
 STRING_VALUE_PLACEHOLDER = "<String Value>"
@@ -42,6 +51,20 @@ USER_PLACEHOLDER_DICT = {
 }
 REQUIRED_ERROR_MESSAGE = str(Field.default_error_messages['required'])
 PLACEHOLDER_ERROR_MESSAGE = 'This field contains a placeholder value.'
+TYPE_ERROR_MESSAGE = 'This field must be of type {}.'
+# Fields of the record types in USER_PLACEHOLDER_DICT
+RECORD_TYPE_FIELDS = {
+    'NamedFASTQFilePairType': [
+        {'name': 'name', 'type': 'string'},
+        {'name': 'file1', 'type': 'File'},
+        {'name': 'file2', 'type': 'File'},
+    ],
+    'FASTQReadPairType': [
+        {'name': 'name', 'type': 'string'},
+        {'name': 'read1_files', 'type': {'type': 'array', 'items': 'File'}},
+        {'name': 'read2_files', 'type': {'type': 'array', 'items': 'File'}},
+    ],
+}
 
 
 class WorkflowVersionConfiguration(object):
@@ -53,6 +76,7 @@ class WorkflowVersionConfiguration(object):
         self.workflow_configuration = WorkflowConfiguration.objects.get(
             workflow=self.workflow_version.workflow,
             tag=configuration_name)
+        self._user_job_fields = None
 
     @staticmethod
     def split_workflow_tag_parts(tag):
@@ -69,35 +93,122 @@ class WorkflowVersionConfiguration(object):
         return workflow_tag, version_num, configuration_name
 
     def user_job_fields(self):
-        system_keys = self.workflow_configuration.system_job_order.keys()
-        user_fields_json = []
-        for field in self.workflow_version.fields:
-            if field['name'] not in system_keys:
-                user_fields_json.append(field)
-        return user_fields_json
+        if self._user_job_fields is None:
+            system_keys = self.workflow_configuration.system_job_order.keys()
+            user_fields_json = []
+            for field in self.workflow_version.fields:
+                if field['name'] not in system_keys:
+                    user_fields_json.append(field)
+            self._user_job_fields = user_fields_json
+        return self._user_job_fields
+
+
+class WorkflowVersionConfigurationCache(object):
+    """
+    Resolves WorkflowVersionConfigurations by tag, reusing them for the lifetime of this object (one request).
+    When settings.BESPIN_WORKFLOW_CONFIGURATION_CACHE_SECONDS is set they are also shared between requests
+    in this process until they expire or a Workflow, WorkflowVersion or WorkflowConfiguration is saved or deleted.
+    """
+    process_configurations = {}
+
+    def __init__(self):
+        self.configurations = {}
+
+    def get(self, tag):
+        """
+        :param tag: str: workflow tag in the format <workflow_tag>/v<version_num>/<configuration_name>
+        :return: WorkflowVersionConfiguration
+        """
+        configuration = self.configurations.get(tag)
+        if configuration is None:
+            configuration = self._get_process_configuration(tag)
+            self.configurations[tag] = configuration
+        return configuration
+
+    @classmethod
+    def _get_process_configuration(cls, tag):
+        cache_seconds = settings.BESPIN_WORKFLOW_CONFIGURATION_CACHE_SECONDS
+        if not cache_seconds:
+            return WorkflowVersionConfiguration(tag)
+        cached = cls.process_configurations.get(tag)
+        if cached:
+            configuration, cached_time = cached
+            if time.time() - cached_time < cache_seconds:
+                return configuration
+        configuration = WorkflowVersionConfiguration(tag)
+        # compute user fields before sharing the configuration with other requests
+        configuration.user_job_fields()
+        cls.process_configurations[tag] = (configuration, time.time())
+        return configuration
+
+    @classmethod
+    def clear_process_cache(cls):
+        cls.process_configurations.clear()
+
+
+@receiver([post_save, post_delete], sender=Workflow)
+@receiver([post_save, post_delete], sender=WorkflowVersion)
+@receiver([post_save, post_delete], sender=WorkflowConfiguration)
+def clear_workflow_version_configuration_cache(sender, **kwargs):
+    WorkflowVersionConfigurationCache.clear_process_cache()
 
 
 class JobTemplate(object):
+    # (placeholder job order, time cached) keyed by tag
+    placeholder_job_orders = {}
+
     def __init__(self, tag, name=STRING_VALUE_PLACEHOLDER, fund_code=STRING_VALUE_PLACEHOLDER,
-                 stage_group=None, job_order=None, job_vm_strategy=None):
+                 stage_group=None, job_order=None, job_vm_strategy=None, workflow_version_configurations=None):
         self.tag = tag
         self.name = name
         self.fund_code = fund_code
         self.stage_group = stage_group
         self.job_order = job_order
         self.job_vm_strategy = job_vm_strategy
+        if workflow_version_configurations is None:
+            workflow_version_configurations = WorkflowVersionConfigurationCache()
+        self.workflow_version_configurations = workflow_version_configurations
         self.job = None
 
+    def get_workflow_version_configuration(self):
+        return self.workflow_version_configurations.get(self.tag)
+
     def populate_job_order(self):
-        workflow_version_config = WorkflowVersionConfiguration(self.tag)
+        """
+        Fill in job_order with placeholder values for the user fields of our workflow version and configuration.
+        Like WorkflowVersionConfigurationCache the generated job order is reused by tag for
+        settings.BESPIN_WORKFLOW_CONFIGURATION_CACHE_SECONDS or until a Workflow, WorkflowVersion or
+        WorkflowConfiguration is saved or deleted in this process, so repeat requests do not touch the database.
+        """
+        self.job_order = copy.deepcopy(self.get_placeholder_job_order())
+
+    def get_placeholder_job_order(self):
+        cache_seconds = settings.BESPIN_WORKFLOW_CONFIGURATION_CACHE_SECONDS
+        if not cache_seconds:
+            return self.create_placeholder_job_order(self.get_workflow_version_configuration().user_job_fields())
+        cached = self.placeholder_job_orders.get(self.tag)
+        if cached:
+            placeholder_job_order, cached_time = cached
+            if time.time() - cached_time < cache_seconds:
+                return placeholder_job_order
+        placeholder_job_order = self.create_placeholder_job_order(
+            self.get_workflow_version_configuration().user_job_fields())
+        self.placeholder_job_orders[self.tag] = (placeholder_job_order, time.time())
+        return placeholder_job_order
+
+    def create_placeholder_job_order(self, user_job_fields):
         formatted_user_fields = {}
-        for user_field in workflow_version_config.user_job_fields():
+        for user_field in user_job_fields:
             field_type = user_field.get('type')
             field_name = user_field.get('name')
             value = self.create_placeholder_value(field_type)
             if value:
                 formatted_user_fields[field_name] = value
-        self.job_order = formatted_user_fields
+        return formatted_user_fields
+
+    @classmethod
+    def clear_placeholder_job_orders(cls):
+        cls.placeholder_job_orders.clear()
 
     def create_placeholder_value(self, type_value):
         if isinstance(type_value, six.string_types):
@@ -121,7 +232,7 @@ class JobTemplate(object):
             return workflow_configuration.default_vm_strategy
 
     def create_job_factory(self, user):
-        workflow_version_configuration = WorkflowVersionConfiguration(self.tag)
+        workflow_version_configuration = self.get_workflow_version_configuration()
         workflow_configuration = workflow_version_configuration.workflow_configuration
         system_job_order = workflow_configuration.system_job_order
         vm_strategy = self.get_vm_strategy(workflow_configuration)
@@ -135,9 +246,62 @@ class JobTemplate(object):
         self.job = job_factory.create_job()
 
 
+@receiver([post_save, post_delete], sender=Workflow)
+@receiver([post_save, post_delete], sender=WorkflowVersion)
+@receiver([post_save, post_delete], sender=WorkflowConfiguration)
+def clear_placeholder_job_orders(sender, **kwargs):
+    JobTemplate.clear_placeholder_job_orders()
+
+
+class JobTemplateBatch(object):
+    """
+    Creates many jobs that share a tag, resolving the workflow version, configuration and vm strategy once.
+    """
+    def __init__(self, tag, job_templates, job_vm_strategy=None, workflow_version_configuration=None):
+        """
+        :param tag: str: workflow tag used for all jobs
+        :param job_templates: [JobTemplate]: name, fund_code, stage_group and job_order for each job
+        :param job_vm_strategy: VMStrategy: overrides the workflow configuration's default vm strategy
+        :param workflow_version_configuration: WorkflowVersionConfiguration: already resolved for tag
+        """
+        self.tag = tag
+        self.job_templates = job_templates
+        self.job_vm_strategy = job_vm_strategy
+        self.workflow_version_configuration = workflow_version_configuration
+
+    def create_job_batch_factory(self, user):
+        if not self.workflow_version_configuration:
+            self.workflow_version_configuration = WorkflowVersionConfigurationCache().get(self.tag)
+        workflow_configuration = self.workflow_version_configuration.workflow_configuration
+        vm_strategy = self.job_vm_strategy
+        if not vm_strategy:
+            vm_strategy = workflow_configuration.default_vm_strategy
+        return JobBatchFactory(user, self.workflow_version_configuration.workflow_version,
+                               workflow_configuration.system_job_order, vm_strategy,
+                               workflow_configuration.share_group)
+
+    def create_jobs(self, user):
+        job_batch_factory = self.create_job_batch_factory(user)
+        jobs = job_batch_factory.create_jobs([
+            (job_template.name, job_template.fund_code, job_template.stage_group, job_template.job_order)
+            for job_template in self.job_templates
+        ])
+        for job_template, job in zip(self.job_templates, jobs):
+            job_template.job = job
+
+
 class JobTemplateValidator(object):
-    def __init__(self, data):
+    def __init__(self, data, user_job_fields=None, workflow_version_configurations=None):
+        """
+        :param data: dict: job template values to validate
+        :param user_job_fields: [dict]: user fields for data['tag'], looked up from the tag when None
+        :param workflow_version_configurations: WorkflowVersionConfigurationCache: used to look up the tag
+        """
         self.data = data
+        self.user_job_fields = user_job_fields
+        if workflow_version_configurations is None:
+            workflow_version_configurations = WorkflowVersionConfigurationCache()
+        self.workflow_version_configurations = workflow_version_configurations
         self.errors = {}
 
     def run(self):
@@ -157,22 +321,197 @@ class JobTemplateValidator(object):
     def validate_job_order(self):
         job_order = self.data.get('job_order')
         if job_order:
-            user_job_fields = self.get_user_job_fields()
-            checker = JobOrderValuesCheck(user_job_fields)
-            checker.walk(job_order)
-            self.errors.update(checker.errors)
+            validator = JobOrderValidator.compile(self.get_user_job_fields())
+            self.errors.update(validator.validate(job_order))
         else:
             self.errors['job_order'] = [REQUIRED_ERROR_MESSAGE]
 
     def get_user_job_fields(self):
+        if self.user_job_fields is not None:
+            return self.user_job_fields
         tag = self.data['tag']
-        return WorkflowVersionConfiguration(tag).user_job_fields()
+        return self.workflow_version_configurations.get(tag).user_job_fields()
 
     @staticmethod
     def is_placeholder_value(value):
         return value in USER_PLACEHOLDER_VALUES
 
 
+class JobOrderValidator(object):
+    """
+    Checks a job order against user job fields for missing keys, placeholders and CWL types.
+    Field types are compiled into (kind, argument) tuples once and values are checked in a single iterative
+    pass so large arrays do not recurse. Use JobOrderValidator.compile to share validators for the same fields.
+    """
+    ANY = 'any'
+    STRING = 'string'
+    INT = 'int'
+    FLOAT = 'float'
+    BOOLEAN = 'boolean'
+    FILE = 'File'
+    DIRECTORY = 'Directory'
+    ENUM = 'enum'
+    ARRAY = 'array'
+    RECORD = 'record'
+    OPTIONAL = 'optional'
+    SIMPLE_TYPES = {
+        'string': (STRING, None),
+        'int': (INT, None),
+        'long': (INT, None),
+        'float': (FLOAT, None),
+        'double': (FLOAT, None),
+        'boolean': (BOOLEAN, None),
+        'File': (FILE, None),
+        'Directory': (DIRECTORY, None),
+    }
+    compiled_validators = {}
+
+    def __init__(self, user_job_fields):
+        """
+        :param user_job_fields: [dict]: CWL input fields with 'name' and 'type'
+        """
+        self.field_specs = [(field['name'], self.compile_type(field.get('type'))) for field in user_job_fields]
+        self.required_keys = [name for name, spec in self.field_specs if spec[0] != self.OPTIONAL]
+        self.field_spec_lookup = dict(self.field_specs)
+
+    @classmethod
+    def compile(cls, user_job_fields):
+        """
+        Return a validator for user_job_fields, reusing one previously compiled for the same fields.
+        :param user_job_fields: [dict]: CWL input fields with 'name' and 'type'
+        :return: JobOrderValidator
+        """
+        key = hashlib.sha1(json.dumps(user_job_fields, sort_keys=True).encode('utf-8')).hexdigest()
+        validator = cls.compiled_validators.get(key)
+        if validator is None:
+            validator = JobOrderValidator(user_job_fields)
+            cls.compiled_validators[key] = validator
+        return validator
+
+    @classmethod
+    def compile_type(cls, type_value):
+        """
+        Convert a CWL type into a (kind, argument) tuple. Types this validator doesn't understand accept any value.
+        """
+        if isinstance(type_value, six.string_types):
+            if type_value.endswith('?'):
+                return cls.OPTIONAL, cls.compile_type(type_value[:-1])
+            if type_value.endswith('[]'):
+                return cls.ARRAY, cls.compile_type(type_value[:-2])
+            if type_value in cls.SIMPLE_TYPES:
+                return cls.SIMPLE_TYPES[type_value]
+            if type_value in RECORD_TYPE_FIELDS:
+                return cls.RECORD, (type_value, cls.compile_record_fields(RECORD_TYPE_FIELDS[type_value]))
+        elif isinstance(type_value, list):
+            types = [item for item in type_value if item != 'null']
+            item_spec = cls.compile_type(types[0]) if len(types) == 1 else (cls.ANY, None)
+            if len(types) < len(type_value):
+                return cls.OPTIONAL, item_spec
+            return item_spec
+        elif isinstance(type_value, dict):
+            kind = type_value.get('type')
+            if kind == 'array':
+                return cls.ARRAY, cls.compile_type(type_value.get('items'))
+            if kind == 'enum':
+                return cls.ENUM, frozenset(symbol.split('/')[-1].split('#')[-1]
+                                           for symbol in type_value.get('symbols', []))
+            if kind == 'record':
+                record_name = type_value.get('name', 'record')
+                return cls.RECORD, (record_name, cls.compile_record_fields(type_value.get('fields', [])))
+        return cls.ANY, None
+
+    @classmethod
+    def compile_record_fields(cls, fields):
+        return [(field['name'].split('/')[-1].split('#')[-1], cls.compile_type(field.get('type'))) for field in fields]
+
+    def validate(self, job_order):
+        """
+        Check job_order returning errors keyed by 'job_order.<field name>'.
+        :param job_order: dict: user job order to check
+        :return: dict: list containing an error message for each top level field with a problem
+        """
+        errors = {}
+        for key in self.required_keys:
+            if key not in job_order:
+                errors[key] = REQUIRED_ERROR_MESSAGE
+        pending = [(key, self.field_spec_lookup.get(key, (self.ANY, None)), value)
+                   for key, value in job_order.items()]
+        while pending:
+            key, spec, value = pending.pop()
+            if key in errors:
+                continue
+            error = self._check_value(key, spec, value, pending)
+            if error:
+                errors[key] = error
+        return dict(('job_order.{}'.format(key), [error]) for key, error in errors.items())
+
+    def _check_value(self, key, spec, value, pending):
+        """
+        Check a single value against spec, adding any nested values to pending.
+        :return: str: error message or None if the value is valid so far
+        """
+        kind, argument = spec
+        if kind == self.OPTIONAL:
+            if value is None:
+                return None
+            kind, argument = argument
+        if isinstance(value, six.string_types) and JobTemplateValidator.is_placeholder_value(value):
+            return PLACEHOLDER_ERROR_MESSAGE
+        if kind == self.ANY:
+            if isinstance(value, list):
+                pending.extend((key, spec, item) for item in value)
+            elif isinstance(value, dict):
+                if 'class' in value:
+                    return self._check_class_value(value, value['class'])
+                pending.extend((key, spec, item) for item in value.values())
+            return None
+        if kind == self.STRING:
+            return None if isinstance(value, six.string_types) else TYPE_ERROR_MESSAGE.format('string')
+        if kind == self.INT:
+            if isinstance(value, six.integer_types) and not isinstance(value, bool):
+                return None
+            return TYPE_ERROR_MESSAGE.format('int')
+        if kind == self.FLOAT:
+            if isinstance(value, (float,) + six.integer_types) and not isinstance(value, bool):
+                return None
+            return TYPE_ERROR_MESSAGE.format('float')
+        if kind == self.BOOLEAN:
+            return None if isinstance(value, bool) else TYPE_ERROR_MESSAGE.format('boolean')
+        if kind == self.FILE or kind == self.DIRECTORY:
+            if not isinstance(value, dict) or value.get('class') != kind:
+                return TYPE_ERROR_MESSAGE.format(kind)
+            return self._check_class_value(value, kind)
+        if kind == self.ENUM:
+            if isinstance(value, six.string_types) and value in argument:
+                return None
+            return TYPE_ERROR_MESSAGE.format('enum')
+        if kind == self.ARRAY:
+            if not isinstance(value, list):
+                return TYPE_ERROR_MESSAGE.format('array')
+            pending.extend((key, argument, item) for item in value)
+            return None
+        if kind == self.RECORD:
+            record_name, record_fields = argument
+            if not isinstance(value, dict):
+                return TYPE_ERROR_MESSAGE.format(record_name)
+            for field_name, field_spec in record_fields:
+                if field_name not in value:
+                    if field_spec[0] != self.OPTIONAL:
+                        return TYPE_ERROR_MESSAGE.format(record_name)
+                else:
+                    pending.append((key, field_spec, value[field_name]))
+            return None
+        return None
+
+    @staticmethod
+    def _check_class_value(value, class_name):
+        if class_name in ('File', 'Directory'):
+            path = value.get('path', value.get('location'))
+            if path and JobTemplateValidator.is_placeholder_value(path):
+                return PLACEHOLDER_ERROR_MESSAGE
+        return None
+
+
 class JobOrderWalker(object):
     def walk(self, obj):
         for key in obj.keys():
@@ -213,27 +552,90 @@ class JobOrderWalker(object):
         return path
 
 
-class JobOrderValuesCheck(JobOrderWalker):
-    def __init__(self, user_job_fields):
-        self.user_job_keys = [field['name'] for field in user_job_fields]
-        self.errors = {}
-
-    def walk(self, obj):
-        for required_key in self.user_job_keys:
-            if not required_key in obj:
-                self._on_bad_value(required_key, REQUIRED_ERROR_MESSAGE)
-        super(JobOrderValuesCheck, self).walk(obj)
+class DDSFilePathCollector(JobOrderWalker):
+    """
+    Collects dds:// paths of File values in a job order and rewrites them to the paths they will be staged at.
+    """
+    def __init__(self):
+        self.paths_by_key = {}
+        self.keys = []
 
     def on_class_value(self, top_level_key, value):
         if value['class'] == 'File':
             path = value.get('path')
-            if path and JobTemplateValidator.is_placeholder_value(path):
-                self._on_bad_value(top_level_key, PLACEHOLDER_ERROR_MESSAGE)
+            if path and path.startswith(DUKEDS_PATH_PREFIX):
+                if top_level_key not in self.paths_by_key:
+                    self.keys.append(top_level_key)
+                    self.paths_by_key[top_level_key] = []
+                self.paths_by_key[top_level_key].append(path)
+                value['path'] = self.format_file_path(path)
+
+    @staticmethod
+    def split_dds_path(path):
+        """
+        :param path: str: format dds://<projectname>/<filepath>
+        :return: (str, str): project name and file path within the project
+        """
+        project_name, _, file_path = path[len(DUKEDS_PATH_PREFIX):].partition('/')
+        return project_name, file_path
 
-    def on_simple_value(self, top_level_key, value):
-        if JobTemplateValidator.is_placeholder_value(value):
-            self._on_bad_value(top_level_key, PLACEHOLDER_ERROR_MESSAGE)
 
-    def _on_bad_value(self, key, error_message):
-        complete_name = 'job_order.{}'.format(key)
-        self.errors[complete_name] = [error_message]
+class DDSStageGroupBuilder(object):
+    """
+    Creates a stage group containing the DukeDS files referenced by dds:// paths in a job order.
+    """
+    def __init__(self, user, dds_user_credentials, max_workers=None):
+        """
+        :param user: User: owner of the stage group, their DukeDS credentials are used to look up files
+        :param dds_user_credentials: DDSUserCredential: credentials used to download the files when staging
+        :param max_workers: int: maximum number of DukeDS projects to fetch at the same time
+        """
+        self.user = user
+        self.dds_user_credentials = dds_user_credentials
+        if max_workers is None:
+            max_workers = settings.BESPIN_DDS_LOOKUP_WORKERS
+        self.max_workers = max_workers
+
+    def build(self, job_order):
+        """
+        Create a stage group with a DDSJobInputFile for each unique dds:// path in job_order.
+        :param job_order: dict: user job order containing File values with dds:// paths
+        :return: (JobFileStageGroup, dict): stage group and job order with paths replaced by staging paths
+        """
+        staged_job_order = copy.deepcopy(job_order)
+        collector = DDSFilePathCollector()
+        collector.walk(staged_job_order)
+        project_names = set()
+        for key in collector.keys:
+            for path in collector.paths_by_key[key]:
+                project_names.add(collector.split_dds_path(path)[0])
+        project_files = {}
+        if project_names:
+            project_files = get_user_project_files_by_path(self.user, project_names, self.max_workers)
+        dds_files = self._make_dds_files(collector, project_files)
+        with transaction.atomic():
+            stage_group = JobFileStageGroup.objects.create(user=self.user)
+            stage_group.add_files(dds_files, [])
+        return stage_group, staged_job_order
+
+    def _make_dds_files(self, collector, project_files):
+        errors = {}
+        dds_files = []
+        added_paths = set()
+        for sequence_group, key in enumerate(collector.keys):
+            for sequence, path in enumerate(collector.paths_by_key[key]):
+                project_name, file_path = collector.split_dds_path(path)
+                dds_file = project_files.get(project_name, {}).get(file_path)
+                if not dds_file:
+                    errors.setdefault('job_order.{}'.format(key), []).append(
+                        'File not found in DukeDS: {}'.format(path))
+                elif path not in added_paths:
+                    added_paths.add(path)
+                    dds_files.append(DDSJobInputFile(project_id=dds_file.project, file_id=dds_file.id,
+                                                     dds_user_credentials=self.dds_user_credentials,
+                                                     destination_path=collector.format_file_path(path),
+                                                     size=dds_file.size, sequence_group=sequence_group,
+                                                     sequence=sequence))
+        if errors:
+            raise ValidationError(errors)
+        return dds_files
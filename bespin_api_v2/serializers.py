@@ -2,9 +2,12 @@ import json
 from rest_framework import serializers, fields
 from django.contrib.auth.models import User
 from data.models import Workflow, WorkflowVersion, VMStrategy, WorkflowConfiguration, JobFileStageGroup, VMStrategy, \
-    ShareGroup, VMFlavor, Job
+    ShareGroup, VMFlavor, Job, DDSUserCredential
 from bespin_api_v2.jobtemplate import JobTemplate, WorkflowVersionConfiguration, JobTemplateValidator, \
-    REQUIRED_ERROR_MESSAGE, PLACEHOLDER_ERROR_MESSAGE
+    JobTemplateBatch, WorkflowVersionConfigurationCache, DDSStageGroupBuilder, REQUIRED_ERROR_MESSAGE, \
+    PLACEHOLDER_ERROR_MESSAGE
+from data.exceptions import InvalidWorkflowTagException
+from data.jobfactory import WorkerDDSUserCredentialCache
 
 
 class AdminWorkflowSerializer(serializers.ModelSerializer):
@@ -61,6 +64,14 @@ class VMStrategySerializer(serializers.ModelSerializer):
         fields = '__all__'
 
 
+def get_workflow_version_configurations(serializer):
+    """
+    Return the WorkflowVersionConfigurationCache shared by everything using this serializer's context.
+    Serializers are created for each request so tags are resolved at most once per request.
+    """
+    return serializer.context.setdefault('workflow_version_configurations', WorkflowVersionConfigurationCache())
+
+
 class JobTemplateMinimalSerializer(serializers.Serializer):
     tag = serializers.CharField()
     name = serializers.CharField(required=False)
@@ -68,7 +79,8 @@ class JobTemplateMinimalSerializer(serializers.Serializer):
     job_order = serializers.DictField(required=False)
 
     def create(self, validated_data):
-        return JobTemplate(**validated_data)
+        return JobTemplate(workflow_version_configurations=get_workflow_version_configurations(self),
+                           **validated_data)
 
 
 class JobTemplateValidatingSerializer(JobTemplateMinimalSerializer):
@@ -77,7 +89,7 @@ class JobTemplateValidatingSerializer(JobTemplateMinimalSerializer):
     checking the contents of the job order dictionary against fields in the database.
     """
     def validate(self, data):
-        JobTemplateValidator(data).run()
+        JobTemplateValidator(data, workflow_version_configurations=get_workflow_version_configurations(self)).run()
         return data
 
 
@@ -88,6 +100,104 @@ class JobTemplateSerializer(JobTemplateValidatingSerializer):
     job = serializers.PrimaryKeyRelatedField(required=False, read_only=True)
 
 
+class StageGroupIdField(serializers.IntegerField):
+    """
+    Accepts a stage group id, leaving the lookup to the parent serializer so many can be fetched at once.
+    """
+    def to_representation(self, value):
+        return value.pk
+
+
+class JobTemplateBatchEntrySerializer(serializers.Serializer):
+    name = serializers.CharField(required=False)
+    fund_code = serializers.CharField(required=False)
+    job_order = serializers.DictField(required=False)
+    stage_group = StageGroupIdField()
+    job = serializers.PrimaryKeyRelatedField(required=False, read_only=True)
+
+
+class JobTemplateBatchSerializer(serializers.Serializer):
+    """
+    Creates a job for each entry in jobs using a single tag.
+    All entries are validated before any jobs are created.
+    """
+    tag = serializers.CharField()
+    job_vm_strategy = serializers.PrimaryKeyRelatedField(
+        queryset=VMStrategy.objects.all(), required=False)
+    jobs = JobTemplateBatchEntrySerializer(many=True, source='job_templates')
+
+    def validate(self, data):
+        try:
+            workflow_version_configuration = get_workflow_version_configurations(self).get(data['tag'])
+        except (WorkflowVersion.DoesNotExist, WorkflowConfiguration.DoesNotExist, InvalidWorkflowTagException,
+                ValueError):
+            raise serializers.ValidationError({'tag': ['No workflow configuration found for this tag.']})
+        user_job_fields = workflow_version_configuration.user_job_fields()
+        stage_groups = self._lookup_stage_groups(data['job_templates'])
+        errors = []
+        used_stage_group_ids = set()
+        for entry in data['job_templates']:
+            validator = JobTemplateValidator(dict(entry, tag=data['tag']), user_job_fields)
+            validator.errors = self._stage_group_errors(entry['stage_group'], stage_groups, used_stage_group_ids)
+            try:
+                validator.run()
+                errors.append({})
+            except serializers.ValidationError as e:
+                errors.append(e.detail)
+            used_stage_group_ids.add(entry['stage_group'])
+        if any(errors):
+            raise serializers.ValidationError({'jobs': errors})
+        for entry in data['job_templates']:
+            entry['stage_group'] = stage_groups[entry['stage_group']]
+        data['workflow_version_configuration'] = workflow_version_configuration
+        return data
+
+    def _lookup_stage_groups(self, entries):
+        """
+        Fetch the current user's stage groups referenced by entries that are not already used by a job.
+        """
+        stage_group_ids = [entry['stage_group'] for entry in entries]
+        queryset = JobFileStageGroup.objects.filter(user=self.context['request'].user, job__isnull=True)
+        return queryset.in_bulk(stage_group_ids)
+
+    @staticmethod
+    def _stage_group_errors(stage_group_id, stage_groups, used_stage_group_ids):
+        if stage_group_id not in stage_groups:
+            return {'stage_group': ['Stage group not found or already used by another job.']}
+        if stage_group_id in used_stage_group_ids:
+            return {'stage_group': ['Stage group is used by more than one job.']}
+        return {}
+
+    def create(self, validated_data):
+        job_templates = [JobTemplate(validated_data['tag'], **entry) for entry in validated_data['job_templates']]
+        return JobTemplateBatch(validated_data['tag'], job_templates,
+                                job_vm_strategy=validated_data.get('job_vm_strategy'),
+                                workflow_version_configuration=validated_data['workflow_version_configuration'])
+
+
+class DDSStageGroupSerializer(serializers.Serializer):
+    """
+    Creates a stage group from the dds:// paths in job_order.
+    The job_order in the response has those paths replaced by the paths the files will be staged to.
+    """
+    job_order = serializers.DictField()
+    dds_user_credentials = serializers.PrimaryKeyRelatedField(queryset=DDSUserCredential.objects.all(),
+                                                              required=False)
+    stage_group = serializers.PrimaryKeyRelatedField(read_only=True)
+
+    def create(self, validated_data):
+        dds_user_credentials = validated_data.get('dds_user_credentials')
+        if not dds_user_credentials:
+            dds_user_credentials = WorkerDDSUserCredentialCache.get()
+        builder = DDSStageGroupBuilder(self.context['request'].user, dds_user_credentials)
+        stage_group, job_order = builder.build(validated_data['job_order'])
+        return {
+            'job_order': job_order,
+            'dds_user_credentials': dds_user_credentials,
+            'stage_group': stage_group,
+        }
+
+
 class ShareGroupSerializer(serializers.ModelSerializer):
     class Meta:
         model = ShareGroup
@@ -1,11 +1,12 @@
 import json
+from unittest.mock import patch, Mock
 from django.core.urlresolvers import reverse
 from rest_framework.test import APITestCase
 from rest_framework import status
 from data.tests_api import UserLogin
 from data.models import Workflow, WorkflowVersion, WorkflowConfiguration, VMStrategy, ShareGroup, VMFlavor, \
     VMSettings, CloudSettings, VMProject, JobFileStageGroup, DDSUserCredential, DDSEndpoint, Job
-from bespin_api_v2.jobtemplate import STRING_VALUE_PLACEHOLDER, INT_VALUE_PLACEHOLDER, \
+from bespin_api_v2.jobtemplate import WorkflowVersionConfiguration, STRING_VALUE_PLACEHOLDER, INT_VALUE_PLACEHOLDER, \
     REQUIRED_ERROR_MESSAGE, PLACEHOLDER_ERROR_MESSAGE
 
 
@@ -610,6 +611,23 @@ class JobTemplatesViewSetTestCase(APITestCase):
         self.assertEqual(jobs[0].fund_code, '001')
         self.assertEqual(json.loads(jobs[0].job_order), {'A':'B', 'threads': 12, 'items': 'pie'})
 
+    def test_create_job_resolves_tag_once(self):
+        user = self.user_login.become_normal_user()
+        DDSUserCredential.objects.create(endpoint=self.endpoint, user=user, token='secret1', dds_id='1')
+        stage_group = JobFileStageGroup.objects.create(user=user)
+        url = reverse('v2-jobtemplate_createjob')
+        with patch('bespin_api_v2.jobtemplate.WorkflowVersionConfiguration',
+                   wraps=WorkflowVersionConfiguration) as mock_workflow_version_configuration:
+            response = self.client.post(url, format='json', data={
+                'tag': 'exomeseq/v1/b37xGen',
+                'name': 'My Job',
+                'fund_code': '001',
+                'stage_group': stage_group.id,
+                'job_order': {'threads': 12, 'items': 'pie'},
+            })
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        mock_workflow_version_configuration.assert_called_once_with('exomeseq/v1/b37xGen')
+
     def test_create_job_with_vm_strategy(self):
         user = self.user_login.become_normal_user()
         DDSUserCredential.objects.create(endpoint=self.endpoint, user=user, token='secret1', dds_id='1')
@@ -634,6 +652,96 @@ class JobTemplatesViewSetTestCase(APITestCase):
         self.assertEqual(json.loads(jobs[0].job_order), {'A': 'B', 'threads': 12, 'items': 'pie'})
 
 
+    def test_create_jobs(self):
+        user = self.user_login.become_normal_user()
+        DDSUserCredential.objects.create(endpoint=self.endpoint, user=user, token='secret1', dds_id='1')
+        stage_groups = [JobFileStageGroup.objects.create(user=user) for _ in range(3)]
+        url = reverse('v2-jobtemplate_createjobs')
+        response = self.client.post(url, format='json', data={
+            'tag': 'exomeseq/v1/b37xGen',
+            'jobs': [
+                {
+                    'name': 'Sample {}'.format(i),
+                    'fund_code': '001',
+                    'stage_group': stage_group.id,
+                    'job_order': {'threads': i, 'items': 'pie'},
+                } for i, stage_group in enumerate(stage_groups)
+            ]
+        })
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        jobs = Job.objects.order_by('name')
+        self.assertEqual([job.name for job in jobs], ['Sample 0', 'Sample 1', 'Sample 2'])
+        self.assertEqual([item['job'] for item in response.data['jobs']], [job.id for job in jobs])
+        self.assertEqual([item['stage_group'] for item in response.data['jobs']],
+                         [stage_group.id for stage_group in stage_groups])
+        self.assertEqual(json.loads(jobs[2].job_order), {'A': 'B', 'threads': 2, 'items': 'pie'})
+        self.assertEqual(jobs[2].vm_flavor, self.vm_strategy.vm_flavor)
+        self.assertEqual(jobs[2].share_group, self.share_group)
+
+    def test_create_jobs_validates_all_entries(self):
+        other_user = self.user_login.become_other_normal_user()
+        other_stage_group = JobFileStageGroup.objects.create(user=other_user)
+        user = self.user_login.become_normal_user()
+        stage_group = JobFileStageGroup.objects.create(user=user)
+        url = reverse('v2-jobtemplate_createjobs')
+        response = self.client.post(url, format='json', data={
+            'tag': 'exomeseq/v1/b37xGen',
+            'jobs': [
+                {'name': 'Good', 'fund_code': '001', 'stage_group': stage_group.id,
+                 'job_order': {'threads': 1, 'items': 'pie'}},
+                {'name': 'Reused', 'fund_code': '001', 'stage_group': stage_group.id,
+                 'job_order': {'threads': 1, 'items': 'pie'}},
+                {'name': 'Other user', 'fund_code': STRING_VALUE_PLACEHOLDER, 'stage_group': other_stage_group.id,
+                 'job_order': {'threads': 1}},
+            ]
+        })
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        errors = response.data['jobs']
+        self.assertEqual(errors[0], {})
+        self.assertEqual(list(errors[1].keys()), ['stage_group'])
+        self.assertEqual(set(errors[2].keys()), set(['stage_group', 'fund_code', 'job_order.items']))
+        self.assertEqual(Job.objects.count(), 0)
+
+    def test_create_jobs_bad_tag(self):
+        self.user_login.become_normal_user()
+        url = reverse('v2-jobtemplate_createjobs')
+        response = self.client.post(url, format='json', data={'tag': 'exomeseq/v9/b37xGen', 'jobs': []})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('tag', response.data)
+
+    @patch('bespin_api_v2.jobtemplate.get_user_project_files_by_path')
+    def test_create_stage_group(self, mock_get_user_project_files_by_path):
+        user = self.user_login.become_normal_user()
+        dds_user_credentials = DDSUserCredential.objects.create(endpoint=self.endpoint, user=user, token='secret1',
+                                                                dds_id='1')
+        mock_file = Mock(id='file1', project='project1', size=100)
+        mock_get_user_project_files_by_path.return_value = {'mouse': {'data/sample1.fastq': mock_file}}
+        url = reverse('v2-jobtemplate_createstagegroup')
+        response = self.client.post(url, format='json', data={
+            'job_order': {'reads': {'class': 'File', 'path': 'dds://mouse/data/sample1.fastq'}, 'threads': 1}
+        })
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        stage_group = JobFileStageGroup.objects.get(pk=response.data['stage_group'])
+        self.assertEqual(stage_group.user, user)
+        self.assertEqual(stage_group.dds_files.get().dds_user_credentials, dds_user_credentials)
+        self.assertEqual(response.data['dds_user_credentials'], dds_user_credentials.id)
+        self.assertEqual(response.data['job_order'],
+                         {'reads': {'class': 'File', 'path': 'dds_mouse_data_sample1.fastq'}, 'threads': 1})
+
+    @patch('bespin_api_v2.jobtemplate.get_user_project_files_by_path')
+    def test_create_stage_group_missing_file(self, mock_get_user_project_files_by_path):
+        user = self.user_login.become_normal_user()
+        DDSUserCredential.objects.create(endpoint=self.endpoint, user=user, token='secret1', dds_id='1')
+        mock_get_user_project_files_by_path.return_value = {}
+        url = reverse('v2-jobtemplate_createstagegroup')
+        response = self.client.post(url, format='json', data={
+            'job_order': {'reads': {'class': 'File', 'path': 'dds://mouse/data/sample1.fastq'}}
+        })
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('job_order.reads', response.data)
+        self.assertEqual(JobFileStageGroup.objects.count(), 0)
+
+
 class ShareGroupViewSetTestCase(APITestCase):
     def setUp(self):
         self.user_login = UserLogin(self.client)
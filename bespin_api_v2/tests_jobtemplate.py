@@ -1,8 +1,13 @@
 from django.test import TestCase
 from rest_framework.exceptions import ValidationError
 from bespin_api_v2.jobtemplate import WorkflowVersionConfiguration, JobTemplate, InvalidWorkflowTagException, \
-    JobOrderWalker, JobOrderValuesCheck, JobTemplateValidator, STRING_VALUE_PLACEHOLDER, INT_VALUE_PLACEHOLDER, \
-    FILE_PLACEHOLDER, REQUIRED_ERROR_MESSAGE, PLACEHOLDER_ERROR_MESSAGE
+    JobOrderWalker, JobTemplateValidator, STRING_VALUE_PLACEHOLDER, INT_VALUE_PLACEHOLDER, \
+    FILE_PLACEHOLDER, REQUIRED_ERROR_MESSAGE, PLACEHOLDER_ERROR_MESSAGE, WorkflowVersionConfigurationCache, \
+    JobOrderValidator, TYPE_ERROR_MESSAGE, DDSFilePathCollector, DDSStageGroupBuilder
+from data.models import Workflow, WorkflowVersion, WorkflowConfiguration, VMFlavor, VMProject, CloudSettings, \
+    VMSettings, VMStrategy, ShareGroup, DDSEndpoint, DDSUserCredential, JobFileStageGroup
+from django.contrib.auth.models import User
+from django.test.utils import override_settings
 from mock import patch, ANY, Mock, call
 
 
@@ -36,7 +41,68 @@ class WorkflowVersionConfigurationTestCase(TestCase):
         self.assertEqual(item.user_job_fields(), [{'name': 'field2'}])
 
 
+class WorkflowVersionConfigurationCacheTestCase(TestCase):
+    def setUp(self):
+        WorkflowVersionConfigurationCache.clear_process_cache()
+
+    def tearDown(self):
+        WorkflowVersionConfigurationCache.clear_process_cache()
+
+    @override_settings(BESPIN_WORKFLOW_CONFIGURATION_CACHE_SECONDS=0)
+    @patch('bespin_api_v2.jobtemplate.WorkflowVersionConfiguration')
+    def test_get_resolves_tag_once_per_cache(self, mock_workflow_version_configuration):
+        cache = WorkflowVersionConfigurationCache()
+        self.assertEqual(cache.get('exome/v1/human'), mock_workflow_version_configuration.return_value)
+        cache.get('exome/v1/human')
+        mock_workflow_version_configuration.assert_called_once_with('exome/v1/human')
+        cache.get('exome/v1/mouse')
+        WorkflowVersionConfigurationCache().get('exome/v1/human')
+        self.assertEqual(mock_workflow_version_configuration.call_count, 3)
+
+    @override_settings(BESPIN_WORKFLOW_CONFIGURATION_CACHE_SECONDS=60)
+    @patch('bespin_api_v2.jobtemplate.WorkflowVersionConfiguration')
+    def test_process_cache_shared_between_caches(self, mock_workflow_version_configuration):
+        first = WorkflowVersionConfigurationCache().get('exome/v1/human')
+        second = WorkflowVersionConfigurationCache().get('exome/v1/human')
+        self.assertEqual(first, second)
+        mock_workflow_version_configuration.assert_called_once_with('exome/v1/human')
+        first.user_job_fields.assert_called_once_with()
+
+    @override_settings(BESPIN_WORKFLOW_CONFIGURATION_CACHE_SECONDS=60)
+    def test_process_cache_cleared_on_save(self):
+        workflow = Workflow.objects.create(name='Exome Seq', tag='exome')
+        workflow_version = WorkflowVersion.objects.create(workflow=workflow, version=1, url='',
+                                                          fields=[{'name': 'threads'}, {'name': 'items'}])
+        vm_settings = VMSettings.objects.create(
+            cloud_settings=CloudSettings.objects.create(vm_project=VMProject.objects.create()))
+        vm_strategy = VMStrategy.objects.create(name='default', vm_flavor=VMFlavor.objects.create(name='large'),
+                                                vm_settings=vm_settings)
+        workflow_configuration = WorkflowConfiguration.objects.create(
+            tag='human', workflow=workflow, system_job_order={'threads': 4}, default_vm_strategy=vm_strategy,
+            share_group=ShareGroup.objects.create())
+        configuration = WorkflowVersionConfigurationCache().get('exome/v1/human')
+        self.assertEqual(configuration.user_job_fields(), [{'name': 'items'}])
+        self.assertIs(WorkflowVersionConfigurationCache().get('exome/v1/human'), configuration)
+
+        workflow_configuration.system_job_order = {'items': 'abc'}
+        workflow_configuration.save()
+        configuration = WorkflowVersionConfigurationCache().get('exome/v1/human')
+        self.assertEqual(configuration.user_job_fields(), [{'name': 'threads'}])
+
+        workflow_version.fields = [{'name': 'threads'}]
+        workflow_version.save()
+        configuration = WorkflowVersionConfigurationCache().get('exome/v1/human')
+        self.assertEqual(configuration.user_job_fields(), [{'name': 'threads'}])
+        self.assertEqual(configuration.workflow_version.fields, [{'name': 'threads'}])
+
+
 class JobTemplateTestCase(TestCase):
+    def setUp(self):
+        JobTemplate.clear_placeholder_job_orders()
+
+    def tearDown(self):
+        JobTemplate.clear_placeholder_job_orders()
+
     @patch('bespin_api_v2.jobtemplate.WorkflowVersionConfiguration')
     def test_create_job_order(self, mock_workflow_version_configuration):
         user_fields = [
@@ -56,6 +122,55 @@ class JobTemplateTestCase(TestCase):
             'two_d_ary': [[INT_VALUE_PLACEHOLDER]],
         })
 
+    @override_settings(BESPIN_WORKFLOW_CONFIGURATION_CACHE_SECONDS=60)
+    @patch('bespin_api_v2.jobtemplate.time')
+    @patch('bespin_api_v2.jobtemplate.WorkflowVersionConfiguration')
+    def test_populate_job_order_reuses_placeholders(self, mock_workflow_version_configuration, mock_time):
+        mock_time.time.return_value = 100
+        mock_workflow_version_configuration.return_value.user_job_fields.return_value = [
+            {"type": "int", "name": "myint"},
+        ]
+        first = JobTemplate(tag="exome/v1/human")
+        first.populate_job_order()
+        first.job_order['myint'] = 5
+        second = JobTemplate(tag="exome/v1/human")
+        second.populate_job_order()
+        self.assertEqual(second.job_order, {'myint': INT_VALUE_PLACEHOLDER})
+        # a cache hit does not look up the workflow version configuration
+        self.assertEqual(mock_workflow_version_configuration.call_count, 1)
+
+        other = JobTemplate(tag="exome/v2/human")
+        other.populate_job_order()
+        self.assertEqual(mock_workflow_version_configuration.call_count, 2)
+
+        # changes saved by other processes are picked up once the cached job order expires
+        mock_workflow_version_configuration.return_value.user_job_fields.return_value = [
+            {"type": "string", "name": "mystr"},
+        ]
+        mock_time.time.return_value = 160
+        expired = JobTemplate(tag="exome/v1/human")
+        expired.populate_job_order()
+        self.assertEqual(expired.job_order, {'mystr': STRING_VALUE_PLACEHOLDER})
+
+    @override_settings(BESPIN_WORKFLOW_CONFIGURATION_CACHE_SECONDS=0)
+    @patch('bespin_api_v2.jobtemplate.WorkflowVersionConfiguration')
+    def test_populate_job_order_without_cache(self, mock_workflow_version_configuration):
+        mock_workflow_version_configuration.return_value.user_job_fields.return_value = [
+            {"type": "int", "name": "myint"},
+        ]
+        JobTemplate(tag="exome/v1/human").populate_job_order()
+        JobTemplate(tag="exome/v1/human").populate_job_order()
+        self.assertEqual(mock_workflow_version_configuration.call_count, 2)
+        self.assertEqual(JobTemplate.placeholder_job_orders, {})
+
+    def test_placeholder_job_orders_cleared_on_save(self):
+        workflow = Workflow.objects.create(name='Exome Seq', tag='exome')
+        workflow_version = WorkflowVersion.objects.create(workflow=workflow, version=1, url='',
+                                                          fields=[{'name': 'threads', 'type': 'int'}])
+        JobTemplate.placeholder_job_orders['exome/v1/human'] = ({}, 0)
+        workflow_version.save()
+        self.assertEqual(JobTemplate.placeholder_job_orders, {})
+
     def test_create_placeholder_value(self):
         job_template = JobTemplate(tag="exome/v1/human", job_order={"A": "B"})
         self.assertEqual(
@@ -186,11 +301,11 @@ class JobTemplateTestCase(TestCase):
 
 
 class JobTemplateValidatorTestCase(TestCase):
-    @patch('bespin_api_v2.jobtemplate.JobOrderValuesCheck')
+    @patch('bespin_api_v2.jobtemplate.JobOrderValidator')
     @patch('bespin_api_v2.jobtemplate.WorkflowVersionConfiguration')
-    def test_run_null_required_fields(self, mock_workflow_version_configuration, mock_job_order_values_check):
+    def test_run_null_required_fields(self, mock_workflow_version_configuration, mock_job_order_validator):
         mock_workflow_version_configuration.return_value.user_job_fields.return_value = []
-        mock_job_order_values_check.return_value = Mock(errors=[])
+        mock_job_order_validator.compile.return_value.validate.return_value = {}
         validator = JobTemplateValidator({
             'tag': 'exome/v1/human',
         })
@@ -201,6 +316,7 @@ class JobTemplateValidatorTestCase(TestCase):
             'fund_code': [REQUIRED_ERROR_MESSAGE],
             'job_order': [REQUIRED_ERROR_MESSAGE],
         })
+        mock_job_order_validator.compile.return_value.validate.assert_not_called()
 
     @patch('bespin_api_v2.jobtemplate.WorkflowVersionConfiguration')
     def test_run_with_placeholders(self, mock_workflow_version_configuration):
@@ -221,11 +337,11 @@ class JobTemplateValidatorTestCase(TestCase):
             'job_order.threads': [PLACEHOLDER_ERROR_MESSAGE],
         })
 
-    @patch('bespin_api_v2.jobtemplate.JobOrderValuesCheck')
+    @patch('bespin_api_v2.jobtemplate.JobOrderValidator')
     @patch('bespin_api_v2.jobtemplate.WorkflowVersionConfiguration')
-    def test_run(self, mock_workflow_version_configuration, mock_job_order_values_check):
+    def test_run(self, mock_workflow_version_configuration, mock_job_order_validator):
         mock_workflow_version_configuration.return_value.user_job_fields.return_value = []
-        mock_job_order_values_check.return_value = Mock(errors=[])
+        mock_job_order_validator.compile.return_value.validate.return_value = {}
         validator = JobTemplateValidator({
             'tag': 'exome/v1/human',
             'name': 'myjob',
@@ -235,6 +351,8 @@ class JobTemplateValidatorTestCase(TestCase):
             }
         })
         validator.run()
+        mock_job_order_validator.compile.assert_called_with([])
+        mock_job_order_validator.compile.return_value.validate.assert_called_with({'threads': 12})
 
     @patch('bespin_api_v2.jobtemplate.WorkflowVersionConfiguration')
     def test_run_check_job_order_values(self, mock_workflow_version_configuration):
@@ -321,63 +439,165 @@ class JobOrderWalkerTestCase(TestCase):
             self.assertEqual(JobOrderWalker.format_file_path(input_val), expected_val)
 
 
-class JobOrderValuesCheckTestCase(TestCase):
+class DDSFilePathCollectorTestCase(TestCase):
     def test_walk(self):
         job_order = {
-            'good_str': 'a',
-            'bad_str': STRING_VALUE_PLACEHOLDER,
-            'good_int': 123,
-            'bad_int': INT_VALUE_PLACEHOLDER,
-            'good_file': {
-                'class': 'File',
-                'path': 'somepath.txt',
-            },
-            'bad_file': {
-                'class': 'File',
-                'path': FILE_PLACEHOLDER,
-            },
-            'good_str_ary': ['a', 'b', 'c'],
-            'bad_str_ary': ['a', STRING_VALUE_PLACEHOLDER, 'c'],
-            'good_file_ary': [{
-                'class': 'File',
-                'path': 'somepath.txt',
-            }],
-            'bad_file_ary': [{
-                'class': 'File',
-                'path': FILE_PLACEHOLDER,
-            }],
-            'good_file_dict': {
-                'stuff': {
-                    'class': 'File',
-                    'path': 'somepath.txt',
-                }
-            },
-            'bad_file_dict': {
-                'stuff': {
-                    'class': 'File',
-                    'path': FILE_PLACEHOLDER,
-                }
-            },
-            'plain_path_file': {
-                'class': 'File',
-                'path': '/tmp/data.txt'
-            },
-            'url_file': {
-                'class': 'File',
-                'location': 'https://github.com/datafile1.dat'
-            },
+            'reads': [
+                {'class': 'File', 'path': 'dds://mouse/data/sample1.fastq'},
+                {'class': 'File', 'path': 'dds://mouse/data/sample2.fastq'},
+            ],
+            'reference': {'class': 'File', 'path': 'dds://genomes/b37.fa'},
+            'url_file': {'class': 'File', 'location': 'https://github.com/datafile1.dat'},
+            'threads': 2,
+        }
+        collector = DDSFilePathCollector()
+        collector.walk(job_order)
+        self.assertEqual(set(collector.keys), {'reads', 'reference'})
+        self.assertEqual(collector.paths_by_key['reads'],
+                         ['dds://mouse/data/sample1.fastq', 'dds://mouse/data/sample2.fastq'])
+        self.assertEqual(collector.paths_by_key['reference'], ['dds://genomes/b37.fa'])
+        self.assertEqual(job_order['reads'][0]['path'], 'dds_mouse_data_sample1.fastq')
+        self.assertEqual(job_order['reference']['path'], 'dds_genomes_b37.fa')
+        self.assertEqual(job_order['url_file'], {'class': 'File', 'location': 'https://github.com/datafile1.dat'})
+
+    def test_split_dds_path(self):
+        self.assertEqual(DDSFilePathCollector.split_dds_path('dds://mouse/data/sample1.fastq'),
+                         ('mouse', 'data/sample1.fastq'))
+
+
+class DDSStageGroupBuilderTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('user')
+        endpoint = DDSEndpoint.objects.create(name='DukeDS', agent_key='secret', api_root='https://someserver.com/api')
+        self.dds_user_credentials = DDSUserCredential.objects.create(endpoint=endpoint, user=self.user,
+                                                                     token='secret1', dds_id='1')
+        self.project_files = {
+            'mouse': {
+                'data/sample1.fastq': Mock(id='file1', project='project1', size=100),
+                'data/sample2.fastq': Mock(id='file2', project='project1', size=200),
+            }
         }
-        expected_keys = {
-            'job_order.bad_str': [PLACEHOLDER_ERROR_MESSAGE],
-            'job_order.bad_int': [PLACEHOLDER_ERROR_MESSAGE],
-            'job_order.bad_file': [PLACEHOLDER_ERROR_MESSAGE],
-            'job_order.bad_str_ary': [PLACEHOLDER_ERROR_MESSAGE],
-            'job_order.bad_file_ary': [PLACEHOLDER_ERROR_MESSAGE],
-            'job_order.bad_file_dict': [PLACEHOLDER_ERROR_MESSAGE],
-            'job_order.missing_field': [REQUIRED_ERROR_MESSAGE],
+
+    @patch('bespin_api_v2.jobtemplate.get_user_project_files_by_path')
+    def test_build(self, mock_get_user_project_files_by_path):
+        mock_get_user_project_files_by_path.return_value = self.project_files
+        job_order = {
+            'reads': [
+                {'class': 'File', 'path': 'dds://mouse/data/sample1.fastq'},
+                {'class': 'File', 'path': 'dds://mouse/data/sample2.fastq'},
+            ],
+            'threads': 2,
         }
+        builder = DDSStageGroupBuilder(self.user, self.dds_user_credentials, max_workers=4)
+        stage_group, staged_job_order = builder.build(job_order)
 
-        checker = JobOrderValuesCheck(user_job_fields=[{'name': 'missing_field'}])
-        checker.walk(job_order)
+        mock_get_user_project_files_by_path.assert_called_with(self.user, {'mouse'}, 4)
+        self.assertEqual(stage_group.user, self.user)
+        self.assertEqual(stage_group.total_size, 300)
+        dds_files = stage_group.dds_files.order_by('sequence')
+        self.assertEqual([dds_file.file_id for dds_file in dds_files], ['file1', 'file2'])
+        self.assertEqual([dds_file.destination_path for dds_file in dds_files],
+                         ['dds_mouse_data_sample1.fastq', 'dds_mouse_data_sample2.fastq'])
+        self.assertEqual([dds_file.sequence for dds_file in dds_files], [0, 1])
+        self.assertEqual(staged_job_order['reads'][0]['path'], 'dds_mouse_data_sample1.fastq')
+        self.assertEqual(staged_job_order['threads'], 2)
+        # the original job order is left unchanged
+        self.assertEqual(job_order['reads'][0]['path'], 'dds://mouse/data/sample1.fastq')
 
-        self.assertEqual(checker.errors, expected_keys)
+    @patch('bespin_api_v2.jobtemplate.get_user_project_files_by_path')
+    def test_build_duplicate_paths(self, mock_get_user_project_files_by_path):
+        mock_get_user_project_files_by_path.return_value = self.project_files
+        job_order = {
+            'reads': {'class': 'File', 'path': 'dds://mouse/data/sample1.fastq'},
+            'more_reads': {'class': 'File', 'path': 'dds://mouse/data/sample1.fastq'},
+        }
+        stage_group, staged_job_order = DDSStageGroupBuilder(self.user, self.dds_user_credentials).build(job_order)
+        self.assertEqual(stage_group.dds_files.count(), 1)
+
+    @patch('bespin_api_v2.jobtemplate.get_user_project_files_by_path')
+    def test_build_missing_files(self, mock_get_user_project_files_by_path):
+        mock_get_user_project_files_by_path.return_value = self.project_files
+        job_order = {
+            'reads': [
+                {'class': 'File', 'path': 'dds://mouse/data/sample1.fastq'},
+                {'class': 'File', 'path': 'dds://mouse/data/sample3.fastq'},
+            ],
+            'reference': {'class': 'File', 'path': 'dds://rat/b37.fa'},
+        }
+        with self.assertRaises(ValidationError) as raised_exception:
+            DDSStageGroupBuilder(self.user, self.dds_user_credentials).build(job_order)
+        self.assertEqual(set(raised_exception.exception.detail.keys()), {'job_order.reads', 'job_order.reference'})
+        self.assertEqual(JobFileStageGroup.objects.count(), 0)
+
+
+class JobOrderValidatorTestCase(TestCase):
+    def setUp(self):
+        self.user_job_fields = [
+            {'name': 'threads', 'type': 'int'},
+            {'name': 'library', 'type': 'string'},
+            {'name': 'padding', 'type': ['null', 'int']},
+            {'name': 'reference', 'type': 'File'},
+            {'name': 'samples', 'type': {'type': 'array', 'items': 'NamedFASTQFilePairType'}},
+            {'name': 'untyped'},
+        ]
+        self.job_order = {
+            'threads': 4,
+            'library': 'Agilent',
+            'reference': {'class': 'File', 'path': 'dds://project/genome.fa'},
+            'samples': [
+                {
+                    'name': 'sample1',
+                    'file1': {'class': 'File', 'path': 'dds://project/sample1_R1.fastq'},
+                    'file2': {'class': 'File', 'path': 'dds://project/sample1_R2.fastq'},
+                }
+            ],
+            'untyped': 'abc',
+        }
+
+    def test_compile_reuses_validator(self):
+        validator = JobOrderValidator.compile(self.user_job_fields)
+        self.assertIs(JobOrderValidator.compile(list(self.user_job_fields)), validator)
+        self.assertIsNot(JobOrderValidator.compile(self.user_job_fields[1:]), validator)
+
+    def test_validate_valid_job_order(self):
+        validator = JobOrderValidator.compile(self.user_job_fields)
+        self.assertEqual(validator.validate(self.job_order), {})
+        self.job_order['padding'] = 10
+        self.assertEqual(validator.validate(self.job_order), {})
+
+    def test_validate_missing_and_placeholder_values(self):
+        validator = JobOrderValidator.compile(self.user_job_fields)
+        del self.job_order['library']
+        self.job_order['threads'] = INT_VALUE_PLACEHOLDER
+        self.job_order['samples'][0]['file2']['path'] = FILE_PLACEHOLDER
+        self.job_order['extra'] = STRING_VALUE_PLACEHOLDER
+        self.assertEqual(validator.validate(self.job_order), {
+            'job_order.library': [REQUIRED_ERROR_MESSAGE],
+            'job_order.threads': [PLACEHOLDER_ERROR_MESSAGE],
+            'job_order.samples': [PLACEHOLDER_ERROR_MESSAGE],
+            'job_order.extra': [PLACEHOLDER_ERROR_MESSAGE],
+        })
+
+    def test_validate_types(self):
+        validator = JobOrderValidator.compile(self.user_job_fields)
+        self.job_order['threads'] = '4'
+        self.job_order['padding'] = True
+        self.job_order['reference'] = 'genome.fa'
+        self.job_order['samples'] = [{'name': 'sample1'}]
+        self.assertEqual(validator.validate(self.job_order), {
+            'job_order.threads': [TYPE_ERROR_MESSAGE.format('int')],
+            'job_order.padding': [TYPE_ERROR_MESSAGE.format('int')],
+            'job_order.reference': [TYPE_ERROR_MESSAGE.format('File')],
+            'job_order.samples': [TYPE_ERROR_MESSAGE.format('NamedFASTQFilePairType')],
+        })
+
+    def test_validate_large_nested_arrays(self):
+        validator = JobOrderValidator.compile([
+            {'name': 'matrix', 'type': {'type': 'array', 'items': {'type': 'array', 'items': 'int'}}},
+        ])
+        matrix = [list(range(100)) for _ in range(1000)]
+        self.assertEqual(validator.validate({'matrix': matrix}), {})
+        matrix[999][99] = INT_VALUE_PLACEHOLDER
+        self.assertEqual(validator.validate({'matrix': matrix}), {
+            'job_order.matrix': [PLACEHOLDER_ERROR_MESSAGE]
+        })
@@ -24,5 +24,8 @@ urlpatterns = [
     url(r'^', include(router.urls)),
     url(r'job-templates/init', api.JobTemplateInitView.as_view(), name='v2-jobtemplate_init'),
     url(r'job-templates/validate', api.JobTemplateValidateView.as_view(), name='v2-jobtemplate_validate'),
+    url(r'job-templates/create-stage-group', api.JobTemplateCreateStageGroupView.as_view(),
+        name='v2-jobtemplate_createstagegroup'),
+    url(r'job-templates/create-jobs', api.JobTemplateCreateJobsView.as_view(), name='v2-jobtemplate_createjobs'),
     url(r'job-templates/create-job', api.JobTemplateCreateJobView.as_view(), name='v2-jobtemplate_createjob'),
 ]
@@ -30,10 +30,15 @@ admin.site.register(VMFlavor)
 admin.site.register(ShareGroup)
 admin.site.register(DDSUser)
 admin.site.register(WorkflowMethodsDocument)
+admin.site.register(WorkflowVersionStep)
+admin.site.register(WorkflowVersionPackage)
+admin.site.register(DOICitation)
 admin.site.register(EmailTemplate)
 admin.site.register(EmailMessage)
+admin.site.register(JobNotification)
 admin.site.register(VMSettings)
 admin.site.register(CloudSettings)
 admin.site.register(JobActivity)
 admin.site.register(VMStrategy)
 admin.site.register(WorkflowConfiguration)
+admin.site.register(WorkflowImportTask)
@@ -1,6 +1,6 @@
 from rest_framework import viewsets, permissions, status, mixins
 from data.util import get_user_projects, get_user_project, get_user_project_content, get_user_folder_content, \
-    get_readme_file_url
+    get_readme_file_url, make_version_key
 from rest_framework.response import Response
 from rest_framework.exceptions import NotFound
 from data.exceptions import DataServiceUnavailable, WrappedDataServiceException, BespinAPIException, JobTokenException
@@ -14,7 +14,8 @@ from data.lando import LandoJob
 from django.db.models import Q
 from django.db import transaction
 from data.jobfactory import create_job_factory_for_answer_set
-from data.mailer import EmailMessageSender, JobMailer
+from data.jobusage import VMFlavorUsageReport
+from data.mailer import EmailMessageSender, EmailMessageBatchSender, JobMailer
 from data.importers import WorkflowQuestionnaireImporter, ImporterException
 from rest_framework.authtoken.models import Token
 
@@ -89,6 +90,47 @@ class WorkflowMethodsDocumentViewSet(viewsets.ReadOnlyModelViewSet):
     serializer_class = WorkflowMethodsDocumentSerializer
 
 
+class WorkflowVersionStepViewSet(viewsets.ReadOnlyModelViewSet):
+    permission_classes = (permissions.IsAuthenticated,)
+    queryset = WorkflowVersionStep.objects.prefetch_related('packages')
+    serializer_class = WorkflowVersionStepSerializer
+    filter_backends = (DjangoFilterBackend,)
+    filter_fields = ('workflow_version', 'tool_class', 'docker_image',)
+
+
+class WorkflowVersionPackageViewSet(viewsets.ReadOnlyModelViewSet):
+    """
+    Software packages used by the steps of workflow versions.
+    Besides the filter fields packages can be filtered with the version_lt, version_lte, version_gt and version_gte
+    query parameters, e.g. ?package=samtools&version_lt=1.9 lists the workflow versions using samtools before 1.9.
+    """
+    permission_classes = (permissions.IsAuthenticated,)
+    queryset = WorkflowVersionPackage.objects.all()
+    serializer_class = WorkflowVersionPackageSerializer
+    filter_backends = (DjangoFilterBackend,)
+    filter_fields = ('workflow_version', 'package', 'version', 'step__docker_image',)
+    version_comparisons = {
+        'version_lt': lambda key, value: key < value,
+        'version_lte': lambda key, value: key <= value,
+        'version_gt': lambda key, value: key > value,
+        'version_gte': lambda key, value: key >= value,
+    }
+
+    def filter_queryset(self, queryset):
+        queryset = super(WorkflowVersionPackageViewSet, self).filter_queryset(queryset)
+        comparisons = [(compare, make_version_key(self.request.query_params[param]))
+                       for param, compare in self.version_comparisons.items()
+                       if param in self.request.query_params]
+        if comparisons:
+            # packages without a version can't be placed in a range
+            queryset = queryset.exclude(version='')
+            # versions are free form strings so they are compared here instead of in the database
+            package_ids = [package_id for package_id, version in queryset.values_list('id', 'version')
+                           if all(compare(make_version_key(version), value) for compare, value in comparisons)]
+            queryset = queryset.filter(id__in=package_ids)
+        return queryset
+
+
 class JobsViewSet(mixins.RetrieveModelMixin,
                   mixins.ListModelMixin,
                   mixins.DestroyModelMixin,
@@ -218,6 +260,18 @@ class JobFileStageGroupViewSet(viewsets.ModelViewSet):
     def get_queryset(self):
         return JobFileStageGroup.objects.filter(user=self.request.user)
 
+    @detail_route(methods=['post'], serializer_class=JobFileStageGroupFilesSerializer, url_path='add-files')
+    def add_files(self, request, pk=None):
+        """
+        Add a list of dds and/or url files to a stage group in a single request
+        """
+        stage_group = self.get_object()
+        serializer = JobFileStageGroupFilesSerializer(data=request.data,
+                                                      context={'request': request, 'stage_group': stage_group})
+        serializer.is_valid(raise_exception=True)
+        stage_group = serializer.save()
+        return Response(JobFileStageGroupSerializer(stage_group).data, status=status.HTTP_201_CREATED)
+
 
 class AdminJobFileStageGroupViewSet(viewsets.ReadOnlyModelViewSet):
     permission_classes = (permissions.IsAdminUser,)
@@ -334,14 +388,7 @@ class JobQuestionnaireViewSet(viewsets.ReadOnlyModelViewSet):
     def get_queryset(self):
         tag = self.request.query_params.get('tag', None)
         if tag:
-            parts = JobQuestionnaire.split_tag_parts(tag)
-            if parts:
-                workflow_tag, version_num, questionnaire_type_tag = parts
-                return JobQuestionnaire.objects.filter(workflow_version__workflow__tag=workflow_tag,
-                                                       workflow_version__version=version_num,
-                                                       type__tag=questionnaire_type_tag)
-            else:
-                return JobQuestionnaire.objects.none()
+            return JobQuestionnaire.objects.filter(tag=tag)
         else:
             return JobQuestionnaire.objects.all()
 
@@ -400,6 +447,15 @@ class AdminEmailMessageViewSet(viewsets.ModelViewSet):
         serializer = self.get_serializer(message)
         return Response(serializer.data, status=status.HTTP_201_CREATED)
 
+    @list_route(methods=['post'], serializer_class=AdminEmailBatchResultSerializer, url_path='send-pending')
+    def send_pending(self, request):
+        """
+        Send all NEW email messages in batches
+        """
+        sent_count, error_count = EmailMessageBatchSender().send_pending()
+        serializer = AdminEmailBatchResultSerializer({'sent': sent_count, 'errors': error_count})
+        return Response(serializer.data, status=status.HTTP_200_OK)
+
 
 class AdminEmailTemplateViewSet(viewsets.ModelViewSet):
     permission_classes = (permissions.IsAdminUser,)
@@ -407,6 +463,27 @@ class AdminEmailTemplateViewSet(viewsets.ModelViewSet):
     queryset = EmailTemplate.objects.all()
 
 
+class AdminVMFlavorRecommendationViewSet(viewsets.ViewSet):
+    """
+    Recommends the VM flavor for each workflow version that uses the fewest CPU hours while the
+    percentile runtime of finished jobs meets target_hours.
+    """
+    permission_classes = (permissions.IsAdminUser,)
+
+    def list(self, request):
+        query_serializer = VMFlavorRecommendationQuerySerializer(data=request.query_params)
+        query_serializer.is_valid(raise_exception=True)
+        params = query_serializer.validated_data
+        workflow_version_ids = None
+        if params.get('workflow_version'):
+            workflow_version_ids = [params['workflow_version']]
+        report = VMFlavorUsageReport(percentile=params['percentile'], min_jobs=params['min_jobs'],
+                                     workflow_version_ids=workflow_version_ids)
+        recommendations = report.get_recommendations(params['target_hours'])
+        serializer = VMFlavorRecommendationSerializer(recommendations, many=True)
+        return Response(serializer.data)
+
+
 class JobActivityViewSet(viewsets.ModelViewSet):
     permission_classes = (permissions.IsAuthenticated,)
     serializer_class = JobActivitySerializer
@@ -417,6 +494,29 @@ class JobActivityViewSet(viewsets.ModelViewSet):
         return JobActivity.objects.filter(job__user=self.request.user).order_by('job', 'created')
 
 
+class AdminWorkflowImportTaskViewSet(mixins.CreateModelMixin,
+                                     mixins.RetrieveModelMixin,
+                                     mixins.ListModelMixin,
+                                     viewsets.GenericViewSet):
+    """
+    Queues workflow imports to be run by the runimporttasks command.
+    POST takes the same fields as admin/import-workflow-questionnaire and responds with 202 and the task.
+    GET reports the state, current stage, stage timings and errors of tasks.
+    """
+    permission_classes = (permissions.IsAdminUser,)
+    serializer_class = AdminWorkflowImportTaskSerializer
+    queryset = WorkflowImportTask.objects.all()
+    filter_backends = (DjangoFilterBackend,)
+    filter_fields = ('state',)
+
+    def create(self, request, *args, **kwargs):
+        spec_serializer = AdminImportWorkflowQuestionnaireSerializer(data=request.data)
+        spec_serializer.is_valid(raise_exception=True)
+        task = WorkflowImportTask.objects.create(spec=spec_serializer.validated_data, user=request.user)
+        serializer = self.get_serializer(task)
+        return Response(serializer.data, status=status.HTTP_202_ACCEPTED)
+
+
 class AdminImportWorkflowQuestionnaireViewSet(mixins.CreateModelMixin,
                                               viewsets.GenericViewSet):
     permission_classes = (permissions.IsAdminUser,)
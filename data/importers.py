@@ -1,21 +1,93 @@
 from data.models import Workflow, WorkflowVersion, JobQuestionnaire, VMFlavor, VMProject, \
-    VMSettings, ShareGroup, WorkflowMethodsDocument, JobQuestionnaireType
-from cwltool.context import LoadingContext
-from cwltool.workflow import default_make_tool
-from cwltool.resolver import tool_resolver
-from cwltool.load_tool import load_tool
+    VMSettings, ShareGroup, WorkflowMethodsDocument, JobQuestionnaireType, DOICitation, WorkflowImportTask, \
+    WorkflowVersionStep, WorkflowVersionPackage
 import sys
+import os
+import tempfile
+import hashlib
 import requests
 import json
-from habanero import cn
-from jinja2 import Template
+import time
+import importlib
+import datetime
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from django.conf import settings
+from django.db import transaction, connections
 from django.template.defaultfilters import slugify
+from django.utils import timezone
 SCHEMA_ORG_CITATION = 'https://schema.org/citation'
 HTTPS_DOI_URL = 'https://dx.doi.org/'
+SOFTWARE_REQUIREMENT_HINT = 'SoftwareRequirement'
+DOCKER_REQUIREMENT = 'DockerRequirement'
+# Keys from the root of CWL documents and classes of tool hints stored in CWLDocument summaries
+SUMMARY_KEYS = ['label', 'doc']
+SUMMARY_HINT_CLASS_NAMES = [SOFTWARE_REQUIREMENT_HINT]
+# Changed whenever the contents of CWLDocument summaries change so summaries cached in an older format are not used
+SUMMARY_FORMAT_VERSION = '2'
+CLAIM_IMPORT_TASK_SQL = "SELECT * FROM {} WHERE state = %s ORDER BY id LIMIT 1 FOR UPDATE SKIP LOCKED"
+IMPORT_TASK_TIMEOUT_ERROR = 'Import task did not finish within {} seconds, the runner running it may have stopped'
+FILE_URL_PREFIX = 'file://'
+# Artifacts can be looked up in an ArtifactMirror by the hash of their content with urls like sha256:<hexdigest>
+SHA256_URL_PREFIX = 'sha256:'
 import logging
 logger = logging.getLogger(__name__)
 
 
+class LazyModule(object):
+    """
+    Imports a module the first time one of its attributes is used.
+    """
+    def __init__(self, name):
+        """
+        :param name: str: full name of the module to import
+        """
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+
+# cwltool, habanero and jinja2 are slow to import and only used when importing workflows, so they are loaded on
+# first use instead of in every process that imports data.api
+cwltool_context = LazyModule('cwltool.context')
+cwltool_workflow = LazyModule('cwltool.workflow')
+cwltool_resolver = LazyModule('cwltool.resolver')
+cwltool_load_tool = LazyModule('cwltool.load_tool')
+schema_salad_fetcher = LazyModule('schema_salad.fetcher')
+cn = LazyModule('habanero.cn')
+jinja2 = LazyModule('jinja2')
+
+
+def load_tool(argsworkflow, loading_context):
+    """
+    Load and validate a CWL document with cwltool
+    :param argsworkflow: str: url of the CWL document and the object to load
+    :param loading_context: cwltool.context.LoadingContext: cwltool loading options
+    :return: cwltool.process.Process: the loaded tool or workflow
+    """
+    return cwltool_load_tool.load_tool(argsworkflow, loading_context)
+
+
+def make_prefetched_fetcher_constructor(url, content):
+    """
+    Create a schema-salad fetcher constructor that returns content for url instead of downloading it again.
+    Other urls (documents referenced with run or $import) are fetched as usual.
+    :param url: str: url cwltool will load
+    :param content: bytes: content already downloaded from url
+    :return: function: fetcher_constructor for a cwltool LoadingContext
+    """
+    text = content.decode('utf-8')
+
+    def fetcher_constructor(cache, session):
+        cache[url] = text
+        return schema_salad_fetcher.DefaultFetcher(cache, session)
+    return fetcher_constructor
+
+
 class BaseCreator(object):
     """
     Base for command with simple logging facility
@@ -40,18 +112,397 @@ class BaseCreator(object):
         self.stdout.write(message)
 
 
+def write_file_atomically(path, content):
+    """
+    Write content to path through a temporary file so readers never see a partially written file.
+    The parent directory is created when needed.
+    :param path: str: path of the file to write
+    :param content: bytes: content to write
+    """
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as outfile:
+            outfile.write(content)
+        os.replace(temp_path, path)
+    except Exception:
+        os.remove(temp_path)
+        raise
+
+
+def hash_content(content):
+    """
+    :param content: bytes: content to hash
+    :return: str: sha256 hexdigest of content
+    """
+    return hashlib.sha256(content).hexdigest()
+
+
+class ArtifactNotFoundException(Exception):
+    pass
+
+
+class ArtifactMirror(object):
+    """
+    Local directory holding copies of the artifacts imports download: CWL documents, methods templates and
+    APA citations for DOIs. Content is stored once by its sha256 hash and urls are mapped to the hash of their content.
+    """
+    def __init__(self, mirror_dir):
+        """
+        :param mirror_dir: str: directory holding the mirror, created when needed
+        """
+        self.mirror_dir = mirror_dir
+
+    @staticmethod
+    def _hash(value):
+        return hashlib.sha256(value.encode('utf-8')).hexdigest()
+
+    def get_content_path(self, content_hash):
+        """
+        :param content_hash: str: sha256 hexdigest of some content
+        :return: str: path the content is stored at
+        """
+        return os.path.join(self.mirror_dir, 'sha256', content_hash)
+
+    def _get_url_path(self, url):
+        return os.path.join(self.mirror_dir, 'urls', '{}.json'.format(self._hash(url)))
+
+    def _get_doi_path(self, doi_name):
+        return os.path.join(self.mirror_dir, 'dois', '{}.json'.format(self._hash(doi_name)))
+
+    @staticmethod
+    def _read_json(path):
+        try:
+            with open(path) as infile:
+                return json.load(infile)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def get_content_hash(self, url):
+        """
+        :param url: str: url of an artifact or SHA256_URL_PREFIX followed by the hash of its content
+        :return: str: sha256 hexdigest of the content stored for url or None if it is not in the mirror
+        """
+        if url.startswith(SHA256_URL_PREFIX):
+            content_hash = url[len(SHA256_URL_PREFIX):]
+        else:
+            entry = self._read_json(self._get_url_path(url))
+            if entry is None:
+                return None
+            content_hash = entry['sha256']
+        if not os.path.exists(self.get_content_path(content_hash)):
+            return None
+        return content_hash
+
+    def contains(self, url):
+        return self.get_content_hash(url) is not None
+
+    def get(self, url):
+        """
+        :param url: str: url of an artifact or SHA256_URL_PREFIX followed by the hash of its content
+        :return: bytes: content stored for url
+        """
+        content_hash = self.get_content_hash(url)
+        if content_hash is None:
+            raise ArtifactNotFoundException('{} is not in the artifact mirror {}'.format(url, self.mirror_dir))
+        with open(self.get_content_path(content_hash), 'rb') as infile:
+            return infile.read()
+
+    def put(self, url, content):
+        """
+        Store content as the artifact for url
+        :param url: str: url the content was downloaded from
+        :param content: bytes: content of the artifact
+        :return: str: sha256 hexdigest of content
+        """
+        content_hash = hash_content(content)
+        content_path = self.get_content_path(content_hash)
+        if not os.path.exists(content_path):
+            write_file_atomically(content_path, content)
+        entry = {'url': url, 'sha256': content_hash}
+        write_file_atomically(self._get_url_path(url), json.dumps(entry).encode('utf-8'))
+        return content_hash
+
+    def get_apa_citation(self, doi_name):
+        """
+        :param doi_name: str: DOI without HTTPS_DOI_URL
+        :return: str: APA citation stored for doi_name or None if it is not in the mirror
+        """
+        entry = self._read_json(self._get_doi_path(doi_name))
+        if entry is None:
+            return None
+        return entry['apa_citation']
+
+    def put_apa_citation(self, doi_name, apa_citation):
+        entry = {'doi': doi_name, 'apa_citation': apa_citation}
+        write_file_atomically(self._get_doi_path(doi_name), json.dumps(entry).encode('utf-8'))
+
+
+class NetworkArtifactResolver(object):
+    """
+    Fetches import artifacts from their urls and DOIs from the DOI content negotiation service.
+    file:// urls are read from the local filesystem.
+    """
+    def fetch(self, url):
+        """
+        :param url: str: url of the artifact
+        :return: bytes: content of the artifact
+        """
+        if url.startswith(FILE_URL_PREFIX):
+            with open(url[len(FILE_URL_PREFIX):], 'rb') as infile:
+                return infile.read()
+        response = requests.get(url)
+        response.raise_for_status()
+        return response.content
+
+    def fetch_text(self, url):
+        """
+        :param url: str: url of the artifact
+        :return: str: content of the artifact decoded as text
+        """
+        if url.startswith(FILE_URL_PREFIX):
+            return self.fetch(url).decode('utf-8')
+        response = requests.get(url)
+        response.raise_for_status()
+        return response.text
+
+    def fetch_text_if_modified(self, url, etag=None, last_modified=None):
+        """
+        Fetch an artifact as text unless it is unchanged since it was fetched with etag and last_modified
+        :param url: str: url of the artifact
+        :param etag: str: ETag header from the response that was previously fetched
+        :param last_modified: str: Last-Modified header from the response that was previously fetched
+        :return: (str, str, str): text, ETag and Last-Modified of the artifact, None when it is unchanged
+        """
+        if url.startswith(FILE_URL_PREFIX):
+            return self.fetch_text(url), None, None
+        headers = {}
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+        response = requests.get(url, headers=headers)
+        if response.status_code == requests.codes.not_modified:
+            return None
+        response.raise_for_status()
+        return response.text, response.headers.get('ETag'), response.headers.get('Last-Modified')
+
+    def fetch_apa_citation(self, doi_name):
+        """
+        :param doi_name: str: DOI without HTTPS_DOI_URL
+        :return: str: APA style citation for the DOI
+        """
+        return cn.content_negotiation(ids=doi_name, format="text", style="apa")
+
+    def get_local_url(self, url):
+        """
+        :param url: str: url of a CWL document
+        :return: str: url cwltool should load the CWL document from
+        """
+        return url
+
+
+class MirrorArtifactResolver(object):
+    """
+    Reads import artifacts from an ArtifactMirror so imports can run without network access.
+    Artifacts missing from the mirror are fetched with fallback_resolver, or raise ArtifactNotFoundException
+    when there is no fallback_resolver. file:// urls are always read from the local filesystem.
+    """
+    def __init__(self, mirror, fallback_resolver=None):
+        """
+        :param mirror: ArtifactMirror: mirror to read artifacts from
+        :param fallback_resolver: NetworkArtifactResolver: resolver for artifacts missing from the mirror
+        """
+        self.mirror = mirror
+        self.fallback_resolver = fallback_resolver
+
+    def _get_fallback_resolver(self, description):
+        if self.fallback_resolver is None:
+            raise ArtifactNotFoundException('{} is not in the artifact mirror {}'.format(
+                description, self.mirror.mirror_dir))
+        return self.fallback_resolver
+
+    def fetch(self, url):
+        if url.startswith(FILE_URL_PREFIX):
+            return NetworkArtifactResolver().fetch(url)
+        if not self.mirror.contains(url):
+            return self._get_fallback_resolver(url).fetch(url)
+        return self.mirror.get(url)
+
+    def fetch_text(self, url):
+        return self.fetch(url).decode('utf-8')
+
+    def fetch_text_if_modified(self, url, etag=None, last_modified=None):
+        """
+        Mirrored artifacts use the hash of their content as their ETag
+        """
+        if url.startswith(FILE_URL_PREFIX):
+            return NetworkArtifactResolver().fetch_text_if_modified(url, etag, last_modified)
+        content_hash = self.mirror.get_content_hash(url)
+        if content_hash is None:
+            return self._get_fallback_resolver(url).fetch_text_if_modified(url, etag, last_modified)
+        if content_hash == etag:
+            return None
+        return self.mirror.get(url).decode('utf-8'), content_hash, None
+
+    def fetch_apa_citation(self, doi_name):
+        apa_citation = self.mirror.get_apa_citation(doi_name)
+        if apa_citation is None:
+            return self._get_fallback_resolver('DOI ' + doi_name).fetch_apa_citation(doi_name)
+        return apa_citation
+
+    def get_local_url(self, url):
+        """
+        Mirrored CWL documents are loaded from their file in the mirror. Only packed CWL documents can be loaded
+        this way since relative references within the document are not mirrored.
+        """
+        if url.startswith(FILE_URL_PREFIX):
+            return url
+        content_hash = self.mirror.get_content_hash(url)
+        if content_hash is None:
+            return self._get_fallback_resolver(url).get_local_url(url)
+        return FILE_URL_PREFIX + os.path.abspath(self.mirror.get_content_path(content_hash))
+
+
+def get_artifact_resolver():
+    """
+    Create the resolver imports use to fetch artifacts based on settings.BESPIN_ARTIFACT_MIRROR_DIR
+    and settings.BESPIN_ARTIFACT_OFFLINE.
+    :return: NetworkArtifactResolver or MirrorArtifactResolver
+    """
+    mirror_dir = settings.BESPIN_ARTIFACT_MIRROR_DIR
+    if mirror_dir:
+        fallback_resolver = None
+        if not settings.BESPIN_ARTIFACT_OFFLINE:
+            fallback_resolver = NetworkArtifactResolver()
+        return MirrorArtifactResolver(ArtifactMirror(mirror_dir), fallback_resolver)
+    if settings.BESPIN_ARTIFACT_OFFLINE:
+        raise ArtifactNotFoundException('BESPIN_ARTIFACT_MIRROR_DIR must be set to import artifacts offline')
+    return NetworkArtifactResolver()
+
+
+class CWLDocumentCache(object):
+    """
+    Stores CWLDocument summaries on disk keyed by the document url and a hash of its content.
+    """
+    def __init__(self, cache_dir):
+        """
+        :param cache_dir: str: directory to store summaries in, created when needed
+        """
+        self.cache_dir = cache_dir
+
+    @staticmethod
+    def make_key(url, content):
+        """
+        :param url: str: url the CWL document was downloaded from
+        :param content: bytes: content of the CWL document
+        :return: str: key that changes whenever the url or content changes
+        """
+        sha = hashlib.sha256(SUMMARY_FORMAT_VERSION.encode('utf-8'))
+        sha.update(b'\0')
+        sha.update(url.encode('utf-8'))
+        sha.update(b'\0')
+        sha.update(content)
+        return sha.hexdigest()
+
+    def _get_path(self, key):
+        return os.path.join(self.cache_dir, '{}.json'.format(key))
+
+    def get(self, key):
+        """
+        :param key: str: key from make_key
+        :return: dict: summary or None when not in the cache or unreadable
+        """
+        try:
+            with open(self._get_path(key)) as infile:
+                return json.load(infile)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def put(self, key, summary):
+        """
+        Store summary under key, writing to a temporary file first so readers never see a partial summary.
+        :param key: str: key from make_key
+        :param summary: dict: JSON serializable summary
+        """
+        write_file_atomically(self._get_path(key), json.dumps(summary).encode('utf-8'))
+
+
 class CWLDocument(object):
     """
     Simple CWL document parser
+    The parts of the document used by the importers are summarized and stored in a CWLDocumentCache
+    when settings.BESPIN_CWL_CACHE_DIR is set so re-importing an unchanged document skips cwltool.
+    The cache key is made from the top level document only so the cache is only safe for packed documents.
     """
 
-    def __init__(self, url):
+    def __init__(self, url, summary=None, artifact_resolver=None, content_hash=None):
         """
         Creates a parser for the given URL
         :param url: The URL to a CWL document to be parsed
+        :param summary: dict: summary already created for this document (e.g. in another process)
+        :param artifact_resolver: resolver used to fetch the document, defaults to get_artifact_resolver()
+        :param content_hash: str: hash of the document content already computed along with summary
         """
         self.url = url
         self._parsed = None
+        self._summary = summary
+        self._artifact_resolver = artifact_resolver
+        self._content = None
+        self._content_hash = content_hash
+
+    @property
+    def artifact_resolver(self):
+        if self._artifact_resolver is None:
+            self._artifact_resolver = get_artifact_resolver()
+        return self._artifact_resolver
+
+    @property
+    def summary(self):
+        """
+        Lazy property with the input fields, summary keys and summary hints of the CWL document
+        :return: dict: summary of the parsed CWL document
+        """
+        if self._summary is None:
+            cache_dir = settings.BESPIN_CWL_CACHE_DIR
+            if cache_dir:
+                cache = CWLDocumentCache(cache_dir)
+                key = cache.make_key(self.url, self._download())
+                summary = cache.get(key)
+                if summary is None:
+                    summary = self._summarize()
+                    cache.put(key, summary)
+                self._summary = summary
+            else:
+                self._summary = self._summarize()
+        return self._summary
+
+    def _download(self):
+        if self._content is None:
+            self._content = self.artifact_resolver.fetch(self.url)
+        return self._content
+
+    @property
+    def content_hash(self):
+        """
+        :return: str: sha256 hexdigest of the CWL document content
+        """
+        if self._content_hash is None:
+            self._content_hash = hash_content(self._download())
+        return self._content_hash
+
+    def _summarize(self):
+        summary = {
+            'input_fields': self.parsed.inputs_record_schema.get('fields'),
+            'hints': dict((hint_class_name, self._extract_parsed_tool_hints(hint_class_name))
+                          for hint_class_name in SUMMARY_HINT_CLASS_NAMES),
+            'steps': self._extract_parsed_steps(),
+        }
+        for key in SUMMARY_KEYS:
+            summary[key] = self.parsed.tool.get(key)
+        # convert the parsed cwltool values to plain python types as they would be read from the cache
+        return json.loads(json.dumps(summary))
 
     @property
     def parsed(self):
@@ -60,10 +511,14 @@ class CWLDocument(object):
         :return: The CWL document, parsed into a dict
         """
         if self._parsed is None:
-            context = LoadingContext({"construct_tool_object": default_make_tool,
-                                      "resolver": tool_resolver,
-                                      "disable_js_validation": True})
-            self._parsed = load_tool(self.url + '#main', context)
+            local_url = self.artifact_resolver.get_local_url(self.url)
+            context_options = {"construct_tool_object": cwltool_workflow.default_make_tool,
+                               "resolver": cwltool_resolver.tool_resolver,
+                               "disable_js_validation": True}
+            if self._content is not None:
+                # parse the content that was already downloaded and hashed instead of letting cwltool fetch it again
+                context_options["fetcher_constructor"] = make_prefetched_fetcher_constructor(local_url, self._content)
+            self._parsed = load_tool(local_url + '#main', cwltool_context.LoadingContext(context_options))
         return self._parsed
 
     @property
@@ -72,7 +527,7 @@ class CWLDocument(object):
         The input fields from the CWL document
         :return: List of input fields from the CWL document
         """
-        return self.parsed.inputs_record_schema.get('fields')
+        return self.summary['input_fields']
 
     def get(self, key):
         """
@@ -80,6 +535,8 @@ class CWLDocument(object):
         :param key: The key to get
         :return: value associated with the key in the parsed CWL
         """
+        if key in SUMMARY_KEYS:
+            return self.summary[key]
         return self.parsed.tool.get(key)
 
     def extract_tool_hints(self, hint_class_name):
@@ -88,6 +545,56 @@ class CWLDocument(object):
         :param hint_class_name: str: name of the class to include
         :return: [dict]: list of hints
         """
+        if hint_class_name in SUMMARY_HINT_CLASS_NAMES:
+            return self.summary['hints'][hint_class_name]
+        return self._extract_parsed_tool_hints(hint_class_name)
+
+    def extract_steps(self):
+        """
+        Retrieve the steps of the workflow, including the steps of nested workflows, with the tool each step runs.
+        A document containing a single tool is returned as one step.
+        :return: [dict]: step_id, tool_id, tool_class, docker_image and packages (from SoftwareRequirements)
+        of each step
+        """
+        return self.summary['steps']
+
+    def _extract_parsed_steps(self):
+        steps = []
+        if hasattr(self.parsed, 'steps'):
+            self._extract_steps_recursive(steps, self.parsed)
+        else:
+            steps.append(self._make_step(self.parsed.tool.get('id', ''), self.parsed))
+        return steps
+
+    def _extract_steps_recursive(self, steps, workflow_node):
+        for step in workflow_node.steps:
+            steps.append(self._make_step(step.id, step.embedded_tool))
+            if hasattr(step.embedded_tool, 'steps'):
+                self._extract_steps_recursive(steps, step.embedded_tool)
+
+    @staticmethod
+    def _make_step(step_id, tool_node):
+        docker_image = ''
+        packages = []
+        for requirement in list(tool_node.requirements or []) + list(tool_node.hints or []):
+            if requirement['class'] == DOCKER_REQUIREMENT:
+                docker_image = docker_image or requirement.get('dockerPull', '')
+            elif requirement['class'] == SOFTWARE_REQUIREMENT_HINT:
+                for package in requirement['packages']:
+                    packages.append({
+                        'package': package['package'],
+                        'version': package.get('version', []),
+                        'citation': package.get(SCHEMA_ORG_CITATION, ''),
+                    })
+        return {
+            'step_id': step_id,
+            'tool_id': tool_node.tool.get('id', ''),
+            'tool_class': tool_node.tool.get('class', ''),
+            'docker_image': docker_image,
+            'packages': packages,
+        }
+
+    def _extract_parsed_tool_hints(self, hint_class_name):
         hints = []
         self._extract_tool_hints_recursive(hints, self.parsed, hint_class_name)
         return hints
@@ -103,32 +610,164 @@ class CWLDocument(object):
                         hints.append(hint)
 
 
+class DOICitationResolver(object):
+    """
+    Resolves DOI citations to APA style citations, fetching DOIs not already stored in DOICitation concurrently.
+    """
+    def __init__(self, max_workers=None, artifact_resolver=None):
+        """
+        :param max_workers: int: maximum number of DOIs to fetch at the same time
+        :param artifact_resolver: resolver used to fetch DOIs, defaults to get_artifact_resolver()
+        """
+        if max_workers is None:
+            max_workers = settings.BESPIN_DOI_LOOKUP_WORKERS
+        self.max_workers = max_workers
+        self.artifact_resolver = artifact_resolver
+
+    def resolve(self, citations):
+        """
+        :param citations: [str]: citations, those starting with HTTPS_DOI_URL are resolved
+        :return: dict: APA citation for each citation, citations that could not be resolved map to themselves
+        """
+        doi_names = set(citation.replace(HTTPS_DOI_URL, '') for citation in citations
+                        if citation.startswith(HTTPS_DOI_URL))
+        apa_citations = dict(DOICitation.objects.filter(doi__in=doi_names).values_list('doi', 'apa_citation'))
+        missing_doi_names = sorted(doi_names - set(apa_citations.keys()))
+        if missing_doi_names:
+            if self.artifact_resolver is None:
+                self.artifact_resolver = get_artifact_resolver()
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                fetched = zip(missing_doi_names, executor.map(self._fetch_apa_citation, missing_doi_names))
+                for doi_name, apa_citation in fetched:
+                    if apa_citation:
+                        DOICitation.objects.get_or_create(doi=doi_name, defaults={'apa_citation': apa_citation})
+                        apa_citations[doi_name] = apa_citation
+        result = {}
+        for citation in citations:
+            result[citation] = apa_citations.get(citation.replace(HTTPS_DOI_URL, ''), citation)
+        return result
+
+    def _fetch_apa_citation(self, doi_name):
+        try:
+            return self.artifact_resolver.fetch_apa_citation(doi_name)
+        except Exception:
+            logger.warning('Unable to resolve DOI %s, using the raw citation', doi_name, exc_info=True)
+            return None
+
+
+class MethodsTemplateCache(object):
+    """
+    Caches methods document template text by url along with the compiled jinja2 Templates.
+    Cached text is revalidated with the ETag and Last-Modified of the response it was fetched in, so unchanged
+    templates are not downloaded again. Compiled templates are keyed by a hash of the template text.
+    """
+    def __init__(self):
+        self.template_texts = {}
+        self.compiled_templates = {}
+
+    def get_template_text(self, url, artifact_resolver):
+        """
+        :param url: str: url of the jinja2 template
+        :param artifact_resolver: resolver used to fetch the template
+        :return: str: current text of the template
+        """
+        cached = self.template_texts.get(url)
+        etag, last_modified = (cached[1], cached[2]) if cached else (None, None)
+        fetched = artifact_resolver.fetch_text_if_modified(url, etag, last_modified)
+        if fetched is None:
+            return cached[0]
+        self.template_texts[url] = fetched
+        return fetched[0]
+
+    def get_compiled_template(self, template_text):
+        """
+        :param template_text: str: jinja2 template text
+        :return: jinja2.Template: template compiled from template_text
+        """
+        key = hash_content(template_text.encode('utf-8'))
+        compiled_template = self.compiled_templates.get(key)
+        if compiled_template is None:
+            compiled_template = jinja2.Template(template_text)
+            self.compiled_templates[key] = compiled_template
+        return compiled_template
+
+    def clear(self):
+        self.template_texts = {}
+        self.compiled_templates = {}
+
+
+methods_template_cache = MethodsTemplateCache()
+
+
 class MethodsDocumentContents(object):
-    def __init__(self, workflow_version_description, software_requirement_hints, jinja_template_url):
+    def __init__(self, workflow_version_description, software_requirement_hints, jinja_template_url,
+                 artifact_resolver=None):
         self.workflow_version_description = workflow_version_description
         self.software_requirement_hints = software_requirement_hints
         self.jinja_template_url = jinja_template_url
+        self.artifact_resolver = artifact_resolver
 
     def get_content(self):
+        apa_citations = DOICitationResolver(artifact_resolver=self.artifact_resolver).resolve(self.get_citations())
+        return self.render(self.fetch_template_text(), apa_citations)
+
+    def _get_packages(self):
+        return [package for hint in self.software_requirement_hints for package in hint['packages']]
+
+    def get_citations(self):
+        """
+        :return: [str]: citation of each package in the software requirement hints
+        """
+        return [package[SCHEMA_ORG_CITATION] for package in self._get_packages()]
+
+    def fetch_template_text(self):
+        """
+        :return: str: jinja2 template text from jinja_template_url, reused from methods_template_cache when unchanged
+        """
+        if self.artifact_resolver is None:
+            self.artifact_resolver = get_artifact_resolver()
+        return methods_template_cache.get_template_text(self.jinja_template_url, self.artifact_resolver)
+
+    def render(self, template_text, apa_citations):
+        """
+        Render the methods document
+        :param template_text: str: jinja2 template text
+        :param apa_citations: dict: APA citation for each citation from get_citations
+        :return: str: methods document contents in markdown
+        """
         template_args = {}
-        for hint in self.software_requirement_hints:
-            for package in hint['packages']:
-                package_name = package['package']
-                versions = package['version']
-                citation = package[SCHEMA_ORG_CITATION]
-                if citation.startswith(HTTPS_DOI_URL):
-                    doi_name = citation.replace(HTTPS_DOI_URL, '')
-                    apa_citation = cn.content_negotiation(ids=doi_name, format="text", style="apa")
-                else:
-                    apa_citation = citation
-                template_args[package_name] = {'version': versions[-1], 'citation': apa_citation}
+        for package in self._get_packages():
+            package_name = package['package']
+            versions = package['version']
+            apa_citation = apa_citations[package[SCHEMA_ORG_CITATION]]
+            template_args[package_name] = {'version': versions[-1], 'citation': apa_citation}
         template_args['description'] = self.workflow_version_description
-        response = requests.get(self.jinja_template_url)
-        response.raise_for_status()
-        template = Template(response.text)
+        template = methods_template_cache.get_compiled_template(template_text)
         return template.render(**template_args)
 
 
+def save_workflow_version_steps(workflow_version, steps):
+    """
+    Replace the WorkflowVersionStep and WorkflowVersionPackage index of workflow_version
+    :param workflow_version: WorkflowVersion: version to index
+    :param steps: [dict]: steps from CWLDocument.extract_steps
+    """
+    workflow_version.steps.all().delete()
+    step_models = WorkflowVersionStep.objects.bulk_create([
+        WorkflowVersionStep(workflow_version=workflow_version, step_id=step['step_id'], tool_id=step['tool_id'],
+                            tool_class=step['tool_class'], docker_image=step['docker_image'])
+        for step in steps
+    ])
+    package_models = []
+    for step_model, step in zip(step_models, steps):
+        for package in step['packages']:
+            for version in package['version'] or ['']:
+                package_models.append(WorkflowVersionPackage(workflow_version=workflow_version, step=step_model,
+                                                             package=package['package'], version=version,
+                                                             citation=package['citation']))
+    WorkflowVersionPackage.objects.bulk_create(package_models)
+
+
 class JobQuestionnaireImporter(BaseCreator):
     """
     Creates a JobQuestionnaire model for a WorkflowVersion with the supplied system job order
@@ -147,7 +786,12 @@ class JobQuestionnaireImporter(BaseCreator):
                  volume_size_factor,
                  cwl_document,
                  stdout=sys.stdout,
-                 stderr=sys.stderr):
+                 stderr=sys.stderr,
+                 reuse_existing=False):
+        """
+        :param reuse_existing: bool: use an existing JobQuestionnaire matching all values except the user fields
+        without reading the CWL document, set when the workflow version was skipped as unchanged
+        """
         super(JobQuestionnaireImporter, self).__init__(stdout, stderr)
         self.name = name
         self.description = description
@@ -163,8 +807,33 @@ class JobQuestionnaireImporter(BaseCreator):
         self.vm_flavor = None
         self.job_questionnaire = None
         self.cwl_document = cwl_document
+        self.reuse_existing = reuse_existing
+        self.skipped = False
+
+    def _find_existing_job_questionnaire(self):
+        return JobQuestionnaire.objects.filter(
+            name=self.name,
+            description=self.description,
+            workflow_version=self.workflow_version,
+            system_job_order_json=json.dumps(self.system_job_order_dict),
+            vm_settings__name=self.vm_settings_name,
+            vm_flavor__name=self.vm_flavor_name,
+            share_group__name=self.share_group_name,
+            volume_size_base=self.volume_size_base,
+            volume_size_factor=self.volume_size_factor,
+            type__tag=self.type_tag
+        ).first()
 
     def _create_models(self):
+        if self.reuse_existing:
+            job_questionnaire = self._find_existing_job_questionnaire()
+            if job_questionnaire:
+                self.job_questionnaire = job_questionnaire
+                self.created_job_questionnaire = False
+                self.skipped = True
+                self.log("JobQuestionnaire '{}' unchanged with id {}, skipped".format(job_questionnaire.name,
+                                                                                      job_questionnaire.id))
+                return
         # Fail if VMSettings not found
         self.vm_settings = VMSettings.objects.get(name=self.vm_settings_name)
         self.log_creation(False, 'VMSettings', self.vm_settings_name, self.vm_settings.id)
@@ -218,24 +887,60 @@ class WorkflowImporter(BaseCreator):
                  methods_jinja_template_url=None,
                  tag=None,
                  stdout=sys.stdout,
-                 stderr=sys.stderr):
+                 stderr=sys.stderr,
+                 methods_document_content=None,
+                 methods_template_hash=None):
         """
         Creates a WorkflowImporter to import the specified CWL and its variables into bespin-api models
+        When a version with the same tag, url, version number, CWL content hash and methods template hash already
+        exists it is reused without parsing the CWL document or rendering the methods document.
         :param cwl_url: The URL to a CWL Workflow to import
         :param version_number: the version number to assign
         :param stdout: For writing info log messages
         :param stderr: For writing error messages
+        :param methods_document_content: str: already rendered methods document, rendered here when None
+        :param methods_template_hash: str: hash of the template methods_document_content was rendered from
         """
         super(WorkflowImporter, self).__init__(stdout, stderr)
         self.cwl_document = cwl_document
         self.version_number = version_number
         self.methods_jinja_template_url = methods_jinja_template_url
         self.tag = tag
+        self.methods_document_content = methods_document_content
+        self.methods_template_hash = methods_template_hash
+        self.skipped = False
         # django model objects built up
         self.workflow = None
         self.workflow_version = None
 
+    def _find_unchanged_workflow_version(self, content_hash, template_hash):
+        if not self.tag or not template_hash:
+            return None
+        return WorkflowVersion.objects.filter(
+            workflow__tag=self.tag,
+            url=self.cwl_document.url,
+            version=self.version_number,
+            content_hash=content_hash,
+            methods_document__template_hash=template_hash
+        ).select_related('workflow').first()
+
     def _create_models(self):
+        content_hash = self.cwl_document.content_hash
+        template_text = None
+        template_hash = self.methods_template_hash
+        if self.methods_document_content is None:
+            template_text = methods_template_cache.get_template_text(self.methods_jinja_template_url,
+                                                                     get_artifact_resolver())
+            template_hash = hash_content(template_text.encode('utf-8'))
+        unchanged_workflow_version = self._find_unchanged_workflow_version(content_hash, template_hash)
+        if unchanged_workflow_version:
+            self.skipped = True
+            self.workflow = unchanged_workflow_version.workflow
+            self.workflow_version = unchanged_workflow_version
+            self.log("Workflow Version '{}' unchanged with id {}, skipped".format(
+                unchanged_workflow_version.description, unchanged_workflow_version.id))
+            return
+
         # Short description used for the Workflow name
         workflow_name = self.cwl_document.get('label')
         # Longer description used in workflow version
@@ -249,13 +954,27 @@ class WorkflowImporter(BaseCreator):
             url=self.cwl_document.url,
             description=workflow_version_description,
             version=self.version_number,
+            defaults={'content_hash': content_hash, 'fields': self.cwl_document.input_fields}
         )
-        software_requirement_hints = self.cwl_document.extract_tool_hints(hint_class_name="SoftwareRequirement")
-        methods_document = MethodsDocumentContents(workflow_version_description, software_requirement_hints,
-                                                   jinja_template_url=self.methods_jinja_template_url)
-        WorkflowMethodsDocument.objects.get_or_create(
+        content_changed = workflow_version.content_hash != content_hash
+        if content_changed:
+            # the CWL document changed (or the version was imported before content hashes were stored)
+            workflow_version.content_hash = content_hash
+            workflow_version.fields = self.cwl_document.input_fields
+            workflow_version.save(update_fields=['content_hash', 'fields'])
+        if created or content_changed or not workflow_version.steps.exists():
+            save_workflow_version_steps(workflow_version, self.cwl_document.extract_steps())
+        methods_document_content = self.methods_document_content
+        if methods_document_content is None:
+            software_requirement_hints = self.cwl_document.extract_tool_hints(
+                hint_class_name=SOFTWARE_REQUIREMENT_HINT)
+            methods_document = MethodsDocumentContents(workflow_version_description, software_requirement_hints,
+                                                       jinja_template_url=self.methods_jinja_template_url)
+            apa_citations = DOICitationResolver().resolve(methods_document.get_citations())
+            methods_document_content = methods_document.render(template_text, apa_citations)
+        WorkflowMethodsDocument.objects.update_or_create(
             workflow_version=workflow_version,
-            content=methods_document.get_content(),
+            defaults={'content': methods_document_content, 'template_hash': template_hash or ''}
         )
         self.log_creation(created, 'Workflow Version', workflow_version_description, workflow_version.id)
         self.workflow = workflow
@@ -278,13 +997,49 @@ class ImporterException(Exception):
 
 class WorkflowQuestionnaireImporter(object):
 
-    def __init__(self, data):
+    STAGE_VALIDATE = 'validate'
+    STAGE_LOAD_CWL = 'load_cwl'
+    STAGE_IMPORT_WORKFLOW = 'import_workflow'
+    STAGE_IMPORT_QUESTIONNAIRE = 'import_questionnaire'
+
+    def __init__(self, data, cwl_document=None, methods_document_content=None, stage_listener=None,
+                 methods_template_hash=None):
+        """
+        :param data: dict: import spec with the fields of AdminImportWorkflowQuestionnaireSerializer
+        :param cwl_document: CWLDocument: already loaded document for data['cwl_url'], loaded here when None
+        :param methods_document_content: str: already rendered methods document, rendered here when None
+        :param stage_listener: func(str): called with the name of each stage as it starts
+        :param methods_template_hash: str: hash of the template methods_document_content was rendered from
+        """
         self.data = data
+        self.cwl_document = cwl_document
+        self.methods_document_content = methods_document_content
+        self.methods_template_hash = methods_template_hash
+        self.stage_listener = stage_listener
+        self.stage_timings = {}
+        self.job_questionnaire = None
+        # True when the workflow version and questionnaire were unchanged so nothing was parsed or created
+        self.skipped = False
 
     def run(self):
-        self._validate_existing_objects()
+        with self._stage(self.STAGE_VALIDATE):
+            self._validate_existing_objects()
         self._load()
 
+    @contextmanager
+    def _stage(self, name):
+        """
+        Record the seconds taken by the stage in stage_timings, notifying stage_listener when it starts
+        :param name: str: name of the stage
+        """
+        if self.stage_listener:
+            self.stage_listener(name)
+        start_time = time.time()
+        try:
+            yield
+        finally:
+            self.stage_timings[name] = time.time() - start_time
+
     def _validate_existing_objects(self):
         vm_settings_name = self.data['vm_settings_name']
         share_group_name = self.data['share_group_name']
@@ -300,40 +1055,309 @@ class WorkflowQuestionnaireImporter(object):
     def _load(self):
         try:
             logger.info('Loading CWL document from %s', self.data.get('cwl_url'))
-            cwl_document = CWLDocument(self.data.get('cwl_url'))
+            with self._stage(self.STAGE_LOAD_CWL):
+                cwl_document = self.cwl_document or CWLDocument(self.data.get('cwl_url'))
+                # download and parse now so the time is recorded for this stage instead of import_workflow
+                cwl_document.content_hash
+                cwl_document.summary
         except Exception as e:
             raise ImporterException('Unable to load CWL Document', e)
 
         try:
             logger.info('Importing Workflow version %s', str(self.data.get('workflow_version_number')))
-            wf_importer = WorkflowImporter(
-                cwl_document,
-                self.data.get('workflow_version_number'),
-                self.data.get('methods_template_url'),
-                self.data.get('workflow_tag')
-            )
-            wf_importer.run()
+            with self._stage(self.STAGE_IMPORT_WORKFLOW):
+                wf_importer = WorkflowImporter(
+                    cwl_document,
+                    self.data.get('workflow_version_number'),
+                    self.data.get('methods_template_url'),
+                    self.data.get('workflow_tag'),
+                    methods_document_content=self.methods_document_content,
+                    methods_template_hash=self.methods_template_hash
+                )
+                wf_importer.run()
         except Exception as e:
             logger.exception('Unable to import workflow' )
             raise ImporterException('Unable to import workflow', e)
 
         try:
             logger.info('Importing Job Questionnaire named %s', self.data.get('name'))
-            jq_importer = JobQuestionnaireImporter(
-                self.data.get('name'),
-                self.data.get('description'),
-                self.data.get('type_tag'),
-                wf_importer.workflow_version,
-                self.data.get('system_json'),
-                self.data.get('vm_settings_name'),
-                self.data.get('vm_flavor_name'),
-                self.data.get('share_group_name'),
-                self.data.get('volume_size_base'),
-                self.data.get('volume_size_factor'),
-                cwl_document
-            )
-            jq_importer.run()
+            with self._stage(self.STAGE_IMPORT_QUESTIONNAIRE):
+                jq_importer = JobQuestionnaireImporter(
+                    self.data.get('name'),
+                    self.data.get('description'),
+                    self.data.get('type_tag'),
+                    wf_importer.workflow_version,
+                    self.data.get('system_json'),
+                    self.data.get('vm_settings_name'),
+                    self.data.get('vm_flavor_name'),
+                    self.data.get('share_group_name'),
+                    self.data.get('volume_size_base'),
+                    self.data.get('volume_size_factor'),
+                    cwl_document,
+                    reuse_existing=wf_importer.skipped
+                )
+                jq_importer.run()
             self.created_jobquestionnaire = jq_importer.created_job_questionnaire
+            self.job_questionnaire = jq_importer.job_questionnaire
+            self.skipped = jq_importer.skipped
         except Exception as e:
             logger.exception('Unable to import questionnaire' )
             raise ImporterException('Unable to import questionnaire', e)
+
+
+def prepare_workflow_import(spec):
+    """
+    Parse the CWL document for an import spec without touching the database so it can be run in a worker process.
+    :param spec: dict: import spec with the fields of AdminImportWorkflowQuestionnaireSerializer
+    :return: (dict, str, float): summary of the CWL document, hash of its content and seconds taken
+    """
+    start_time = time.time()
+    cwl_document = CWLDocument(spec['cwl_url'])
+    # hashing downloads the document first so cwltool parses those bytes instead of fetching it again
+    content_hash = cwl_document.content_hash
+    return cwl_document.summary, content_hash, time.time() - start_time
+
+
+class ArtifactPrefetcher(object):
+    """
+    Fills an ArtifactMirror with the CWL documents, methods templates and DOI citations needed to import specs
+    so the imports can be run with settings.BESPIN_ARTIFACT_OFFLINE.
+    """
+    def __init__(self, mirror, refresh=False, network_resolver=None):
+        """
+        :param mirror: ArtifactMirror: mirror to fill
+        :param refresh: bool: fetch artifacts again even when they are already in the mirror
+        :param network_resolver: NetworkArtifactResolver: resolver used to fetch artifacts
+        """
+        self.mirror = mirror
+        self.refresh = refresh
+        self.network_resolver = network_resolver or NetworkArtifactResolver()
+
+    def prefetch(self, spec):
+        """
+        Fetch the artifacts for spec missing from the mirror. The CWL document is parsed from the mirror to make sure
+        it can be loaded offline.
+        :param spec: dict: import spec with the fields of AdminImportWorkflowQuestionnaireSerializer
+        :return: [str]: urls and DOI citations that were fetched
+        """
+        fetched = []
+        for url in [spec['cwl_url'], spec['methods_template_url']]:
+            if url.startswith(FILE_URL_PREFIX):
+                continue
+            if self.refresh or not self.mirror.contains(url):
+                self.mirror.put(url, self.network_resolver.fetch(url))
+                fetched.append(url)
+        cwl_document = CWLDocument(spec['cwl_url'], artifact_resolver=MirrorArtifactResolver(self.mirror))
+        software_requirement_hints = cwl_document.extract_tool_hints(SOFTWARE_REQUIREMENT_HINT)
+        methods_document = MethodsDocumentContents(cwl_document.get('doc'), software_requirement_hints,
+                                                   jinja_template_url=spec['methods_template_url'])
+        for citation in methods_document.get_citations():
+            if citation.startswith(HTTPS_DOI_URL):
+                doi_name = citation.replace(HTTPS_DOI_URL, '')
+                if self.refresh or self.mirror.get_apa_citation(doi_name) is None:
+                    apa_citation = self.network_resolver.fetch_apa_citation(doi_name)
+                    self.mirror.put_apa_citation(doi_name, apa_citation)
+                    fetched.append(citation)
+        return fetched
+
+
+class BulkImportResult(object):
+    """
+    Outcome of importing one spec with BulkWorkflowImporter.
+    """
+    def __init__(self, spec):
+        self.spec = spec
+        self.summary = None
+        self.content_hash = None
+        self.template_text = None
+        self.prepare_seconds = None
+        self.created_job_questionnaire = None
+        self.skipped = False
+        self.error = None
+
+    @property
+    def prepared(self):
+        return self.summary is not None and self.template_text is not None
+
+    @property
+    def succeeded(self):
+        return self.error is None
+
+    def make_methods_document(self):
+        hints = self.summary['hints'][SOFTWARE_REQUIREMENT_HINT]
+        return MethodsDocumentContents(self.summary['doc'], hints, jinja_template_url=self.spec['methods_template_url'])
+
+
+class BulkWorkflowImporter(object):
+    """
+    Imports many workflow versions and their questionnaires from a list of import specs.
+    CWL parsing and hint extraction run in a process pool. Each methods template is fetched once and DOI citations
+    for all versions are resolved together, then the models for each workflow are created in their own transaction.
+    """
+    def __init__(self, specs, max_workers=None):
+        """
+        :param specs: [dict]: import specs with the fields of AdminImportWorkflowQuestionnaireSerializer
+        :param max_workers: int: number of worker processes, defaults to the number of CPUs
+        """
+        self.specs = specs
+        self.max_workers = max_workers
+        self.results = [BulkImportResult(spec) for spec in specs]
+        self.timings = {}
+
+    def run(self):
+        """
+        :return: [BulkImportResult]: result for each spec in the same order as specs
+        """
+        start_time = time.time()
+        self._prepare()
+        self.timings['prepare'] = time.time() - start_time
+
+        templates_start_time = time.time()
+        self._fetch_templates()
+        self.timings['templates'] = time.time() - templates_start_time
+
+        citations_start_time = time.time()
+        apa_citations = self._resolve_citations()
+        self.timings['citations'] = time.time() - citations_start_time
+
+        save_start_time = time.time()
+        self._save(apa_citations)
+        self.timings['save'] = time.time() - save_start_time
+        self.timings['total'] = time.time() - start_time
+        return self.results
+
+    def _prepare(self):
+        # database connections must not be shared with the worker processes
+        connections.close_all()
+        with ProcessPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = [(result, executor.submit(prepare_workflow_import, result.spec)) for result in self.results]
+            for result, future in futures:
+                try:
+                    result.summary, result.content_hash, result.prepare_seconds = future.result()
+                except Exception as e:
+                    logger.exception('Unable to load CWL document %s', result.spec.get('cwl_url'))
+                    result.error = 'Unable to load CWL Document: {}'.format(e)
+
+    def _fetch_templates(self):
+        artifact_resolver = get_artifact_resolver()
+        template_texts = {}
+        for result in self.results:
+            if result.summary is None:
+                continue
+            url = result.spec['methods_template_url']
+            if url not in template_texts:
+                try:
+                    template_texts[url] = methods_template_cache.get_template_text(url, artifact_resolver)
+                except Exception as e:
+                    logger.exception('Unable to fetch methods template %s', url)
+                    template_texts[url] = e
+            if isinstance(template_texts[url], Exception):
+                result.error = 'Unable to fetch methods template: {}'.format(template_texts[url])
+            else:
+                result.template_text = template_texts[url]
+
+    def _resolve_citations(self):
+        citations = set()
+        for result in self.results:
+            if result.prepared:
+                citations.update(result.make_methods_document().get_citations())
+        return DOICitationResolver().resolve(list(citations))
+
+    def _save(self, apa_citations):
+        results_by_workflow_tag = {}
+        for result in self.results:
+            if result.prepared:
+                results_by_workflow_tag.setdefault(result.spec['workflow_tag'], []).append(result)
+        for workflow_tag, results in results_by_workflow_tag.items():
+            try:
+                with transaction.atomic():
+                    for result in results:
+                        self._save_result(result, apa_citations)
+            except Exception:
+                for result in results:
+                    if result.succeeded:
+                        result.error = 'Not imported, another version of workflow {} failed'.format(workflow_tag)
+                        result.created_job_questionnaire = None
+
+    @staticmethod
+    def _save_result(result, apa_citations):
+        """
+        Render the methods document and import result.spec, recording any error in result before re-raising it
+        so the transaction for the workflow is rolled back.
+        """
+        try:
+            methods_document_content = result.make_methods_document().render(result.template_text, apa_citations)
+            cwl_document = CWLDocument(result.spec['cwl_url'], summary=result.summary,
+                                       content_hash=result.content_hash)
+            importer = WorkflowQuestionnaireImporter(
+                result.spec, cwl_document=cwl_document, methods_document_content=methods_document_content,
+                methods_template_hash=hash_content(result.template_text.encode('utf-8')))
+            importer.run()
+        except ImporterException as e:
+            result.error = '{}: {}'.format(e.message, e.cause)
+            raise
+        except Exception as e:
+            logger.exception('Unable to import workflow %s', result.spec.get('cwl_url'))
+            result.error = 'Unable to import workflow: {}'.format(e)
+            raise
+        result.created_job_questionnaire = importer.created_jobquestionnaire
+        result.skipped = importer.skipped
+
+
+class WorkflowImportTaskRunner(object):
+    """
+    Runs NEW WorkflowImportTasks one at a time, recording the current stage, stage timings and any error.
+    """
+    def run_next(self):
+        """
+        Fail stale RUNNING tasks then claim the oldest NEW task and run it. Tasks locked by other runners are skipped.
+        :return: WorkflowImportTask: task that was run or None if there were no NEW tasks
+        """
+        self.fail_stale_tasks()
+        with transaction.atomic():
+            sql = CLAIM_IMPORT_TASK_SQL.format(WorkflowImportTask._meta.db_table)
+            tasks = list(WorkflowImportTask.objects.raw(sql, [WorkflowImportTask.STATE_NEW]))
+            if not tasks:
+                return None
+            task = tasks[0]
+            task.state = WorkflowImportTask.STATE_RUNNING
+            task.started = timezone.now()
+            task.save()
+        self.run_task(task)
+        return task
+
+    @staticmethod
+    def fail_stale_tasks():
+        """
+        Mark RUNNING tasks started more than settings.BESPIN_IMPORT_TASK_TIMEOUT_SECONDS ago as errors so a task
+        whose runner was stopped part way through does not stay RUNNING forever.
+        :return: int: number of tasks marked as errors
+        """
+        timeout_seconds = settings.BESPIN_IMPORT_TASK_TIMEOUT_SECONDS
+        now = timezone.now()
+        stale_tasks = WorkflowImportTask.objects.filter(state=WorkflowImportTask.STATE_RUNNING,
+                                                        started__lt=now - datetime.timedelta(seconds=timeout_seconds))
+        return stale_tasks.update(state=WorkflowImportTask.STATE_ERROR,
+                                  error=IMPORT_TASK_TIMEOUT_ERROR.format(timeout_seconds), finished=now)
+
+    @staticmethod
+    def run_task(task):
+        def on_stage(stage):
+            task.stage = stage
+            task.save(update_fields=['stage'])
+
+        importer = WorkflowQuestionnaireImporter(task.spec, stage_listener=on_stage)
+        try:
+            importer.run()
+            task.state = WorkflowImportTask.STATE_FINISHED
+            task.job_questionnaire = importer.job_questionnaire
+        except ImporterException as e:
+            task.state = WorkflowImportTask.STATE_ERROR
+            task.error = '{}: {}'.format(e.message, e.cause)
+        except Exception as e:
+            logger.exception('Unable to run workflow import task %s', task.id)
+            task.state = WorkflowImportTask.STATE_ERROR
+            task.error = str(e)
+        task.stage_timings = importer.stage_timings
+        task.finished = timezone.now()
+        task.save()
@@ -1,11 +1,17 @@
 from data.models import Job, JobDDSOutputProject, DDSJobInputFile, DDSUserCredential, WorkflowVersion, \
-    WorkflowConfiguration
+    WorkflowConfiguration, JobFileStageGroup, JobActivity
 from data.exceptions import JobFactoryException
 from django.conf import settings
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
 import json
 import math
+import time
 
 BYTES_TO_GB_DIVISOR = 1024 * 1024 * 1024
+VOLUME_SIZING_MODE_STATIC = 'static'
+VOLUME_SIZING_MODE_PREDICTED = 'predicted'
 
 
 def create_job_factory_for_answer_set(job_answer_set):
@@ -44,10 +50,19 @@ def calculate_volume_size(volume_size_base, volume_size_factor, stage_group):
     :param stage_group: StageGroup: input files used with a job
     :return: int: size in GB: volume_size_factor * data_size_in_gb + volume_size_base
     """
-    base_in_gb = volume_size_base
-    factor = volume_size_factor
     data_size_in_gb = calculate_stage_group_size(stage_group)
-    return int(math.ceil(base_in_gb + float(factor) * data_size_in_gb))
+    return volume_size_for_data_size(volume_size_base, volume_size_factor, data_size_in_gb)
+
+
+def volume_size_for_data_size(volume_size_base, volume_size_factor, data_size_in_gb):
+    """
+    Calculates the volume size needed to stage data_size_in_gb based volume size settings.
+    :param volume_size_base: int: base volume size
+    :param volume_size_factor: int: value multipied by data_size_in_gb
+    :param data_size_in_gb: float: size in GB of the files to be staged
+    :return: int: size in GB: volume_size_factor * data_size_in_gb + volume_size_base
+    """
+    return int(math.ceil(volume_size_base + float(volume_size_factor) * data_size_in_gb))
 
 
 def calculate_stage_group_size(stage_group):
@@ -56,14 +71,195 @@ def calculate_stage_group_size(stage_group):
     :param stage_group: JobFileStageGroup that may contain dds_files and/or url_file
     :return: float: size in GB of all files in the stage group
     """
-    total_size_in_bytes = 0
-    for dds_file in stage_group.dds_files.all():
-        total_size_in_bytes += dds_file.size
-    for url_file in stage_group.url_files.all():
-        total_size_in_bytes += url_file.size
+    total_size_in_bytes = stage_group.calculate_total_size()
     return float(total_size_in_bytes) / BYTES_TO_GB_DIVISOR
 
 
+def calculate_stage_group_sizes(stage_groups):
+    """
+    Total up the size of the files contained in each of the passed stage_groups with a single query
+    :param stage_groups: [JobFileStageGroup]: stage groups that may contain dds_files and/or url_files
+    :return: dict: size in GB of all files for each stage group id
+    """
+    total_sizes = JobFileStageGroup.calculate_total_sizes([stage_group.pk for stage_group in stage_groups])
+    return dict((pk, float(total_size) / BYTES_TO_GB_DIVISOR) for pk, total_size in total_sizes.items())
+
+
+def make_job_order(system_job_order, user_job_order):
+    # Create the job order to be submitted. Begin with the system info and overlay the user order
+    job_order = system_job_order.copy()
+    job_order.update(user_job_order)
+    return job_order
+
+
+def get_new_job_state():
+    """
+    State for newly created jobs, jobs must be authorized with a token when settings.REQUIRE_JOB_TOKENS is set
+    """
+    if settings.REQUIRE_JOB_TOKENS:
+        return Job.JOB_STATE_NEW
+    else:
+        return Job.JOB_STATE_AUTHORIZED
+
+
+class WorkerDDSUserCredentialCache(object):
+    """
+    Resolves the DDSUserCredential used by workers to store job output, reusing it for
+    settings.BESPIN_WORKER_DDS_USER_CREDENTIAL_CACHE_SECONDS or until a DDSUserCredential is saved or deleted
+    in this process. Uses settings.BESPIN_WORKER_DDS_USER_CREDENTIAL_ID when set otherwise the first
+    credential (there is only one production DukeDS instance).
+    """
+    # (configured credential id, DDSUserCredential, time cached)
+    cached = None
+
+    @classmethod
+    def get(cls):
+        """
+        :return: DDSUserCredential: credential for the worker user
+        """
+        configured_id = settings.BESPIN_WORKER_DDS_USER_CREDENTIAL_ID
+        if cls.cached is not None:
+            cached_id, worker_user_credentials, cached_time = cls.cached
+            cache_seconds = settings.BESPIN_WORKER_DDS_USER_CREDENTIAL_CACHE_SECONDS
+            if cached_id == configured_id and time.time() - cached_time < cache_seconds:
+                return worker_user_credentials
+        if configured_id:
+            worker_user_credentials = DDSUserCredential.objects.filter(pk=configured_id).first()
+        else:
+            worker_user_credentials = DDSUserCredential.objects.first()
+        if not worker_user_credentials:
+            raise JobFactoryException(['No DukeDS credentials found for the worker user.'])
+        cls.cached = (configured_id, worker_user_credentials, time.time())
+        return worker_user_credentials
+
+    @classmethod
+    def clear(cls):
+        cls.cached = None
+
+
+@receiver([post_save, post_delete], sender=DDSUserCredential)
+def clear_worker_dds_user_credential_cache(sender, **kwargs):
+    WorkerDDSUserCredentialCache.clear()
+
+
+def create_output_projects(jobs):
+    """
+    Create the output projects for jobs with a single insert, all owned by the worker user.
+    :param jobs: [Job]: jobs that have been saved to the database
+    :return: [JobDDSOutputProject]: output projects that were created
+    """
+    worker_user_credentials = WorkerDDSUserCredentialCache.get()
+    return JobDDSOutputProject.objects.bulk_create([
+        JobDDSOutputProject(job=job, dds_user_credentials=worker_user_credentials) for job in jobs
+    ])
+
+
+class VolumeSizePredictor(object):
+    """
+    Predicts the volume size a job needs based on the disk usage of finished jobs of the same workflow version.
+    Fits volume size = base + factor * input GB so the line lies on or above the space every recent finished job
+    reported using. Jobs sized by a previous prediction are not used since jobs that ran out of space never finish.
+    Predictions never exceed the size the vm strategy settings would give the job.
+    """
+    def __init__(self, workflow_version, margin=None, min_jobs=None, max_jobs=None):
+        """
+        :param workflow_version: WorkflowVersion: version whose finished jobs are used
+        :param margin: float: fraction added to the fitted size, defaults to settings.BESPIN_VOLUME_SIZE_MARGIN
+        :param min_jobs: int: finished jobs required before predicting, defaults to settings.BESPIN_VOLUME_SIZE_MIN_JOBS
+        :param max_jobs: int: most recent finished jobs to fit, defaults to settings.BESPIN_VOLUME_SIZE_MAX_JOBS
+        """
+        self.workflow_version = workflow_version
+        self.margin = settings.BESPIN_VOLUME_SIZE_MARGIN if margin is None else margin
+        self.min_jobs = settings.BESPIN_VOLUME_SIZE_MIN_JOBS if min_jobs is None else min_jobs
+        self.max_jobs = settings.BESPIN_VOLUME_SIZE_MAX_JOBS if max_jobs is None else max_jobs
+        self._coefficients = None
+        self._fitted = False
+
+    def get_finished_job_sizes(self):
+        """
+        :return: [(float, int)]: input size in GB and volume size used in GB of recent finished jobs
+        """
+        finished_jobs = Job.objects.filter(workflow_version=self.workflow_version, state=Job.JOB_STATE_FINISHED,
+                                           stage_group__isnull=False, volume_size_used__isnull=False,
+                                           volume_size_predicted=False).order_by('-created')
+        rows = finished_jobs.values_list('stage_group__total_size', 'volume_size_used')[:self.max_jobs]
+        return [(float(total_size) / BYTES_TO_GB_DIVISOR, volume_size_used) for total_size, volume_size_used in rows]
+
+    def get_coefficients(self):
+        """
+        Fit of volume size used to input size of finished jobs.
+        :return: (float, float): base and factor or None when there are not enough finished jobs
+        """
+        if not self._fitted:
+            self._coefficients = self.fit(self.get_finished_job_sizes(), self.min_jobs)
+            self._fitted = True
+        return self._coefficients
+
+    @staticmethod
+    def fit(sizes, min_jobs):
+        """
+        Least squares factor with the base raised so no job used more space than the fitted line.
+        :param sizes: [(float, int)]: input size in GB and volume size used in GB pairs
+        :param min_jobs: int: minimum number of pairs required
+        :return: (float, float): base and factor or None when there are less than min_jobs pairs
+        """
+        count = len(sizes)
+        if not count or count < min_jobs:
+            return None
+        mean_data_size = sum(data_size for data_size, _ in sizes) / count
+        mean_volume_size = sum(volume_size for _, volume_size in sizes) / float(count)
+        variance = sum((data_size - mean_data_size) ** 2 for data_size, _ in sizes)
+        factor = 0.0
+        if variance:
+            covariance = sum((data_size - mean_data_size) * (volume_size - mean_volume_size)
+                             for data_size, volume_size in sizes)
+            # more input data never needs less space
+            factor = max(covariance / variance, 0.0)
+        base = max(volume_size - factor * data_size for data_size, volume_size in sizes)
+        return base, factor
+
+    def predict(self, data_size_in_gb, default_volume_size):
+        """
+        :param data_size_in_gb: float: size in GB of the files to be staged
+        :param default_volume_size: int: size in GB from the vm strategy settings
+        :return: int: size in GB predicted for the volume including the safety margin or None when there are
+        not enough finished jobs, never more than default_volume_size
+        """
+        coefficients = self.get_coefficients()
+        if coefficients is None:
+            return None
+        base, factor = coefficients
+        predicted_size = (base + factor * data_size_in_gb) * (1 + self.margin)
+        return min(max(int(math.ceil(predicted_size)), 1), default_volume_size)
+
+
+def get_volume_size_predictor(workflow_version):
+    """
+    :param workflow_version: WorkflowVersion: version jobs are being created for
+    :return: VolumeSizePredictor or None when settings.BESPIN_VOLUME_SIZING_MODE is not predicted
+    """
+    if settings.BESPIN_VOLUME_SIZING_MODE == VOLUME_SIZING_MODE_PREDICTED:
+        return VolumeSizePredictor(workflow_version)
+    return None
+
+
+def calculate_job_volume_size(job_vm_strategy, data_size_in_gb, volume_size_predictor=None):
+    """
+    Calculates the volume size for a job using job_vm_strategy settings or volume_size_predictor when present.
+    :param job_vm_strategy: JobVMStrategy: contains volume size base and factor
+    :param data_size_in_gb: float: size in GB of the files to be staged
+    :param volume_size_predictor: VolumeSizePredictor: optional predictor
+    :return: (int, bool): size in GB and whether it was predicted
+    """
+    volume_size = volume_size_for_data_size(job_vm_strategy.volume_size_base, job_vm_strategy.volume_size_factor,
+                                            data_size_in_gb)
+    if volume_size_predictor:
+        predicted_volume_size = volume_size_predictor.predict(data_size_in_gb, volume_size)
+        if predicted_volume_size is not None:
+            return predicted_volume_size, True
+    return volume_size, False
+
+
 class JobVMStrategy(object):
     def __init__(self, vm_settings, vm_flavor, volume_size_base, volume_size_factor, volume_mounts):
         self.vm_settings = vm_settings
@@ -90,10 +286,7 @@ class JobFactory(object):
         self.share_group = share_group
 
     def _get_job_order(self):
-        # Create the job order to be submitted. Begin with the system info and overlay the user order
-        job_order = self.system_job_order.copy()
-        job_order.update(self.user_job_order)
-        return job_order
+        return make_job_order(self.system_job_order, self.user_job_order)
 
     def create_job(self):
         """
@@ -101,15 +294,10 @@ class JobFactory(object):
         :return: Job: job that was inserted into the database along with it's output project and input files.
         """
         job_order = self._get_job_order()
-        if settings.REQUIRE_JOB_TOKENS:
-            job_state = Job.JOB_STATE_NEW
-        else:
-            job_state = Job.JOB_STATE_AUTHORIZED
-
-        volume_size = calculate_volume_size(
-            volume_size_base=self.job_vm_strategy.volume_size_base,
-            volume_size_factor=self.job_vm_strategy.volume_size_factor,
-            stage_group=self.stage_group)
+        job_state = get_new_job_state()
+        volume_size, volume_size_predicted = calculate_job_volume_size(
+            self.job_vm_strategy, calculate_stage_group_size(self.stage_group),
+            get_volume_size_predictor(self.workflow_version))
 
         job = Job.objects.create(workflow_version=self.workflow_version,
                                  user=self.user,
@@ -118,14 +306,59 @@ class JobFactory(object):
                                  vm_settings=self.job_vm_strategy.vm_settings,
                                  job_order=json.dumps(job_order),
                                  volume_size=volume_size,
+                                 volume_size_predicted=volume_size_predicted,
                                  vm_volume_mounts=self.job_vm_strategy.volume_mounts,
                                  vm_flavor=self.job_vm_strategy.vm_flavor,
                                  share_group=self.share_group,
                                  fund_code=self.fund_code,
                                  state=job_state)
 
-        # Create output project
-        # just taking the first worker user credential for now(there is only one production DukeDS instance)
-        worker_user_credentials = DDSUserCredential.objects.first()
-        JobDDSOutputProject.objects.create(job=job, dds_user_credentials=worker_user_credentials)
+        create_output_projects([job])
         return job
+
+
+class JobBatchFactory(object):
+    """
+    Creates many Job records for a single workflow version and vm strategy using bulk inserts.
+    """
+    def __init__(self, user, workflow_version, system_job_order, job_vm_strategy, share_group):
+        self.user = user
+        self.workflow_version = workflow_version
+        self.system_job_order = system_job_order
+        self.job_vm_strategy = job_vm_strategy
+        self.share_group = share_group
+
+    def create_jobs(self, job_entries):
+        """
+        Create a job for each entry along with it's output project and initial activity in one transaction.
+        Job.save is bypassed by the bulk inserts so the initial JobActivity records are created here.
+        :param job_entries: [(str, str, JobFileStageGroup, dict)]: job name, fund code, stage group, user job order
+        :return: [Job]: jobs that were inserted into the database
+        """
+        job_state = get_new_job_state()
+        data_sizes_in_gb = calculate_stage_group_sizes([stage_group for _, _, stage_group, _ in job_entries])
+        volume_size_predictor = get_volume_size_predictor(self.workflow_version)
+        jobs = []
+        for job_name, fund_code, stage_group, user_job_order in job_entries:
+            volume_size, volume_size_predicted = calculate_job_volume_size(
+                self.job_vm_strategy, data_sizes_in_gb[stage_group.pk], volume_size_predictor)
+            job = Job(workflow_version=self.workflow_version,
+                      user=self.user,
+                      stage_group=stage_group,
+                      name=job_name,
+                      vm_settings=self.job_vm_strategy.vm_settings,
+                      job_order=json.dumps(make_job_order(self.system_job_order, user_job_order)),
+                      volume_size=volume_size,
+                      volume_size_predicted=volume_size_predicted,
+                      vm_volume_mounts=self.job_vm_strategy.volume_mounts,
+                      vm_flavor=self.job_vm_strategy.vm_flavor,
+                      share_group=self.share_group,
+                      fund_code=fund_code,
+                      state=job_state)
+            job.check_stage_group_user()
+            jobs.append(job)
+        with transaction.atomic():
+            jobs = Job.objects.bulk_create(jobs)
+            JobActivity.objects.bulk_create([JobActivity(job=job, state=job.state, step=job.step) for job in jobs])
+            create_output_projects(jobs)
+        return jobs
@@ -1,9 +1,35 @@
-from data.models import Job
+from data.models import Job, JobActivity, VMFlavor
 import datetime
+from django.db import connection
 from django.utils import timezone
 
 SECONDS_IN_AN_HOUR = 3600.0
 
+# Totals the time each finished job spent on a VM from the gaps between its activities (as JobUsage does)
+# then aggregates them per workflow version and flavor.
+VM_FLAVOR_USAGE_SQL = """
+WITH activity AS (
+    SELECT a.job_id, a.state, a.step, a.created,
+           LEAD(a.created) OVER (PARTITION BY a.job_id ORDER BY a.created) AS next_created
+    FROM {activity_table} a JOIN {job_table} j ON j.id = a.job_id
+    WHERE j.state = %(finished_state)s AND j.workflow_version_id IS NOT NULL {job_filter}
+), job_hours AS (
+    SELECT job_id, CAST(SUM(EXTRACT(EPOCH FROM next_created - created)) AS FLOAT) / {seconds_in_an_hour} AS vm_hours
+    FROM activity
+    WHERE state = %(running_state)s AND step IN %(vm_steps)s AND next_created IS NOT NULL
+    GROUP BY job_id
+)
+SELECT j.workflow_version_id, f.id, f.name, f.cpus, COUNT(*),
+       PERCENTILE_CONT(0.5) WITHIN GROUP (ORDER BY h.vm_hours),
+       PERCENTILE_CONT(%(percentile)s) WITHIN GROUP (ORDER BY h.vm_hours),
+       AVG(h.vm_hours * f.cpus),
+       SUM(h.vm_hours * f.cpus)
+FROM job_hours h JOIN {job_table} j ON j.id = h.job_id JOIN {flavor_table} f ON f.id = j.vm_flavor_id
+GROUP BY j.workflow_version_id, f.id, f.name, f.cpus
+HAVING COUNT(*) >= %(min_jobs)s
+ORDER BY j.workflow_version_id, f.cpus, f.name
+"""
+
 
 class JobUsage(object):
     def __init__(self, job):
@@ -71,3 +97,92 @@ class JobUsage(object):
         :return: int
         """
         return vm_hours * self.job.vm_flavor.cpus
+
+
+class VMFlavorUsage(object):
+    """
+    VM usage of the finished jobs of a workflow version that ran with a VM flavor.
+    """
+    def __init__(self, workflow_version_id, vm_flavor_id, vm_flavor_name, cpus, job_count, median_vm_hours,
+                 percentile_vm_hours, mean_cpu_hours, total_cpu_hours):
+        self.workflow_version_id = workflow_version_id
+        self.vm_flavor_id = vm_flavor_id
+        self.vm_flavor_name = vm_flavor_name
+        self.cpus = cpus
+        self.job_count = job_count
+        self.median_vm_hours = median_vm_hours
+        self.percentile_vm_hours = percentile_vm_hours
+        self.mean_cpu_hours = mean_cpu_hours
+        self.total_cpu_hours = total_cpu_hours
+
+
+class VMFlavorRecommendation(object):
+    """
+    Cheapest VM flavor for a workflow version that meets a target runtime.
+    """
+    def __init__(self, workflow_version_id, usages, target_vm_hours):
+        """
+        :param workflow_version_id: int: id of the workflow version usages are for
+        :param usages: [VMFlavorUsage]: usage of each flavor the workflow version has run with
+        :param target_vm_hours: float: percentile runtime a flavor must not exceed
+        """
+        self.workflow_version_id = workflow_version_id
+        self.usages = usages
+        self.target_vm_hours = target_vm_hours
+        meeting_target = [usage for usage in usages if usage.percentile_vm_hours <= target_vm_hours]
+        self.meets_target = bool(meeting_target)
+        if meeting_target:
+            # CPU hours is what we are charged for so the cheapest flavor uses the fewest of them
+            self.usage = min(meeting_target, key=lambda usage: (usage.mean_cpu_hours, usage.cpus))
+        else:
+            self.usage = min(usages, key=lambda usage: usage.percentile_vm_hours)
+        self.vm_flavor_id = self.usage.vm_flavor_id
+        self.vm_flavor_name = self.usage.vm_flavor_name
+
+
+class VMFlavorUsageReport(object):
+    """
+    Aggregates vm_hours and cpu_hours of finished jobs per workflow version and VM flavor in the database.
+    """
+    def __init__(self, percentile=0.9, min_jobs=1, workflow_version_ids=None):
+        """
+        :param percentile: float: fraction (0-1) of jobs whose runtime is reported in percentile_vm_hours
+        :param min_jobs: int: minimum number of finished jobs for a workflow version and flavor to be included
+        :param workflow_version_ids: [int]: optional workflow versions to limit the report to
+        """
+        self.percentile = percentile
+        self.min_jobs = min_jobs
+        self.workflow_version_ids = workflow_version_ids
+
+    def get_usages(self):
+        """
+        :return: [VMFlavorUsage]: usage ordered by workflow version then flavor cpus
+        """
+        params = {
+            'finished_state': Job.JOB_STATE_FINISHED,
+            'running_state': Job.JOB_STATE_RUNNING,
+            'vm_steps': (Job.JOB_STEP_STAGING, Job.JOB_STEP_RUNNING, Job.JOB_STEP_STORE_OUTPUT),
+            'percentile': self.percentile,
+            'min_jobs': self.min_jobs,
+        }
+        job_filter = ''
+        if self.workflow_version_ids:
+            job_filter = 'AND j.workflow_version_id IN %(workflow_version_ids)s'
+            params['workflow_version_ids'] = tuple(self.workflow_version_ids)
+        sql = VM_FLAVOR_USAGE_SQL.format(activity_table=JobActivity._meta.db_table, job_table=Job._meta.db_table,
+                                         flavor_table=VMFlavor._meta.db_table, job_filter=job_filter,
+                                         seconds_in_an_hour=SECONDS_IN_AN_HOUR)
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            return [VMFlavorUsage(*row) for row in cursor.fetchall()]
+
+    def get_recommendations(self, target_vm_hours):
+        """
+        :param target_vm_hours: float: percentile runtime in hours a flavor must not exceed
+        :return: [VMFlavorRecommendation]: recommendation for each workflow version with finished jobs
+        """
+        usages_by_workflow_version = {}
+        for usage in self.get_usages():
+            usages_by_workflow_version.setdefault(usage.workflow_version_id, []).append(usage)
+        return [VMFlavorRecommendation(workflow_version_id, usages, target_vm_hours)
+                for workflow_version_id, usages in sorted(usages_by_workflow_version.items())]
@@ -1,25 +1,115 @@
-from django.core.mail import EmailMessage as DjangoEmailMessage
+from django.core.mail import EmailMessage as DjangoEmailMessage, get_connection
 from django.template import Template, Context
 from django.utils.safestring import mark_safe
 from django.conf import settings
-from data.models import Job, EmailMessage, EmailTemplate, LandoConnection
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django.utils import timezone
+from data.models import Job, EmailMessage, EmailTemplate, LandoConnection, JobNotification
 from data.exceptions import EmailServiceException, EmailAlreadySentException
 import pickle
+import json
+import threading
+import hashlib
+import time
+import datetime
+import six
 from lando_messaging.workqueue import WorkQueueConnection
 
 EMAIL_EXCHANGE = "EmailExchange"
 ROUTING_KEY = "SendEmail"
+# Version of the JSON payload published to the mailer queue
+MAILER_PAYLOAD_VERSION = 2
+# Postgres row locking that lets several batch senders run at once without claiming the same messages.
+# Claims NEW messages along with ERROR messages that are due to be retried.
+CLAIM_EMAIL_MESSAGES_SQL = "SELECT * FROM {} WHERE state = %s OR (state = %s AND next_attempt <= %s) " \
+                           "ORDER BY id LIMIT %s FOR UPDATE SKIP LOCKED"
+
+
+def make_django_email_message(email_message):
+    """
+    Build a django email message for sending the contents of email_message
+    :param email_message: EmailMessage: message to send
+    :return: django.core.mail.EmailMessage
+    """
+    if email_message.bcc_email is not None:
+        bcc = email_message.bcc_email.split()
+    else:
+        bcc = None
+    return DjangoEmailMessage(
+        email_message.subject,
+        email_message.body,
+        email_message.sender_email,
+        [email_message.to_email],
+        bcc=bcc
+    )
+
+
+class EmailTemplateCache(object):
+    """
+    Caches EmailTemplates by name along with the compiled django Templates for their subject and body.
+    Compiled templates are keyed by template id and a hash of the template text, so a template edited in
+    another process is recompiled. Lookups by name expire after settings.BESPIN_MAILER_TEMPLATE_CACHE_SECONDS.
+    """
+    def __init__(self):
+        self.email_templates = {}
+        self.compiled_templates = {}
+
+    def get_email_template(self, name):
+        cache_seconds = settings.BESPIN_MAILER_TEMPLATE_CACHE_SECONDS
+        now = time.time()
+        cached = self.email_templates.get(name)
+        if cached:
+            email_template, cached_at = cached
+            if now - cached_at < cache_seconds:
+                return email_template
+        email_template = EmailTemplate.objects.get(name=name)
+        if cache_seconds:
+            self.email_templates[name] = (email_template, now)
+        return email_template
+
+    def get_compiled_template(self, template_id, template_text):
+        key = (template_id, hashlib.sha1(template_text.encode('utf-8')).hexdigest())
+        compiled_template = self.compiled_templates.get(key)
+        if compiled_template is None:
+            compiled_template = Template(template_text)
+            self.compiled_templates[key] = compiled_template
+        return compiled_template
+
+    def invalidate(self, email_template):
+        """
+        Remove cached values for email_template
+        :param email_template: EmailTemplate: template that was changed or deleted
+        """
+        self.email_templates = dict(
+            (name, cached) for name, cached in self.email_templates.items()
+            if name != email_template.name and cached[0].pk != email_template.pk
+        )
+        self.compiled_templates = dict(
+            (key, compiled_template) for key, compiled_template in self.compiled_templates.items()
+            if key[0] != email_template.pk
+        )
+
+
+email_template_cache = EmailTemplateCache()
+
+
+@receiver([post_save, post_delete], sender=EmailTemplate)
+def invalidate_email_template_cache(sender, instance, **kwargs):
+    email_template_cache.invalidate(instance)
+
 
 class EmailMessageFactory(object):
 
     def __init__(self, email_template):
         self.email_template = email_template
 
-    @classmethod
-    def _render(cls, template, context):
+    def _render(self, template, context):
         for k in context:
-            context[k] = mark_safe(context[k])
-        django_template = Template(template)
+            if isinstance(context[k], six.string_types):
+                context[k] = mark_safe(context[k])
+        django_template = email_template_cache.get_compiled_template(self.email_template.pk, template)
         return django_template.render(Context(context))
 
     def _render_subject(self, context):
@@ -43,6 +133,58 @@ class EmailMessageFactory(object):
         return message
 
 
+def deliver_email_messages(messages, queue_messages):
+    """
+    Send messages now or queue them to be sent by the mailer
+    :param messages: [EmailMessage]: messages to deliver
+    :param queue_messages: bool: when True queue the messages for the mailer instead of sending them
+    """
+    if queue_messages:
+        queue_email_messages([message.id for message in messages])
+    else:
+        for message in messages:
+            sender = EmailMessageSender(message)
+            sender.send()
+
+
+class PendingEmailMessageIds(threading.local):
+    """
+    Ids of email messages queued during the current thread's transaction that have not been published yet.
+    """
+    def __init__(self):
+        self.ids = []
+
+
+pending_email_message_ids = PendingEmailMessageIds()
+
+
+def queue_email_messages(email_message_ids):
+    """
+    Publish email message ids to the mailer queue.
+    Inside a transaction the ids are collected and published together once the transaction commits.
+    :param email_message_ids: [int]: ids of EmailMessages to send
+    """
+    if transaction.get_connection().in_atomic_block:
+        pending_email_message_ids.ids.extend(email_message_ids)
+        transaction.on_commit(publish_pending_email_messages)
+    else:
+        MailerClient().send_many(email_message_ids)
+
+
+def publish_pending_email_messages():
+    """
+    Publish the email message ids collected by queue_email_messages.
+    Ids left behind by a rolled back transaction no longer have a matching EmailMessage and are dropped.
+    """
+    email_message_ids = pending_email_message_ids.ids
+    pending_email_message_ids.ids = []
+    if email_message_ids:
+        existing_ids = list(EmailMessage.objects.filter(pk__in=email_message_ids).order_by('id')
+                            .values_list('id', flat=True))
+        if existing_ids:
+            MailerClient().send_many(existing_ids)
+
+
 class EmailMessageSender(object):
 
     def __init__(self, email_message):
@@ -51,19 +193,7 @@ class EmailMessageSender(object):
     def send(self):
         if self.email_message.state == EmailMessage.MESSAGE_STATE_SENT:
             raise EmailAlreadySentException()
-
-        if self.email_message.bcc_email is not None:
-            bcc = self.email_message.bcc_email.split()
-        else:
-            bcc = None
-
-        django_message = DjangoEmailMessage(
-            self.email_message.subject,
-            self.email_message.body,
-            self.email_message.sender_email,
-            [self.email_message.to_email],
-            bcc=bcc
-        )
+        django_message = make_django_email_message(self.email_message)
         try:
             django_message.send()
             self.email_message.mark_sent()
@@ -72,6 +202,83 @@ class EmailMessageSender(object):
             raise EmailServiceException(e)
 
 
+class EmailMessageBatchSender(object):
+    """
+    Sends NEW email messages and retries failed messages once their next_attempt is reached.
+    Each batch is delivered over a single mail server connection.
+    """
+    def __init__(self, batch_size=None):
+        if batch_size is None:
+            batch_size = settings.BESPIN_MAILER_BATCH_SIZE
+        self.batch_size = batch_size
+
+    def send_pending(self):
+        """
+        Send batches until no NEW or retry-ready email messages remain.
+        :return: (int, int): number of messages sent, number of messages that failed
+        """
+        total_sent_count, total_error_count = 0, 0
+        while True:
+            sent_count, error_count = self.send_batch()
+            if not sent_count and not error_count:
+                return total_sent_count, total_error_count
+            total_sent_count += sent_count
+            total_error_count += error_count
+
+    def send_batch(self):
+        """
+        Claim up to batch_size NEW or retry-ready email messages, send them and record the results.
+        Rows stay locked until the results are recorded so other senders skip over them.
+        :return: (int, int): number of messages sent, number of messages that failed
+        """
+        with transaction.atomic():
+            email_messages = self._claim_batch()
+            errors = self._send_messages(email_messages)
+            self._record_results(email_messages, errors)
+        return len(email_messages) - len(errors), len(errors)
+
+    def _claim_batch(self):
+        sql = CLAIM_EMAIL_MESSAGES_SQL.format(EmailMessage._meta.db_table)
+        params = [EmailMessage.MESSAGE_STATE_NEW, EmailMessage.MESSAGE_STATE_ERROR, timezone.now(), self.batch_size]
+        return list(EmailMessage.objects.raw(sql, params))
+
+    @staticmethod
+    def _send_messages(email_messages):
+        """
+        Send email_messages over one connection.
+        :param email_messages: [EmailMessage]: messages to send
+        :return: dict: error message for each email message id that could not be sent
+        """
+        if not email_messages:
+            return {}
+        connection = get_connection()
+        try:
+            connection.open()
+        except Exception as e:
+            return dict((email_message.id, str(e)) for email_message in email_messages)
+        errors = {}
+        try:
+            for email_message in email_messages:
+                try:
+                    connection.send_messages([make_django_email_message(email_message)])
+                except Exception as e:
+                    errors[email_message.id] = str(e)
+        finally:
+            connection.close()
+        return errors
+
+    @staticmethod
+    def _record_results(email_messages, errors):
+        sent_ids = [email_message.id for email_message in email_messages if email_message.id not in errors]
+        if sent_ids:
+            EmailMessage.objects.filter(pk__in=sent_ids).update(state=EmailMessage.MESSAGE_STATE_SENT, errors='',
+                                                                next_attempt=None)
+        # each failed message gets its own retry time
+        for email_message in email_messages:
+            if email_message.id in errors:
+                email_message.mark_error(errors[email_message.id])
+
+
 class JobMailer(object):
 
     def __init__(self, job, queue_messages=True, sender_email=None):
@@ -81,14 +288,6 @@ class JobMailer(object):
         self.sender_email = sender_email
         self.queue_messages = queue_messages
 
-    def _deliver(self, message):
-        if self.queue_messages:
-            client = MailerClient()
-            client.send(message.id)
-        else:
-            sender = EmailMessageSender(message)
-            sender.send()
-
     def _make_context(self):
         return {
             'id': self.job.id,
@@ -97,24 +296,98 @@ class JobMailer(object):
 
     def _make_message(self, template_name, to_email):
         context = self._make_context()
-        template = EmailTemplate.objects.get(name=template_name)
+        template = email_template_cache.get_email_template(template_name)
         factory = EmailMessageFactory(template)
         return factory.make_message(context, self.sender_email, to_email)
 
-    def mail_current_state(self):
-        messages = []
+    def _current_state_notifications(self):
+        """
+        Determine which templates should be sent to which recipients for the job's current state
+        :return: [(str, str)]: list of template name, to email pairs
+        """
         state = self.job.state
         if state == Job.JOB_STATE_RUNNING:
-            messages.append(self._make_message('job-running-user', self.job.user.email))
+            return [('job-running-user', self.job.user.email)]
         elif state == Job.JOB_STATE_CANCEL:
-            messages.append(self._make_message('job-cancel-user', self.job.user.email))
+            return [('job-cancel-user', self.job.user.email)]
         elif state == Job.JOB_STATE_FINISHED:
-            messages.append(self._make_message('job-finished-user', self.job.user.email))
-            messages.append(self._make_message('job-finished-sharegroup', self.job.share_group.email))
+            return [('job-finished-user', self.job.user.email),
+                    ('job-finished-sharegroup', self.job.share_group.email)]
         elif state == Job.JOB_STATE_ERROR:
-            messages.append(self._make_message('job-error-user', self.job.user.email))
-        for message in messages:
-            self._deliver(message)
+            return [('job-error-user', self.job.user.email)]
+        return []
+
+    def mail_current_state(self):
+        """
+        Notify recipients about the job's current state.
+        When settings.BESPIN_MAILER_DIGEST_SECONDS is set the notifications are saved to be sent as
+        part of a digest email by JobNotificationDigester.
+        """
+        notifications = self._current_state_notifications()
+        if settings.BESPIN_MAILER_DIGEST_SECONDS:
+            JobNotification.objects.bulk_create([
+                JobNotification(job=self.job, job_state=self.job.state, template_name=template_name,
+                                to_email=to_email)
+                for template_name, to_email in notifications
+            ])
+        else:
+            messages = [self._make_message(template_name, to_email) for template_name, to_email in notifications]
+            deliver_email_messages(messages, self.queue_messages)
+
+
+class JobNotificationDigester(object):
+    """
+    Combines the JobNotifications for each recipient into a single digest email once the oldest
+    notification for that recipient is settings.BESPIN_MAILER_DIGEST_SECONDS old.
+    """
+    def __init__(self, sender_email=None):
+        if sender_email is None:
+            sender_email = settings.DEFAULT_FROM_EMAIL
+        self.sender_email = sender_email
+
+    def make_digests(self):
+        """
+        Create NEW EmailMessages for recipients whose notifications are ready to be sent and remove those notifications.
+        A recipient with only one notification receives the usual message for that job state.
+        :return: [EmailMessage]: messages that were created
+        """
+        cutoff = timezone.now() - datetime.timedelta(seconds=settings.BESPIN_MAILER_DIGEST_SECONDS)
+        to_emails = JobNotification.objects.filter(created__lte=cutoff).order_by('to_email') \
+            .values_list('to_email', flat=True).distinct()
+        messages = [self._make_digest(to_email) for to_email in to_emails]
+        return [message for message in messages if message is not None]
+
+    def _make_digest(self, to_email):
+        with transaction.atomic():
+            notifications = list(JobNotification.objects.select_for_update().filter(to_email=to_email)
+                                 .select_related('job').order_by('created'))
+            if not notifications:
+                # another digester already sent these notifications
+                return None
+            if len(notifications) == 1:
+                notification = notifications[0]
+                mailer = JobMailer(notification.job, sender_email=self.sender_email)
+                message = mailer._make_message(notification.template_name, to_email)
+            else:
+                template = email_template_cache.get_email_template(settings.BESPIN_MAILER_DIGEST_TEMPLATE_NAME)
+                factory = EmailMessageFactory(template)
+                message = factory.make_message(self._make_context(notifications), self.sender_email, to_email)
+            JobNotification.objects.filter(pk__in=[notification.pk for notification in notifications]).delete()
+        return message
+
+    @staticmethod
+    def _make_context(notifications):
+        return {
+            'count': len(notifications),
+            'notifications': [
+                {
+                    'id': notification.job.id,
+                    'name': mark_safe(notification.job.name),
+                    'state': notification.get_job_state_display(),
+                }
+                for notification in notifications
+            ]
+        }
 
 
 class MailerConfig(object):
@@ -125,16 +398,48 @@ class MailerConfig(object):
         self.work_queue_config = LandoConnection.objects.first()
 
 
+def make_mailer_payload(send_email_ids):
+    """
+    Create the JSON body published to the mailer queue for a list of email message ids
+    :param send_email_ids: [int]: ids of EmailMessages to send
+    :return: str: JSON payload
+    """
+    return json.dumps({"version": MAILER_PAYLOAD_VERSION, "send_emails": list(send_email_ids)})
+
+
 class MailerClient(object):
     def __init__(self):
         self.config = MailerConfig()
 
     def send(self, send_email_id):
+        self.send_many([send_email_id])
+
+    def send_many(self, send_email_ids):
+        """
+        Publish email message ids to the mailer over a single connection.
+        :param send_email_ids: [int]: ids of EmailMessages to send
+        """
+        bodies = self._make_bodies(send_email_ids)
+        if not bodies:
+            return
         work_queue_connection = WorkQueueConnection(self.config)
-        body = pickle.dumps({"send_email": send_email_id})
         work_queue_connection.connect()
         channel = work_queue_connection.connection.channel()
-        channel.basic_publish(exchange=EMAIL_EXCHANGE,
-                              routing_key=ROUTING_KEY,
-                              body=body)
+        for body in bodies:
+            channel.basic_publish(exchange=EMAIL_EXCHANGE,
+                                  routing_key=ROUTING_KEY,
+                                  body=body)
         work_queue_connection.close()
+
+    @staticmethod
+    def _make_bodies(send_email_ids):
+        """
+        Create message bodies for send_email_ids. Uses one pickled message per id for mailers that only
+        understand the legacy format, otherwise JSON payloads of up to settings.BESPIN_MAILER_BATCH_SIZE ids.
+        """
+        send_email_ids = list(send_email_ids)
+        if settings.BESPIN_MAILER_LEGACY_QUEUE_PAYLOAD:
+            return [pickle.dumps({"send_email": send_email_id}) for send_email_id in send_email_ids]
+        batch_size = settings.BESPIN_MAILER_BATCH_SIZE
+        return [make_mailer_payload(send_email_ids[i:i + batch_size])
+                for i in range(0, len(send_email_ids), batch_size)]
@@ -0,0 +1,59 @@
+from django.core.management.base import BaseCommand, CommandError
+from argparse import FileType
+from data.importers import BulkWorkflowImporter
+from data.serializers import AdminImportWorkflowQuestionnaireSerializer
+import yaml
+
+
+class Command(BaseCommand):
+    help = 'Imports workflow versions and questionnaires listed in a YAML or JSON manifest. ' \
+           'Each entry has the fields used by the admin import-workflow-questionnaire endpoint. ' \
+           'Will not alter existing model objects if they exist.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('manifest', type=FileType('r'), help='YAML or JSON file containing a list of import specs')
+        parser.add_argument('--workers', type=int, default=None,
+                            help='Number of processes used to parse CWL documents (defaults to the number of CPUs)')
+
+    def handle(self, *args, **options):
+        specs = self.read_specs(options['manifest'])
+        importer = BulkWorkflowImporter(specs, max_workers=options['workers'])
+        results = importer.run()
+        for result in results:
+            spec = result.spec
+            name = "{} v{} '{}'".format(spec['workflow_tag'], spec['workflow_version_number'], spec['name'])
+            prepare_seconds = result.prepare_seconds or 0
+            if not result.succeeded:
+                self.stderr.write("{} failed: {}".format(name, result.error))
+            elif result.skipped:
+                self.stdout.write("{} unchanged, skipped".format(name))
+            elif result.created_job_questionnaire:
+                self.stdout.write("{} imported (parsed in {:.1f}s)".format(name, prepare_seconds))
+            else:
+                self.stdout.write("{} already imported (parsed in {:.1f}s)".format(name, prepare_seconds))
+        timings = importer.timings
+        failed_count = len([result for result in results if not result.succeeded])
+        self.stdout.write("Processed {} specs, {} failed in {:.1f}s: parsing {:.1f}s, templates {:.1f}s, "
+                          "citations {:.1f}s, saving {:.1f}s".format(len(results), failed_count, timings['total'],
+                                                                     timings['prepare'], timings['templates'],
+                                                                     timings['citations'], timings['save']))
+        if failed_count:
+            raise CommandError("{} specs failed to import".format(failed_count))
+
+    @staticmethod
+    def read_specs(manifest_file):
+        """
+        Read and validate the import specs in manifest_file (JSON is a subset of YAML so both are supported)
+        :param manifest_file: file: manifest to read
+        :return: [dict]: validated import specs
+        """
+        manifest = yaml.safe_load(manifest_file)
+        if not isinstance(manifest, list):
+            raise CommandError("Manifest must contain a list of import specs")
+        specs = []
+        for index, spec in enumerate(manifest):
+            serializer = AdminImportWorkflowQuestionnaireSerializer(data=spec)
+            if not serializer.is_valid():
+                raise CommandError("Invalid import spec at index {}: {}".format(index, serializer.errors))
+            specs.append(serializer.validated_data)
+        return specs
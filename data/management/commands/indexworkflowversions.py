@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from data.importers import CWLDocument, save_workflow_version_steps
+from data.models import WorkflowVersion
+
+
+class Command(BaseCommand):
+    help = 'Records the steps, tools, docker images and software packages of workflow versions imported ' \
+           'before workflow structure was indexed.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true',
+                            help='Index all workflow versions instead of only those without steps')
+
+    def handle(self, *args, **options):
+        workflow_versions = WorkflowVersion.objects.all()
+        if not options['all']:
+            workflow_versions = workflow_versions.filter(steps__isnull=True)
+        failed_count = 0
+        for workflow_version in workflow_versions:
+            try:
+                steps = CWLDocument(workflow_version.url).extract_steps()
+                with transaction.atomic():
+                    save_workflow_version_steps(workflow_version, steps)
+                self.stdout.write("{} indexed {} steps".format(workflow_version, len(steps)))
+            except Exception as e:
+                failed_count += 1
+                self.stderr.write("{} failed: {}".format(workflow_version, e))
+        if failed_count:
+            raise CommandError("{} workflow versions failed to index".format(failed_count))
@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+from argparse import FileType
+from data.importers import ArtifactMirror, ArtifactPrefetcher
+from data.management.commands.importworkflows import Command as ImportWorkflowsCommand
+
+
+class Command(BaseCommand):
+    help = 'Downloads the CWL documents, methods templates and DOI citations used by the import specs in a manifest ' \
+           'into an artifact mirror so they can be imported without network access. ' \
+           'CWL documents must be packed to be loaded from the mirror.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('manifest', type=FileType('r'), help='YAML or JSON file containing a list of import specs')
+        parser.add_argument('--mirror-dir', default=settings.BESPIN_ARTIFACT_MIRROR_DIR,
+                            help='Directory of the artifact mirror (defaults to BESPIN_ARTIFACT_MIRROR_DIR)')
+        parser.add_argument('--refresh', action='store_true',
+                            help='Download artifacts again even when they are already in the mirror')
+
+    def handle(self, *args, **options):
+        if not options['mirror_dir']:
+            raise CommandError("Either --mirror-dir or BESPIN_ARTIFACT_MIRROR_DIR is required")
+        specs = ImportWorkflowsCommand.read_specs(options['manifest'])
+        prefetcher = ArtifactPrefetcher(ArtifactMirror(options['mirror_dir']), refresh=options['refresh'])
+        failed_count = 0
+        for spec in specs:
+            try:
+                fetched = prefetcher.prefetch(spec)
+                self.stdout.write("{} prefetched, {} artifacts downloaded".format(spec['cwl_url'], len(fetched)))
+            except Exception as e:
+                failed_count += 1
+                self.stderr.write("{} failed: {}".format(spec['cwl_url'], e))
+        if failed_count:
+            raise CommandError("{} specs failed to prefetch".format(failed_count))
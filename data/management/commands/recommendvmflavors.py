@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand
+from data.jobusage import VMFlavorUsageReport
+from data.models import WorkflowVersion
+
+
+class Command(BaseCommand):
+    help = 'Reports VM hours and CPU hours of finished jobs per workflow version and VM flavor. ' \
+           'Recommends the flavor using the fewest CPU hours whose percentile runtime meets --target-hours.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('target_hours', type=float,
+                            help='Runtime in hours the percentile of jobs should finish within')
+        parser.add_argument('--percentile', type=float, default=0.9,
+                            help='Fraction (0-1) of jobs that should finish within target_hours')
+        parser.add_argument('--min-jobs', type=int, default=1,
+                            help='Minimum finished jobs for a workflow version and flavor to be considered')
+        parser.add_argument('--workflow-version', type=int, action='append', dest='workflow_version_ids',
+                            help='Workflow version id to report on, may be repeated')
+
+    def handle(self, **options):
+        report = VMFlavorUsageReport(percentile=options['percentile'], min_jobs=options['min_jobs'],
+                                     workflow_version_ids=options['workflow_version_ids'])
+        recommendations = report.get_recommendations(options['target_hours'])
+        workflow_versions = WorkflowVersion.objects.in_bulk(
+            [recommendation.workflow_version_id for recommendation in recommendations])
+        for recommendation in recommendations:
+            workflow_version = workflow_versions[recommendation.workflow_version_id]
+            self.stdout.write("Workflow version {}: {}".format(workflow_version.id, workflow_version.description))
+            for usage in recommendation.usages:
+                self.stdout.write("  {} ({} cpus): {} jobs, median {:.2f} VM hours, p{:g} {:.2f} VM hours, "
+                                  "mean {:.2f} CPU hours".format(usage.vm_flavor_name, usage.cpus, usage.job_count,
+                                                                 usage.median_vm_hours, options['percentile'] * 100,
+                                                                 usage.percentile_vm_hours, usage.mean_cpu_hours))
+            if recommendation.meets_target:
+                self.stdout.write("  Recommended flavor: {}".format(recommendation.vm_flavor_name))
+            else:
+                self.stdout.write("  No flavor meets the target, fastest flavor: {}".format(
+                    recommendation.vm_flavor_name))
@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+from django.conf import settings
+from data.importers import WorkflowImportTaskRunner
+import time
+
+
+class Command(BaseCommand):
+    help = 'Runs workflow import tasks created by the admin workflow-import-tasks endpoint, ' \
+           'checking for new tasks until stopped.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--poll-seconds', type=float, default=settings.BESPIN_IMPORT_TASK_POLL_SECONDS,
+                            help='Seconds to wait between checks for new tasks')
+        parser.add_argument('--once', action='store_true', help='Exit after running all pending tasks')
+
+    def handle(self, **options):
+        runner = WorkflowImportTaskRunner()
+        while True:
+            task = runner.run_next()
+            while task:
+                self.stdout.write("Import task {} {}".format(task.id, task.get_state_display().lower()))
+                task = runner.run_next()
+            if options['once']:
+                break
+            time.sleep(options['poll_seconds'])
@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand
+from django.conf import settings
+from data.mailer import EmailMessageBatchSender, JobNotificationDigester
+import time
+
+
+class Command(BaseCommand):
+    help = 'Sends NEW email messages in batches, checking for new messages until stopped. ' \
+           'Failed messages are retried with exponential backoff until BESPIN_MAILER_MAX_ATTEMPTS is reached. ' \
+           'Also creates digest emails when BESPIN_MAILER_DIGEST_SECONDS is set.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=settings.BESPIN_MAILER_BATCH_SIZE,
+                            help='Number of messages to send over a single mail server connection')
+        parser.add_argument('--poll-seconds', type=float, default=settings.BESPIN_MAILER_POLL_SECONDS,
+                            help='Seconds to wait between checks for new messages')
+        parser.add_argument('--once', action='store_true', help='Exit after sending all pending messages')
+
+    def handle(self, **options):
+        sender = EmailMessageBatchSender(batch_size=options['batch_size'])
+        while True:
+            if settings.BESPIN_MAILER_DIGEST_SECONDS:
+                digests = JobNotificationDigester().make_digests()
+                if digests:
+                    self.stdout.write("Created {} digest email messages".format(len(digests)))
+            sent_count, error_count = sender.send_pending()
+            if sent_count or error_count:
+                self.stdout.write("Sent {} email messages, {} failed".format(sent_count, error_count))
+            if options['once']:
+                break
+            time.sleep(options['poll_seconds'])
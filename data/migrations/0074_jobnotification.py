@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.1 on 2026-10-19 12:00
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('data', '0073_workflowversion_enable_ui'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='JobNotification',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('job_state', models.CharField(choices=[('N', 'New'), ('A', 'Authorized'), ('S', 'Starting'), ('R', 'Running'), ('F', 'Finished'), ('E', 'Error'), ('c', 'Canceling'), ('C', 'Canceled'), ('r', 'Restarting'), ('D', 'Deleted')], help_text='State of the job when the notification was made', max_length=1)),
+                ('template_name', models.CharField(help_text='Name of the EmailTemplate to use when sent as a single message', max_length=255)),
+                ('to_email', models.EmailField(help_text='Email address of the recipient', max_length=254)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('job', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='notifications', to='data.Job')),
+            ],
+            options={
+                'ordering': ['created'],
+            },
+        ),
+    ]
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.1 on 2026-10-19 13:00
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('data', '0074_jobnotification'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='emailmessage',
+            name='attempts',
+            field=models.IntegerField(default=0, help_text='Number of failed attempts to send this message'),
+        ),
+        migrations.AddField(
+            model_name='emailmessage',
+            name='next_attempt',
+            field=models.DateTimeField(blank=True, help_text='When a message in the error state will be sent again', null=True),
+        ),
+        migrations.AlterField(
+            model_name='emailmessage',
+            name='state',
+            field=models.TextField(choices=[('N', 'New'), ('S', 'Sent'), ('E', 'Error'), ('D', 'Dead')], default='N'),
+        ),
+    ]
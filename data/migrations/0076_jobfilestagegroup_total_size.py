@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.1 on 2026-10-19 14:00
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.db.models import Sum
+
+
+def populate_stage_group_total_size(apps, schema_editor):
+    JobFileStageGroup = apps.get_model("data", "JobFileStageGroup")
+    DDSJobInputFile = apps.get_model("data", "DDSJobInputFile")
+    URLJobInputFile = apps.get_model("data", "URLJobInputFile")
+    total_sizes = {}
+    for file_model in [DDSJobInputFile, URLJobInputFile]:
+        for row in file_model.objects.values('stage_group').annotate(files_size=Sum('size')).order_by():
+            total_sizes[row['stage_group']] = total_sizes.get(row['stage_group'], 0) + row['files_size']
+    for stage_group_id, total_size in total_sizes.items():
+        JobFileStageGroup.objects.filter(pk=stage_group_id).update(total_size=total_size)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('data', '0075_emailmessage_retry'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='jobfilestagegroup',
+            name='total_size',
+            field=models.BigIntegerField(default=0, help_text='Total size in bytes of the files in this stage group, updated as files are saved or deleted'),
+        ),
+        migrations.RunPython(populate_stage_group_total_size, migrations.RunPython.noop),
+    ]
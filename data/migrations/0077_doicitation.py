@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.1 on 2026-10-19 15:00
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('data', '0076_jobfilestagegroup_total_size'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DOICitation',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('doi', models.CharField(help_text='DOI name (without the https://dx.doi.org/ prefix)', max_length=255, unique=True)),
+                ('apa_citation', models.TextField(help_text='Citation for the DOI in APA style')),
+                ('created', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+    ]
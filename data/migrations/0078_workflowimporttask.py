@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.1 on 2026-10-19 16:00
+from __future__ import unicode_literals
+
+from django.conf import settings
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('data', '0077_doicitation'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WorkflowImportTask',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('spec', django.contrib.postgres.fields.jsonb.JSONField(help_text='Import fields as posted to the admin import-workflow-questionnaire endpoint')),
+                ('state', models.CharField(choices=[('N', 'New'), ('R', 'Running'), ('F', 'Finished'), ('E', 'Error')], default='N', max_length=1)),
+                ('stage', models.CharField(blank=True, help_text='Import stage currently running', max_length=255)),
+                ('stage_timings', django.contrib.postgres.fields.jsonb.JSONField(default=dict, help_text='Seconds taken by each finished import stage')),
+                ('error', models.TextField(blank=True, help_text='Details about why the import failed')),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('started', models.DateTimeField(blank=True, null=True)),
+                ('finished', models.DateTimeField(blank=True, null=True)),
+                ('job_questionnaire', models.ForeignKey(blank=True, help_text='Questionnaire created by the import', null=True, on_delete=django.db.models.deletion.SET_NULL, to='data.JobQuestionnaire')),
+                ('user', models.ForeignKey(help_text='User who requested the import', null=True, on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['created'],
+            },
+        ),
+    ]
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.1 on 2026-10-19 17:00
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('data', '0078_workflowimporttask'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='workflowversion',
+            name='content_hash',
+            field=models.CharField(blank=True, default='', help_text='SHA-256 of the packed CWL workflow file when it was imported.', max_length=64),
+        ),
+        migrations.AddField(
+            model_name='workflowmethodsdocument',
+            name='template_hash',
+            field=models.CharField(blank=True, default='', help_text='SHA-256 of the Jinja template the contents were rendered from.', max_length=64),
+        ),
+    ]
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.1 on 2026-10-19 18:00
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('data', '0079_workflow_content_hashes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WorkflowVersionStep',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('step_id', models.CharField(help_text='Id of the step in the packed workflow', max_length=255)),
+                ('tool_id', models.CharField(blank=True, help_text='Id of the tool run by the step', max_length=255)),
+                ('tool_class', models.CharField(blank=True, help_text='CWL class of the tool run by the step (e.g. CommandLineTool)', max_length=255)),
+                ('docker_image', models.CharField(blank=True, db_index=True, help_text='Image from the DockerRequirement of the tool', max_length=255)),
+                ('workflow_version', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='steps', to='data.WorkflowVersion')),
+            ],
+            options={
+                'ordering': ['workflow_version', 'id'],
+            },
+        ),
+        migrations.CreateModel(
+            name='WorkflowVersionPackage',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('package', models.CharField(db_index=True, help_text='Name of the software package', max_length=255)),
+                ('version', models.CharField(blank=True, help_text='Version of the software package', max_length=255)),
+                ('citation', models.TextField(blank=True, help_text='Citation URL for the software package')),
+                ('step', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='packages', to='data.WorkflowVersionStep')),
+                ('workflow_version', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='packages', to='data.WorkflowVersion')),
+            ],
+            options={
+                'ordering': ['workflow_version', 'package', 'id'],
+            },
+        ),
+    ]
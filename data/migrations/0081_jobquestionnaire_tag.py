@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.1 on 2026-10-19 19:00
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def populate_questionnaire_tags(apps, schema_editor):
+    # Historical models do not have make_tag() so the tag format is repeated here
+    JobQuestionnaire = apps.get_model('data', 'JobQuestionnaire')
+    for questionnaire in JobQuestionnaire.objects.select_related('workflow_version__workflow', 'type'):
+        questionnaire.tag = '{}/v{}/{}'.format(questionnaire.workflow_version.workflow.tag,
+                                               questionnaire.workflow_version.version,
+                                               questionnaire.type.tag)
+        questionnaire.save(update_fields=['tag'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('data', '0080_workflowversionstep_workflowversionpackage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='jobquestionnaire',
+            name='tag',
+            field=models.CharField(blank=True, db_index=True, editable=False, help_text='Tag of the questionnaire (<workflow tag>/v<version>/<type tag>), set from the workflow version and type on save', max_length=255),
+        ),
+        migrations.RunPython(populate_questionnaire_tags, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.1 on 2026-10-19 21:00
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('data', '0081_jobquestionnaire_tag'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='job',
+            name='volume_size_predicted',
+            field=models.BooleanField(default=False, help_text='True when volume_size was predicted from the disk usage of previous jobs instead of the vm strategy settings'),
+        ),
+        migrations.AddField(
+            model_name='job',
+            name='volume_size_used',
+            field=models.IntegerField(blank=True, help_text='Size in GB of the volume this job used, reported by the worker when the job finishes', null=True),
+        ),
+    ]
@@ -1,8 +1,14 @@
-from django.db import models
+from django.db import models, transaction
 from django.conf import settings
 from django.core.exceptions import ValidationError
+from django.utils import timezone
 from django.contrib.postgres.fields import JSONField
+from django.db.models import F
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
 from gcb_web_auth.models import DDSUserCredential, DDSEndpoint
+import datetime
+import random
 import json
 
 
@@ -45,6 +51,8 @@ class WorkflowVersion(models.Model):
     fields = JSONField(help_text="Array of fields required by this workflow.")
     enable_ui = models.BooleanField(default=True,
                                     help_text="Should this workflow version be enabled in the web portal.")
+    content_hash = models.CharField(max_length=64, blank=True, default='',
+                                    help_text="SHA-256 of the packed CWL workflow file when it was imported.")
 
     class Meta:
         ordering = ['version']
@@ -61,20 +69,152 @@ class WorkflowMethodsDocument(models.Model):
     workflow_version = models.OneToOneField(WorkflowVersion, on_delete=models.CASCADE,
                                             related_name='methods_document')
     content = models.TextField(help_text="Methods document contents in markdown.")
+    template_hash = models.CharField(max_length=64, blank=True, default='',
+                                     help_text="SHA-256 of the Jinja template the contents were rendered from.")
 
     def __str__(self):
         return "WorkflowMethodsDocument - pk: {} workflow_version.pk".format(self.pk, self.workflow_version.pk,)
 
 
+class WorkflowVersionStep(models.Model):
+    """
+    Step of a WorkflowVersion and the tool it runs, recorded when the workflow version is imported
+    so the structure of workflows can be queried without parsing CWL.
+    """
+    workflow_version = models.ForeignKey(WorkflowVersion, on_delete=models.CASCADE, related_name='steps')
+    step_id = models.CharField(max_length=255, help_text="Id of the step in the packed workflow")
+    tool_id = models.CharField(max_length=255, blank=True, help_text="Id of the tool run by the step")
+    tool_class = models.CharField(max_length=255, blank=True,
+                                  help_text="CWL class of the tool run by the step (e.g. CommandLineTool)")
+    docker_image = models.CharField(max_length=255, blank=True, db_index=True,
+                                    help_text="Image from the DockerRequirement of the tool")
+
+    class Meta:
+        ordering = ['workflow_version', 'id']
+
+    def __str__(self):
+        return "WorkflowVersionStep - pk: {} workflow_version.pk: {} step_id: {}".format(
+            self.pk, self.workflow_version.pk, self.step_id)
+
+
+class WorkflowVersionPackage(models.Model):
+    """
+    Software package version listed in a SoftwareRequirement of a WorkflowVersionStep.
+    """
+    workflow_version = models.ForeignKey(WorkflowVersion, on_delete=models.CASCADE, related_name='packages')
+    step = models.ForeignKey(WorkflowVersionStep, on_delete=models.CASCADE, related_name='packages')
+    package = models.CharField(max_length=255, db_index=True, help_text="Name of the software package")
+    version = models.CharField(max_length=255, blank=True, help_text="Version of the software package")
+    citation = models.TextField(blank=True, help_text="Citation URL for the software package")
+
+    class Meta:
+        ordering = ['workflow_version', 'package', 'id']
+
+    def __str__(self):
+        return "WorkflowVersionPackage - pk: {} workflow_version.pk: {} package: {} version: {}".format(
+            self.pk, self.workflow_version.pk, self.package, self.version)
+
+
+class DOICitation(models.Model):
+    """
+    APA citation resolved for a DOI, used when building methods documents.
+    """
+    doi = models.CharField(max_length=255, unique=True, help_text="DOI name (without the https://dx.doi.org/ prefix)")
+    apa_citation = models.TextField(help_text="Citation for the DOI in APA style")
+    created = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return "DOICitation - pk: {} doi: '{}'".format(self.pk, self.doi)
+
+
 class JobFileStageGroup(models.Model):
     """
     Group of files to stage for a job
     """
     user = models.ForeignKey(settings.AUTH_USER_MODEL)
+    total_size = models.BigIntegerField(default=0,
+                                        help_text='Total size in bytes of the files in this stage group, '
+                                                  'updated as files are saved or deleted')
 
     def __str__(self):
         return "JobFileStageGroup - pk: {} user: '{}'".format(self.pk, self.user,)
 
+    def calculate_total_size(self):
+        """
+        Sum the size of the dds and url files in this stage group with a single database query.
+        :return: int: size in bytes
+        """
+        return JobFileStageGroup.calculate_total_sizes([self.pk])[self.pk]
+
+    @staticmethod
+    def calculate_total_sizes(stage_group_ids):
+        """
+        Sum the size of the dds and url files in each of the stage groups with a single database query.
+        The sums are separate subqueries since joining both file tables would count each file more than once.
+        :param stage_group_ids: [int]: ids of the stage groups to total
+        :return: dict: size in bytes for each stage group id
+        """
+        file_size_sql = "SELECT COALESCE(SUM(size), 0) FROM {} WHERE stage_group_id = {}.id"
+        stage_group_table = JobFileStageGroup._meta.db_table
+        total_size_sql = "({}) + ({})".format(
+            file_size_sql.format(DDSJobInputFile._meta.db_table, stage_group_table),
+            file_size_sql.format(URLJobInputFile._meta.db_table, stage_group_table),
+        )
+        queryset = JobFileStageGroup.objects.filter(pk__in=stage_group_ids).extra(select={'files_size': total_size_sql})
+        return dict((pk, int(files_size)) for pk, files_size in queryset.values_list('pk', 'files_size'))
+
+    def update_total_size(self):
+        """
+        Recalculate and save total_size from the files in this stage group
+        """
+        self.total_size = self.calculate_total_size()
+        JobFileStageGroup.objects.filter(pk=self.pk).update(total_size=self.total_size)
+
+    @staticmethod
+    def add_to_total_size(stage_group_id, size):
+        """
+        Atomically add size to total_size in the database so concurrent file changes are not lost
+        :param stage_group_id: int: id of the stage group to update
+        :param size: int: bytes to add, negative to subtract
+        """
+        if size:
+            JobFileStageGroup.objects.filter(pk=stage_group_id).update(total_size=F('total_size') + size)
+
+    @staticmethod
+    def save_file(input_file, save_func):
+        """
+        Save a dds or url file and move its size between stage group totals.
+        Handles new files, size changes and files reassigned to a different stage group.
+        :param input_file: DDSJobInputFile or URLJobInputFile: file to save
+        :param save_func: function: saves input_file to the database
+        """
+        previous = None
+        if input_file.pk:
+            previous = type(input_file).objects.filter(pk=input_file.pk).values_list('stage_group_id', 'size').first()
+        with transaction.atomic():
+            save_func()
+            if previous:
+                previous_stage_group_id, previous_size = previous
+                if previous_stage_group_id == input_file.stage_group_id:
+                    JobFileStageGroup.add_to_total_size(input_file.stage_group_id, input_file.size - previous_size)
+                    return
+                JobFileStageGroup.add_to_total_size(previous_stage_group_id, -previous_size)
+            JobFileStageGroup.add_to_total_size(input_file.stage_group_id, input_file.size)
+
+    def add_files(self, dds_files, url_files):
+        """
+        Insert many files into this stage group with one query per file type and update total_size once.
+        :param dds_files: [DDSJobInputFile]: unsaved dds files to add
+        :param url_files: [URLJobInputFile]: unsaved url files to add
+        """
+        for input_file in dds_files + url_files:
+            input_file.stage_group = self
+        with transaction.atomic():
+            DDSJobInputFile.objects.bulk_create(dds_files)
+            URLJobInputFile.objects.bulk_create(url_files)
+            JobFileStageGroup.add_to_total_size(self.pk, sum(input_file.size for input_file in dds_files + url_files))
+        self.refresh_from_db(fields=['total_size'])
+
 
 class JobToken(models.Model):
     """
@@ -229,6 +369,12 @@ class Job(models.Model):
                                      help_text='Token that allows permission for a job to be run')
     volume_size = models.IntegerField(default=100,
                                       help_text='Size in GB of volume created for running this job')
+    volume_size_predicted = models.BooleanField(default=False,
+                                                help_text='True when volume_size was predicted from the disk usage '
+                                                          'of previous jobs instead of the vm strategy settings')
+    volume_size_used = models.IntegerField(null=True, blank=True,
+                                           help_text='Size in GB of the volume this job used, reported by the worker '
+                                                     'when the job finishes')
     share_group = models.ForeignKey(ShareGroup,
                                     help_text='Users who will have job output shared with them')
     cleanup_vm = models.BooleanField(default=True,
@@ -237,12 +383,15 @@ class Job(models.Model):
                                         help_text='JSON-encoded dictionary of volume mounts, e.g. {"/dev/vdb1": "/work"}')
 
     def save(self, *args, **kwargs):
-        if self.stage_group is not None and self.stage_group.user != self.user:
-            raise ValidationError('stage group user does not match job user')
+        self.check_stage_group_user()
         super(Job, self).save(*args, **kwargs)
         if self.should_create_activity():
             JobActivity.objects.create(job=self, state=self.state, step=self.step)
 
+    def check_stage_group_user(self):
+        if self.stage_group is not None and self.stage_group.user != self.user:
+            raise ValidationError('stage group user does not match job user')
+
     def should_create_activity(self):
         job_activities = JobActivity.objects.filter(job=self).order_by('-created')
         if not job_activities:
@@ -354,12 +503,30 @@ class JobQuestionnaire(models.Model):
     volume_mounts = models.TextField(default=json.dumps({'/dev/vdb1': '/work'}),
                                      help_text='JSON-encoded dictionary of volume mounts, e.g. {"/dev/vdb1": "/work"}')
     type = models.ForeignKey(JobQuestionnaireType, help_text='Type of questionnaire')
+    tag = models.CharField(max_length=255, blank=True, db_index=True, editable=False,
+                           help_text='Tag of the questionnaire (<workflow tag>/v<version>/<type tag>), '
+                                     'set from the workflow version and type on save')
+
+    def save(self, *args, **kwargs):
+        self.tag = self.make_tag()
+        super(JobQuestionnaire, self).save(*args, **kwargs)
 
     def make_tag(self):
         workflow_tag = self.workflow_version.workflow.tag
         workflow_version_num = self.workflow_version.version
         return '{}/v{}/{}'.format(workflow_tag, workflow_version_num, self.type.tag)
 
+    @staticmethod
+    def update_tags(questionnaires):
+        """
+        Update the stored tags of questionnaires after a workflow, workflow version or type they use changed
+        :param questionnaires: QuerySet: questionnaires to update
+        """
+        for questionnaire in questionnaires.select_related('workflow_version__workflow', 'type'):
+            tag = questionnaire.make_tag()
+            if questionnaire.tag != tag:
+                JobQuestionnaire.objects.filter(pk=questionnaire.pk).update(tag=tag)
+
     @staticmethod
     def split_tag_parts(tag):
         """
@@ -375,7 +542,7 @@ class JobQuestionnaire(models.Model):
         return workflow_tag, version_num, questionnaire_type_tag
 
     def __str__(self):
-        return "JobQuestionnaire - pk: {} tag: '{}' name: '{}'".format(self.pk, self.make_tag(), self.name, )
+        return "JobQuestionnaire - pk: {} tag: '{}' name: '{}'".format(self.pk, self.tag, self.name, )
 
 
 class JobAnswerSet(models.Model):
@@ -428,6 +595,9 @@ class DDSJobInputFile(models.Model):
         return "DDSJobInputFile - pk: {} stage_group.pk: {} destination_path: '{}' size: {}".\
             format(self.pk, self.stage_group.pk, self.destination_path, self.size,)
 
+    def save(self, *args, **kwargs):
+        JobFileStageGroup.save_file(self, lambda: super(DDSJobInputFile, self).save(*args, **kwargs))
+
 
 class URLJobInputFile(models.Model):
     """
@@ -451,6 +621,9 @@ class URLJobInputFile(models.Model):
         return "URLJobInputFile - pk {} stage_group.pk: {} url: '{}' destination_path: '{}' size: {}". \
             format(self.pk, self.stage_group.pk, self.url, self.destination_path, self.size, )
 
+    def save(self, *args, **kwargs):
+        JobFileStageGroup.save_file(self, lambda: super(URLJobInputFile, self).save(*args, **kwargs))
+
 
 class EmailTemplate(models.Model):
     """
@@ -472,10 +645,12 @@ class EmailMessage(models.Model):
     MESSAGE_STATE_NEW = 'N'
     MESSAGE_STATE_SENT = 'S'
     MESSAGE_STATE_ERROR = 'E'
+    MESSAGE_STATE_DEAD = 'D'
     MESSAGE_STATES = (
         (MESSAGE_STATE_NEW, 'New'),
         (MESSAGE_STATE_SENT, 'Sent'),
         (MESSAGE_STATE_ERROR, 'Error'),
+        (MESSAGE_STATE_DEAD, 'Dead'),
     )
 
     body = models.TextField(help_text='Text of the message body')
@@ -485,19 +660,68 @@ class EmailMessage(models.Model):
     bcc_email = models.TextField(blank=True, help_text='space-separated Email addresses to bcc')
     state = models.TextField(choices=MESSAGE_STATES, default=MESSAGE_STATE_NEW)
     errors = models.TextField(blank=True)
+    attempts = models.IntegerField(default=0, help_text='Number of failed attempts to send this message')
+    next_attempt = models.DateTimeField(null=True, blank=True,
+                                        help_text='When a message in the error state will be sent again')
 
     def __str__(self):
         return "EmailMessage - pk: {}: state: '{}' subject: '{}'".format(self.pk, self.get_state_display(), self.subject,)
 
     def mark_sent(self):
         self.state = self.MESSAGE_STATE_SENT
+        self.next_attempt = None
         self.save()
 
     def mark_error(self, errors):
-        self.state = self.MESSAGE_STATE_ERROR
+        """
+        Record a failed attempt to send this message. The message is scheduled to be retried with exponential
+        backoff until settings.BESPIN_MAILER_MAX_ATTEMPTS is reached, then moved to the dead state.
+        :param errors: str: details about the failure
+        """
+        self.attempts += 1
         self.errors = errors
+        if self.attempts >= settings.BESPIN_MAILER_MAX_ATTEMPTS:
+            self.state = self.MESSAGE_STATE_DEAD
+            self.next_attempt = None
+        else:
+            self.state = self.MESSAGE_STATE_ERROR
+            retry_seconds = self.retry_delay_seconds(self.attempts)
+            self.next_attempt = timezone.now() + datetime.timedelta(seconds=retry_seconds)
         self.save()
 
+    @staticmethod
+    def retry_delay_seconds(attempts):
+        """
+        Seconds to wait before retrying a message that has failed attempts times.
+        Doubles with each attempt up to settings.BESPIN_MAILER_RETRY_MAX_SECONDS, with random jitter so
+        messages that failed together are not all retried at the same moment.
+        :param attempts: int: number of failed attempts so far
+        :return: float: seconds to wait
+        """
+        delay = min(settings.BESPIN_MAILER_RETRY_BASE_SECONDS * 2 ** (attempts - 1),
+                    settings.BESPIN_MAILER_RETRY_MAX_SECONDS)
+        return random.uniform(delay / 2.0, delay)
+
+
+class JobNotification(models.Model):
+    """
+    Job state change notification waiting to be sent as part of a digest email
+    """
+    job = models.ForeignKey(Job, on_delete=models.CASCADE, related_name='notifications')
+    job_state = models.CharField(max_length=1, choices=Job.JOB_STATES,
+                                 help_text="State of the job when the notification was made")
+    template_name = models.CharField(max_length=255,
+                                     help_text='Name of the EmailTemplate to use when sent as a single message')
+    to_email = models.EmailField(help_text='Email address of the recipient')
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['created']
+
+    def __str__(self):
+        return "JobNotification - pk: {} job.pk: {} to_email: '{}' template_name: '{}'".format(
+            self.pk, self.job.pk, self.to_email, self.template_name)
+
 
 class VMStrategy(models.Model):
     """
@@ -541,3 +765,64 @@ class WorkflowConfiguration(models.Model):
 
     def __str__(self):
         return "WorkflowConfiguration - pk: {}".format(self.pk)
+
+
+class WorkflowImportTask(models.Model):
+    """
+    Request to import a workflow version and questionnaire, run by the runimporttasks command
+    """
+    STATE_NEW = 'N'
+    STATE_RUNNING = 'R'
+    STATE_FINISHED = 'F'
+    STATE_ERROR = 'E'
+    STATES = (
+        (STATE_NEW, 'New'),
+        (STATE_RUNNING, 'Running'),
+        (STATE_FINISHED, 'Finished'),
+        (STATE_ERROR, 'Error'),
+    )
+
+    spec = JSONField(help_text="Import fields as posted to the admin import-workflow-questionnaire endpoint")
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, null=True, on_delete=models.SET_NULL,
+                             help_text='User who requested the import')
+    state = models.CharField(max_length=1, choices=STATES, default=STATE_NEW)
+    stage = models.CharField(max_length=255, blank=True, help_text="Import stage currently running")
+    stage_timings = JSONField(default=dict, help_text="Seconds taken by each finished import stage")
+    error = models.TextField(blank=True, help_text="Details about why the import failed")
+    job_questionnaire = models.ForeignKey(JobQuestionnaire, null=True, blank=True, on_delete=models.SET_NULL,
+                                          help_text="Questionnaire created by the import")
+    created = models.DateTimeField(auto_now_add=True)
+    started = models.DateTimeField(null=True, blank=True)
+    finished = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['created']
+
+    def __str__(self):
+        return "WorkflowImportTask - pk: {} state: '{}' stage: '{}'".format(self.pk, self.get_state_display(),
+                                                                            self.stage)
+
+
+@receiver(post_delete, sender=DDSJobInputFile)
+@receiver(post_delete, sender=URLJobInputFile)
+def subtract_deleted_file_size(sender, instance, **kwargs):
+    # post_delete also runs for queryset and cascade deletes that skip Model.delete
+    JobFileStageGroup.add_to_total_size(instance.stage_group_id, -instance.size)
+
+
+@receiver(post_save, sender=Workflow)
+def update_workflow_questionnaire_tags(sender, instance, created, **kwargs):
+    if not created:
+        JobQuestionnaire.update_tags(JobQuestionnaire.objects.filter(workflow_version__workflow=instance))
+
+
+@receiver(post_save, sender=WorkflowVersion)
+def update_workflow_version_questionnaire_tags(sender, instance, created, **kwargs):
+    if not created:
+        JobQuestionnaire.update_tags(instance.questionnaires.all())
+
+
+@receiver(post_save, sender=JobQuestionnaireType)
+def update_questionnaire_type_tags(sender, instance, created, **kwargs):
+    if not created:
+        JobQuestionnaire.update_tags(JobQuestionnaire.objects.filter(type=instance))
@@ -3,7 +3,8 @@ from django.contrib.auth.models import User
 from data.models import Workflow, WorkflowVersion, Job, DDSJobInputFile, JobFileStageGroup, \
     DDSEndpoint, DDSUserCredential, JobDDSOutputProject, URLJobInputFile, JobError, JobAnswerSet, \
     JobQuestionnaire, VMFlavor, VMProject, JobToken, ShareGroup, DDSUser, WorkflowMethodsDocument, \
-    EmailTemplate, EmailMessage, VMSettings, CloudSettings, JobActivity
+    EmailTemplate, EmailMessage, VMSettings, CloudSettings, JobActivity, WorkflowImportTask, WorkflowVersionStep, \
+    WorkflowVersionPackage
 from data.jobusage import JobUsage
 from rest_framework.authtoken.models import Token
 
@@ -36,6 +37,20 @@ class WorkflowMethodsDocumentSerializer(serializers.ModelSerializer):
         fields = ('id', 'workflow_version', 'content')
 
 
+class WorkflowVersionStepSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = WorkflowVersionStep
+        resource_name = 'workflow-version-steps'
+        fields = ('id', 'workflow_version', 'step_id', 'tool_id', 'tool_class', 'docker_image', 'packages')
+
+
+class WorkflowVersionPackageSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = WorkflowVersionPackage
+        resource_name = 'workflow-version-packages'
+        fields = ('id', 'workflow_version', 'step', 'package', 'version', 'citation')
+
+
 class JobDDSOutputProjectSerializer(serializers.ModelSerializer):
     def validate(self, data):
         request = self.context['request']
@@ -157,7 +172,8 @@ class AdminJobSerializer(serializers.ModelSerializer):
         resource_name = 'jobs'
         fields = ('id', 'workflow_version', 'user', 'name', 'created', 'state', 'step', 'last_updated',
                   'vm_settings', 'vm_flavor', 'vm_instance_name', 'vm_volume_name', 'vm_volume_mounts', 'job_order',
-                  'output_project', 'stage_group', 'volume_size', 'share_group', 'cleanup_vm', 'fund_code')
+                  'output_project', 'stage_group', 'volume_size', 'volume_size_used', 'share_group', 'cleanup_vm',
+                  'fund_code')
         read_only_fields = ('share_group', 'vm_settings',)
 
 
@@ -213,6 +229,81 @@ class URLJobInputFileSerializer(BaseJobInputFileSerializer):
         fields = '__all__'
 
 
+class StageGroupDDSFileSerializer(serializers.ModelSerializer):
+    # credentials are looked up for all files at once by JobFileStageGroupFilesSerializer
+    dds_user_credentials = serializers.IntegerField()
+
+    class Meta:
+        model = DDSJobInputFile
+        fields = ('project_id', 'file_id', 'dds_user_credentials', 'destination_path', 'size',
+                  'sequence_group', 'sequence')
+
+
+class StageGroupURLFileSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = URLJobInputFile
+        fields = ('url', 'destination_path', 'size', 'sequence_group', 'sequence')
+
+
+class JobFileStageGroupFilesSerializer(serializers.Serializer):
+    """
+    Adds many dds and url files to the stage group passed in context['stage_group'].
+    """
+    dds_files = StageGroupDDSFileSerializer(many=True, required=False)
+    url_files = StageGroupURLFileSerializer(many=True, required=False)
+
+    class Meta:
+        resource_name = 'job-file-stage-group-files'
+
+    def validate(self, data):
+        stage_group = self.context['stage_group']
+        if stage_group.user != self.context['request'].user:
+            raise serializers.ValidationError("This stage group belongs to another user.")
+        data['dds_files'] = self._lookup_credentials(data.get('dds_files', []))
+        data['url_files'] = data.get('url_files', [])
+        self._check_unique_sequences('dds_files', stage_group.dds_files, data['dds_files'])
+        self._check_unique_sequences('url_files', stage_group.url_files, data['url_files'])
+        return data
+
+    @staticmethod
+    def _lookup_credentials(dds_files):
+        credential_ids = set(dds_file['dds_user_credentials'] for dds_file in dds_files)
+        credentials = DDSUserCredential.objects.in_bulk(list(credential_ids))
+        missing_ids = credential_ids - set(credentials.keys())
+        if missing_ids:
+            raise serializers.ValidationError({
+                'dds_files': 'Invalid dds_user_credentials: {}'.format(', '.join(str(pk) for pk in sorted(missing_ids)))
+            })
+        for dds_file in dds_files:
+            dds_file['dds_user_credentials'] = credentials[dds_file['dds_user_credentials']]
+        return dds_files
+
+    @staticmethod
+    def _check_unique_sequences(field_name, existing_files, new_files):
+        """
+        Check that sequence_group/sequence pairs are unique within the stage group without a query per file.
+        Files missing either value are skipped since the database allows duplicate NULLs.
+        """
+        used_sequences = set(existing_files.values_list('sequence_group', 'sequence'))
+        for new_file in new_files:
+            sequence_key = (new_file.get('sequence_group'), new_file.get('sequence'))
+            if None in sequence_key:
+                continue
+            if sequence_key in used_sequences:
+                raise serializers.ValidationError({
+                    field_name: 'Duplicate sequence_group {} sequence {}.'.format(*sequence_key)
+                })
+            used_sequences.add(sequence_key)
+
+    def create(self, validated_data):
+        stage_group = self.context['stage_group']
+        stage_group.add_files(
+            [DDSJobInputFile(**dds_file) for dds_file in validated_data['dds_files']],
+            [URLJobInputFile(**url_file) for url_file in validated_data['url_files']],
+        )
+        return stage_group
+
+
 class JobFileStageGroupSerializer(serializers.ModelSerializer):
     user = serializers.PrimaryKeyRelatedField(read_only=True, default=serializers.CurrentUserDefault())
     dds_files = DDSJobInputFileSerializer(many=True, read_only=True)
@@ -221,7 +312,8 @@ class JobFileStageGroupSerializer(serializers.ModelSerializer):
     class Meta:
         model = JobFileStageGroup
         resource_name = 'job-file-stage-groups'
-        fields = ('id', 'user', 'dds_files', 'url_files')
+        fields = ('id', 'user', 'dds_files', 'url_files', 'total_size')
+        read_only_fields = ('total_size',)
 
 
 class AdminDDSEndpointSerializer(serializers.HyperlinkedModelSerializer):
@@ -287,11 +379,6 @@ class JobAnswerSetSerializer(serializers.ModelSerializer):
 
 
 class JobQuestionnaireSerializer(serializers.ModelSerializer):
-    tag = serializers.SerializerMethodField()
-
-    def get_tag(self, obj):
-        return obj.make_tag()
-
     class Meta:
         model = JobQuestionnaire
         resource_name = 'job-questionnaires'
@@ -299,6 +386,7 @@ class JobQuestionnaireSerializer(serializers.ModelSerializer):
                   'user_fields_json', 'share_group', 'vm_settings', 'vm_flavor',
                   'volume_size_base', 'volume_size_factor', 'volume_mounts',
                   'tag')  # Removed 'type' since it is incompatible with ember data
+        read_only_fields = ('tag',)
 
 
 class AdminJobTokensSerializer(serializers.ModelSerializer):
@@ -324,6 +412,37 @@ class JobUsageSerializer(serializers.Serializer):
         resource_name = 'job-usage'
 
 
+class VMFlavorUsageSerializer(serializers.Serializer):
+    vm_flavor = serializers.IntegerField(source='vm_flavor_id')
+    vm_flavor_name = serializers.CharField()
+    cpus = serializers.IntegerField()
+    job_count = serializers.IntegerField()
+    median_vm_hours = serializers.FloatField()
+    percentile_vm_hours = serializers.FloatField()
+    mean_cpu_hours = serializers.FloatField()
+    total_cpu_hours = serializers.FloatField()
+    class Meta:
+        resource_name = 'vm-flavor-usages'
+
+
+class VMFlavorRecommendationSerializer(serializers.Serializer):
+    workflow_version = serializers.IntegerField(source='workflow_version_id')
+    vm_flavor = serializers.IntegerField(source='vm_flavor_id')
+    vm_flavor_name = serializers.CharField()
+    meets_target = serializers.BooleanField()
+    target_vm_hours = serializers.FloatField()
+    usages = VMFlavorUsageSerializer(many=True)
+    class Meta:
+        resource_name = 'vm-flavor-recommendations'
+
+
+class VMFlavorRecommendationQuerySerializer(serializers.Serializer):
+    target_hours = serializers.FloatField(min_value=0)
+    percentile = serializers.FloatField(min_value=0, max_value=1, required=False, default=0.9)
+    min_jobs = serializers.IntegerField(min_value=1, required=False, default=1)
+    workflow_version = serializers.IntegerField(required=False)
+
+
 class DDSUserSerializer(serializers.ModelSerializer):
     class Meta:
         model = DDSUser
@@ -360,6 +479,13 @@ class AdminEmailMessageSerializer(serializers.ModelSerializer):
         fields = '__all__'
 
 
+class AdminEmailBatchResultSerializer(serializers.Serializer):
+    sent = serializers.IntegerField()
+    errors = serializers.IntegerField()
+    class Meta:
+        resource_name = 'email-batch-results'
+
+
 class JobActivitySerializer(serializers.ModelSerializer):
     class Meta:
         model = JobActivity
@@ -382,3 +508,12 @@ class AdminImportWorkflowQuestionnaireSerializer(serializers.Serializer):
     share_group_name = serializers.CharField(min_length=1) # must relate to an existing Share Group
     volume_size_base = serializers.IntegerField()
     volume_size_factor = serializers.IntegerField()
+
+
+class AdminWorkflowImportTaskSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = WorkflowImportTask
+        resource_name = 'workflow-import-tasks'
+        fields = ('id', 'spec', 'user', 'state', 'stage', 'stage_timings', 'error', 'job_questionnaire', 'created',
+                  'started', 'finished')
+        read_only_fields = fields
@@ -191,3 +191,37 @@ class JSONFieldMigrationTestCase(TestMigrations):
         self.assertEqual(len(items), 2)
         self.assertEqual(items[0].system_job_order, {})
         self.assertEqual(items[1].system_job_order, {'color': 'blue', 'data': {'count': 3}})
+
+
+class JobQuestionnaireTagMigrationTestCase(TestMigrations):
+    migrate_from = '0080_workflowversionstep_workflowversionpackage'
+    migrate_to = '0081_jobquestionnaire_tag'
+    django_application = 'data'
+
+    def setUpBeforeMigration(self, apps):
+        Workflow = apps.get_model('data', 'Workflow')
+        WorkflowVersion = apps.get_model('data', 'WorkflowVersion')
+        VMFlavor = apps.get_model('data', 'VMFlavor')
+        VMProject = apps.get_model('data', 'VMProject')
+        CloudSettings = apps.get_model('data', 'CloudSettings')
+        VMSettings = apps.get_model('data', 'VMSettings')
+        ShareGroup = apps.get_model('data', 'ShareGroup')
+        JobQuestionnaireType = apps.get_model('data', 'JobQuestionnaireType')
+        JobQuestionnaire = apps.get_model('data', 'JobQuestionnaire')
+
+        workflow = Workflow.objects.create(name='Exome Seq', tag='exomeseq')
+        workflow_version = WorkflowVersion.objects.create(workflow=workflow, description='', version=2,
+                                                          url='http://someurl.com', fields=[])
+        cloud_settings = CloudSettings.objects.create(vm_project=VMProject.objects.create(name='project1'))
+        JobQuestionnaire.objects.create(
+            name='Exome Seq Q',
+            description='',
+            workflow_version=workflow_version,
+            share_group=ShareGroup.objects.create(name='somegroup'),
+            vm_settings=VMSettings.objects.create(name='settings', cloud_settings=cloud_settings),
+            vm_flavor=VMFlavor.objects.create(name='m1.small'),
+            type=JobQuestionnaireType.objects.create(tag='human'))
+
+    def test_populates_tags(self):
+        JobQuestionnaire = self.apps.get_model('data', 'JobQuestionnaire')
+        self.assertEqual(JobQuestionnaire.objects.get().tag, 'exomeseq/v2/human')
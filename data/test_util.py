@@ -1,5 +1,6 @@
 from django.test import TestCase
-from data.util import has_download_permissions, DataServiceError, WrappedDataServiceException
+from data.util import has_download_permissions, DataServiceError, WrappedDataServiceException, \
+    get_project_files_by_path, get_user_project_files_by_path, make_version_key
 from unittest.mock import patch, Mock
 
 class HasDownloadPermissionsTestCase(TestCase):
@@ -63,3 +64,73 @@ class HasDownloadPermissionsTestCase(TestCase):
         mock_remote_store.return_value.data_service.get_user_project_permission.side_effect = data_service_error
         with self.assertRaises(WrappedDataServiceException):
             self.assertFalse(has_download_permissions(dds_user_credential, project_id))
+
+
+def make_dds_resource_dict(id, name, kind, parent_id, parent_kind, size=None):
+    resource_dict = {
+        'id': id,
+        'name': name,
+        'kind': kind,
+        'project': {'id': 'project1'},
+        'parent': {'id': parent_id, 'kind': parent_kind},
+    }
+    if size is not None:
+        resource_dict['current_version'] = {'id': 'version-' + id, 'version': 1, 'upload': {'size': size}}
+    return resource_dict
+
+
+class GetProjectFilesByPathTestCase(TestCase):
+    @patch('data.util.RemoteStore')
+    def test_get_project_files_by_path(self, mock_remote_store):
+        mock_remote_store.return_value.data_service.get_project_children.return_value.json.return_value = {
+            'results': [
+                make_dds_resource_dict('file1', 'sample2.fastq', 'dds-file', 'folder2', 'dds-folder', size=200),
+                make_dds_resource_dict('folder2', 'raw', 'dds-folder', 'folder1', 'dds-folder'),
+                make_dds_resource_dict('folder1', 'data', 'dds-folder', 'project1', 'dds-project'),
+                make_dds_resource_dict('file2', 'sample1.fastq', 'dds-file', 'folder1', 'dds-folder', size=100),
+                make_dds_resource_dict('file3', 'README', 'dds-file', 'project1', 'dds-project', size=10),
+            ]
+        }
+        config = Mock()
+        files = get_project_files_by_path(config, 'project1')
+        mock_remote_store.assert_called_with(config)
+        mock_remote_store.return_value.data_service.get_project_children.assert_called_with(
+            'project1', name_contains='')
+        self.assertEqual(set(files.keys()), {'data/raw/sample2.fastq', 'data/sample1.fastq', 'README'})
+        self.assertEqual(files['data/raw/sample2.fastq'].id, 'file1')
+        self.assertEqual(files['data/raw/sample2.fastq'].size, 200)
+        self.assertEqual(files['data/sample1.fastq'].id, 'file2')
+        self.assertEqual(files['README'].id, 'file3')
+
+    @patch('data.util.RemoteStore')
+    def test_get_project_files_by_path_error(self, mock_remote_store):
+        mock_remote_store.return_value.data_service.get_project_children.side_effect = \
+            DataServiceError(response=Mock(status_code=500), url_suffix=Mock(), request_data=Mock())
+        with self.assertRaises(WrappedDataServiceException):
+            get_project_files_by_path(Mock(), 'project1')
+
+    @patch('data.util.get_project_files_by_path')
+    @patch('data.util.get_remote_store')
+    def test_get_user_project_files_by_path(self, mock_get_remote_store, mock_get_project_files_by_path):
+        mock_get_remote_store.return_value.data_service.get_projects.return_value.json.return_value = {
+            'results': [
+                {'id': 'project1', 'name': 'Mouse', 'description': ''},
+                {'id': 'project2', 'name': 'Rat', 'description': ''},
+                {'id': 'project3', 'name': 'Other', 'description': ''},
+            ]
+        }
+        mock_get_project_files_by_path.side_effect = lambda config, project_id: {'README': project_id}
+        files = get_user_project_files_by_path(Mock(), ['Mouse', 'Rat', 'Missing'], max_workers=2)
+        self.assertEqual(files, {
+            'Mouse': {'README': 'project1'},
+            'Rat': {'README': 'project2'},
+        })
+        self.assertEqual(mock_get_project_files_by_path.call_count, 2)
+
+
+class MakeVersionKeyTestCase(TestCase):
+    def test_orders_versions(self):
+        versions = ['1.10', '1.9', '1.9.1', '0.7.17', '2.0']
+        self.assertEqual(sorted(versions, key=make_version_key), ['0.7.17', '1.9', '1.9.1', '1.10', '2.0'])
+        self.assertEqual(make_version_key('v1.9'), make_version_key('v1.9'))
+        self.assertLess(make_version_key('1.9-beta'), make_version_key('1.9.0'))
@@ -1,6 +1,8 @@
 from django.contrib.auth.models import User as django_user
 from django.core.urlresolvers import reverse, NoReverseMatch
 from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from django.db import connection
 from unittest.mock import MagicMock, patch, Mock
 from rest_framework import status
 from rest_framework.test import APITestCase
@@ -12,7 +14,7 @@ from data.models import Workflow, WorkflowVersion, Job, JobFileStageGroup, JobEr
     DDSUserCredential, DDSEndpoint, DDSJobInputFile, URLJobInputFile, JobDDSOutputProject, \
     JobQuestionnaire, JobAnswerSet, VMFlavor, VMProject, JobToken, ShareGroup, DDSUser, \
     WorkflowMethodsDocument, EmailMessage, EmailTemplate, CloudSettings, VMSettings, \
-    JobQuestionnaireType
+    JobQuestionnaireType, WorkflowImportTask, WorkflowVersionStep, WorkflowVersionPackage
 from rest_framework.authtoken.models import Token
 from data.exceptions import WrappedDataServiceException
 from data.util import DDSResource
@@ -1020,6 +1022,76 @@ class JobStageGroupTestCase(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertEqual(2, len(response.data))
 
+    def testIncludesTotalSize(self):
+        normal_user = self.user_login.become_normal_user()
+        stage_group = JobFileStageGroup.objects.create(user=normal_user)
+        URLJobInputFile.objects.create(stage_group=stage_group, url='https://data.org/sample.fasta',
+                                       destination_path='sample.fasta', size=1000, sequence=1)
+        URLJobInputFile.objects.create(stage_group=stage_group, url='https://data.org/sample2.fasta',
+                                       destination_path='sample2.fasta', size=2000, sequence=2)
+        url = reverse('jobfilestagegroup-detail', args=[stage_group.id])
+        response = self.client.get(url, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['total_size'], 3000)
+
+    def add_files_data(self, credential_id, count):
+        return {
+            'dds_files': [
+                {'project_id': '1234', 'file_id': 'file{}'.format(i), 'dds_user_credentials': credential_id,
+                 'destination_path': 'sample{}.fasta'.format(i), 'size': 100, 'sequence_group': 1, 'sequence': i}
+                for i in range(count)
+            ],
+            'url_files': [
+                {'url': 'https://data.org/genome.fasta', 'destination_path': 'genome.fasta', 'size': 1000,
+                 'sequence_group': 2, 'sequence': 0}
+            ]
+        }
+
+    def testAddFiles(self):
+        normal_user = self.user_login.become_normal_user()
+        endpoint = DDSEndpoint.objects.create(name='app', agent_key='abc123', api_root='https://api.example.com')
+        credential = DDSUserCredential.objects.create(endpoint=endpoint, user=normal_user, token='secret',
+                                                       dds_id='1')
+        stage_group = JobFileStageGroup.objects.create(user=normal_user)
+        url = reverse('jobfilestagegroup-add-files', args=[stage_group.id])
+        response = self.client.post(url, format='json', data=self.add_files_data(credential.id, 3))
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data['total_size'], 1300)
+        self.assertEqual(len(response.data['dds_files']), 3)
+        self.assertEqual(len(response.data['url_files']), 1)
+        self.assertEqual(stage_group.dds_files.count(), 3)
+        self.assertEqual(stage_group.url_files.first().url, 'https://data.org/genome.fasta')
+
+    def testAddFilesRejectsDuplicateSequences(self):
+        normal_user = self.user_login.become_normal_user()
+        endpoint = DDSEndpoint.objects.create(name='app', agent_key='abc123', api_root='https://api.example.com')
+        credential = DDSUserCredential.objects.create(endpoint=endpoint, user=normal_user, token='secret',
+                                                       dds_id='1')
+        stage_group = JobFileStageGroup.objects.create(user=normal_user)
+        URLJobInputFile.objects.create(stage_group=stage_group, url='https://data.org/other.fasta',
+                                       destination_path='other.fasta', size=1, sequence_group=2, sequence=0)
+        url = reverse('jobfilestagegroup-add-files', args=[stage_group.id])
+        response = self.client.post(url, format='json', data=self.add_files_data(credential.id, 2))
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        data = self.add_files_data(credential.id, 2)
+        data['dds_files'][1]['sequence'] = 0
+        data['url_files'] = []
+        response = self.client.post(url, format='json', data=data)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(stage_group.dds_files.count(), 0)
+
+    def testAddFilesRejectsBadCredentialsAndOtherUsersStageGroup(self):
+        other_user = self.user_login.become_other_normal_user()
+        other_stage_group = JobFileStageGroup.objects.create(user=other_user)
+        normal_user = self.user_login.become_normal_user()
+        stage_group = JobFileStageGroup.objects.create(user=normal_user)
+        response = self.client.post(reverse('jobfilestagegroup-add-files', args=[stage_group.id]), format='json',
+                                    data=self.add_files_data(9999, 1))
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.post(reverse('jobfilestagegroup-add-files', args=[other_stage_group.id]),
+                                    format='json', data={'url_files': []})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
     def testAutoFillsInUser(self):
         url = reverse('jobfilestagegroup-list')
         normal_user = self.user_login.become_normal_user()
@@ -1629,7 +1701,7 @@ class JobAnswerSetTests(APITestCase):
 
     @patch('data.jobfactory.JobDDSOutputProject')
     def test_create_job_with_exception_rolls_back(self, MockJobDDSOutputProject):
-        MockJobDDSOutputProject.objects.create.side_effect = ValueError("oops")
+        MockJobDDSOutputProject.objects.bulk_create.side_effect = ValueError("oops")
         questionnaire = self.setup_minimal_questionnaire()
         url = reverse('jobanswerset-list')
         response = self.client.post(url, format='json', data={
@@ -1959,6 +2031,26 @@ class EmailMessageTestCase(APITestCase):
         message = EmailMessage.objects.get(id=message.id)
         self.assertEqual(message.state, 'E')
 
+    @patch('data.mailer.get_connection')
+    def test_admin_send_pending(self, mock_get_connection):
+        message = EmailMessage.objects.create(
+            body='body1',
+            subject='subject1',
+            sender_email='sender1@example.com',
+            to_email='recipient1@university.edu',
+        )
+        url = reverse('admin_emailmessage-list') + 'send-pending/'
+        self.user_login.become_normal_user()
+        response = self.client.post(url, format='json', data={})
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        self.user_login.become_admin_user()
+        response = self.client.post(url, format='json', data={})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data, {'sent': 1, 'errors': 0})
+        self.assertEqual(mock_get_connection.return_value.send_messages.call_count, 1)
+        message = EmailMessage.objects.get(id=message.id)
+        self.assertEqual(message.state, 'S')
+
 
 class EmailTemplateTestCase(APITestCase):
 
@@ -2175,6 +2267,44 @@ class JobActivitiesTestCase(APITestCase):
         ])
 
 
+class AdminVMFlavorRecommendationTestCase(APITestCase):
+    def setUp(self):
+        self.user_login = UserLogin(self.client)
+
+    def test_normal_user_cannot_list(self):
+        self.user_login.become_normal_user()
+        url = reverse('admin_vmflavorrecommendation-list')
+        response = self.client.get(url, {'target_hours': 4}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_requires_target_hours(self):
+        self.user_login.become_admin_user()
+        url = reverse('admin_vmflavorrecommendation-list')
+        response = self.client.get(url, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('target_hours', response.data)
+
+    @patch('data.api.VMFlavorUsageReport')
+    def test_list(self, mock_vm_flavor_usage_report):
+        usage = Mock(vm_flavor_id=3, vm_flavor_name='small', cpus=2, job_count=4, median_vm_hours=1.5,
+                     percentile_vm_hours=2.5, mean_cpu_hours=3.0, total_cpu_hours=12.0)
+        mock_vm_flavor_usage_report.return_value.get_recommendations.return_value = [
+            Mock(workflow_version_id=5, vm_flavor_id=3, vm_flavor_name='small', meets_target=True,
+                 target_vm_hours=4.0, usages=[usage])
+        ]
+        self.user_login.become_admin_user()
+        url = reverse('admin_vmflavorrecommendation-list')
+        response = self.client.get(url, {'target_hours': 4, 'percentile': 0.5, 'workflow_version': 5},
+                                   format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        mock_vm_flavor_usage_report.assert_called_with(percentile=0.5, min_jobs=1, workflow_version_ids=[5])
+        mock_vm_flavor_usage_report.return_value.get_recommendations.assert_called_with(4.0)
+        self.assertEqual(len(response.data), 1)
+        self.assertEqual(response.data[0]['workflow_version'], 5)
+        self.assertEqual(response.data[0]['vm_flavor_name'], 'small')
+        self.assertEqual(response.data[0]['usages'][0]['percentile_vm_hours'], 2.5)
+
+
 class AdminImportWorkflowQuestionnaireTestCase(APITestCase):
     def setUp(self):
         self.user_login = UserLogin(self.client)
@@ -2333,3 +2463,127 @@ class TokenTestCase(APITestCase):
         url = reverse('token-list') + token.key + '/'
         response = self.client.delete(url, format='json')
         self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+
+
+class AdminWorkflowImportTaskTestCase(APITestCase):
+    def setUp(self):
+        self.user_login = UserLogin(self.client)
+        self.data = {
+            "cwl_url": "https://example.org/exome-seq.cwl",
+            "workflow_version_number": 12,
+            "name": "Test Questionnaire Name",
+            "description": "Test Questionnaire Description",
+            "workflow_tag": "my-tag",
+            "type_tag": "human",
+            "methods_template_url": "https://example.org/exome-seq.md.j2",
+            "system_json": {"threads": 4},
+            "vm_settings_name": "test-settings",
+            "vm_flavor_name": "test-flavor",
+            "share_group_name": "test-share-group",
+            "volume_size_base": 100,
+            "volume_size_factor": 10
+        }
+
+    def test_normal_user_cannot_create(self):
+        self.user_login.become_normal_user()
+        url = reverse('admin_workflowimporttask-list')
+        response = self.client.post(url, self.data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    @patch('data.api.WorkflowQuestionnaireImporter')
+    def test_create_queues_task(self, mock_importer):
+        admin_user = self.user_login.become_admin_user()
+        url = reverse('admin_workflowimporttask-list')
+        response = self.client.post(url, self.data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(response.data['state'], WorkflowImportTask.STATE_NEW)
+        self.assertFalse(mock_importer.called)
+        task = WorkflowImportTask.objects.get(pk=response.data['id'])
+        self.assertEqual(task.spec, self.data)
+        self.assertEqual(task.user, admin_user)
+
+    def test_create_validates_spec(self):
+        self.user_login.become_admin_user()
+        url = reverse('admin_workflowimporttask-list')
+        del self.data['cwl_url']
+        response = self.client.post(url, self.data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('cwl_url', response.data)
+        self.assertFalse(WorkflowImportTask.objects.exists())
+
+    def test_retrieve_status(self):
+        self.user_login.become_admin_user()
+        task = WorkflowImportTask.objects.create(spec=self.data, state=WorkflowImportTask.STATE_ERROR,
+                                                 stage='import_workflow', stage_timings={'validate': 0.1},
+                                                 error='Unable to import workflow: oops')
+        url = reverse('admin_workflowimporttask-detail', args=[task.id])
+        response = self.client.get(url, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['state'], WorkflowImportTask.STATE_ERROR)
+        self.assertEqual(response.data['stage'], 'import_workflow')
+        self.assertEqual(response.data['stage_timings'], {'validate': 0.1})
+        self.assertEqual(response.data['error'], 'Unable to import workflow: oops')
+
+
+class WorkflowVersionPackageTestCase(APITestCase):
+    def setUp(self):
+        self.user_login = UserLogin(self.client)
+        workflow = Workflow.objects.create(name='Exome', tag='exome')
+        self.versions = []
+        for version, samtools_version in [(1, '1.8'), (2, '1.9'), (3, '1.10')]:
+            workflow_version = WorkflowVersion.objects.create(workflow=workflow, version=version,
+                                                              url='https://example.com/exome.cwl', fields=[])
+            step = WorkflowVersionStep.objects.create(workflow_version=workflow_version, step_id='#main/sort',
+                                                      docker_image='samtools:' + samtools_version)
+            WorkflowVersionPackage.objects.create(workflow_version=workflow_version, step=step, package='samtools',
+                                                  version=samtools_version)
+            WorkflowVersionPackage.objects.create(workflow_version=workflow_version, step=step, package='bwa',
+                                                  version='0.7.17')
+            self.versions.append(workflow_version)
+
+    def test_requires_auth(self):
+        self.user_login.become_unauthorized()
+        response = self.client.get(reverse('workflowversionpackage-list'), format='json')
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_filter_by_version(self):
+        self.user_login.become_normal_user()
+        url = reverse('workflowversionpackage-list')
+        response = self.client.get(url, {'package': 'samtools', 'version_lt': '1.9'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([package['workflow_version'] for package in response.data], [self.versions[0].id])
+
+        response = self.client.get(url, {'package': 'samtools', 'version_gte': '1.9', 'version_lte': '1.10'},
+                                   format='json')
+        self.assertEqual([package['workflow_version'] for package in response.data],
+                         [self.versions[1].id, self.versions[2].id])
+
+    def test_filter_by_version_excludes_blank_versions(self):
+        WorkflowVersionPackage.objects.create(workflow_version=self.versions[0], step=self.versions[0].steps.get(),
+                                              package='samtools', version='')
+        self.user_login.become_normal_user()
+        url = reverse('workflowversionpackage-list')
+        response = self.client.get(url, {'package': 'samtools', 'version_lt': '1.9'}, format='json')
+        self.assertEqual([package['version'] for package in response.data], ['1.8'])
+
+    def test_filter_steps_by_docker_image(self):
+        self.user_login.become_normal_user()
+        url = reverse('workflowversionstep-list')
+        response = self.client.get(url, {'docker_image': 'samtools:1.10'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([step['workflow_version'] for step in response.data], [self.versions[2].id])
+        self.assertEqual(len(response.data[0]['packages']), 2)
+
+    def test_list_steps_query_count_does_not_grow_with_steps(self):
+        self.user_login.become_normal_user()
+        url = reverse('workflowversionstep-list')
+        with CaptureQueriesContext(connection) as three_steps_queries:
+            self.client.get(url, format='json')
+        for workflow_version in self.versions:
+            step = WorkflowVersionStep.objects.create(workflow_version=workflow_version, step_id='#main/align')
+            WorkflowVersionPackage.objects.create(workflow_version=workflow_version, step=step, package='bwa',
+                                                  version='0.7.17')
+        with CaptureQueriesContext(connection) as six_steps_queries:
+            response = self.client.get(url, format='json')
+        self.assertEqual(len(response.data), 6)
+        self.assertEqual(len(six_steps_queries), len(three_steps_queries))
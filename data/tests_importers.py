@@ -1,9 +1,18 @@
 from django.test import TestCase
+from django.test import override_settings
 from data.importers import CWLDocument, MethodsDocumentContents, SCHEMA_ORG_CITATION, \
-    HTTPS_DOI_URL, WorkflowQuestionnaireImporter, ImporterException
-from data.models import ShareGroup
+    HTTPS_DOI_URL, WorkflowQuestionnaireImporter, ImporterException, CWLDocumentCache, DOICitationResolver, \
+    BulkWorkflowImporter, WorkflowImportTaskRunner, WorkflowImporter, ArtifactMirror, MirrorArtifactResolver, \
+    ArtifactNotFoundException, ArtifactPrefetcher, get_artifact_resolver, NetworkArtifactResolver, \
+    MethodsTemplateCache, methods_template_cache
+from data.models import ShareGroup, DOICitation, WorkflowImportTask, WorkflowVersion, WorkflowMethodsDocument
 from data.tests_api import add_vm_settings
-from unittest.mock import patch, Mock
+from unittest.mock import patch, Mock, ANY, PropertyMock
+from concurrent.futures import ThreadPoolExecutor
+from django.utils import timezone
+import datetime
+import tempfile
+import hashlib
 
 
 class CWLNodeWithSteps(object):
@@ -21,7 +30,52 @@ class CWLNodeWithHints(object):
         self.hints = hints
 
 
+class CWLToolNode(object):
+    def __init__(self, tool, hints=None, requirements=None):
+        self.tool = tool
+        self.hints = hints or []
+        self.requirements = requirements or []
+
+
+class CWLStepNodeWithId(CWLStepNode):
+    def __init__(self, id, embedded_tool):
+        super(CWLStepNodeWithId, self).__init__(embedded_tool)
+        self.id = id
+
+
 class CWLDocumentTestCase(TestCase):
+    @override_settings(BESPIN_CWL_CACHE_DIR=None)
+    def test_extract_steps(self):
+        cwl_document = CWLDocument('someurl')
+        align_tool = CWLToolNode(
+            tool={'id': '#bwa-mem.cwl', 'class': 'CommandLineTool'},
+            requirements=[{'class': 'DockerRequirement', 'dockerPull': 'bwa:0.7.17'}],
+            hints=[{'class': 'SoftwareRequirement', 'packages': [
+                {'package': 'bwa', 'version': ['0.7.17'], SCHEMA_ORG_CITATION: 'bwaurl'}
+            ]}])
+        sort_tool = CWLToolNode(
+            tool={'id': '#samtools-sort.cwl', 'class': 'CommandLineTool'},
+            hints=[{'class': 'SoftwareRequirement', 'packages': [{'package': 'samtools', 'version': ['1.8']}]}])
+        subworkflow = CWLNodeWithSteps(steps=[CWLStepNodeWithId('#sub/sort', sort_tool)])
+        subworkflow.tool = {'id': '#sub.cwl', 'class': 'Workflow'}
+        subworkflow.hints = []
+        subworkflow.requirements = []
+        cwl_document._parsed = CWLNodeWithSteps(steps=[
+            CWLStepNodeWithId('#main/align', align_tool),
+            CWLStepNodeWithId('#main/sub', subworkflow),
+        ])
+        cwl_document._parsed.inputs_record_schema = {'fields': []}
+        cwl_document._parsed.tool = {'label': 'Exome', 'doc': 'Exome pipeline'}
+        self.assertEqual(cwl_document.extract_steps(), [
+            {'step_id': '#main/align', 'tool_id': '#bwa-mem.cwl', 'tool_class': 'CommandLineTool',
+             'docker_image': 'bwa:0.7.17',
+             'packages': [{'package': 'bwa', 'version': ['0.7.17'], 'citation': 'bwaurl'}]},
+            {'step_id': '#main/sub', 'tool_id': '#sub.cwl', 'tool_class': 'Workflow', 'docker_image': '',
+             'packages': []},
+            {'step_id': '#sub/sort', 'tool_id': '#samtools-sort.cwl', 'tool_class': 'CommandLineTool',
+             'docker_image': '', 'packages': [{'package': 'samtools', 'version': ['1.8'], 'citation': ''}]},
+        ])
+
     def test_extract_tool_hints(self):
         cwl_document = CWLDocument('someurl')
         step_node1 = CWLStepNode(embedded_tool=CWLNodeWithHints(hints=[
@@ -50,7 +104,74 @@ class CWLDocumentTestCase(TestCase):
         self.assertEqual(set([1, 2]), set([hint['value'] for hint in hints]))
 
 
+class CWLDocumentCacheTestCase(TestCase):
+    def test_make_key(self):
+        key = CWLDocumentCache.make_key('https://example.com/a.cwl', b'cwlVersion: v1.0')
+        self.assertEqual(key, CWLDocumentCache.make_key('https://example.com/a.cwl', b'cwlVersion: v1.0'))
+        self.assertNotEqual(key, CWLDocumentCache.make_key('https://example.com/b.cwl', b'cwlVersion: v1.0'))
+        self.assertNotEqual(key, CWLDocumentCache.make_key('https://example.com/a.cwl', b'cwlVersion: v1.1'))
+
+    def test_get_and_put(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            cache = CWLDocumentCache(temp_dir + '/cwl')
+            self.assertIsNone(cache.get('abc'))
+            cache.put('abc', {'label': 'Exome'})
+            self.assertEqual(cache.get('abc'), {'label': 'Exome'})
+
+
+@patch('data.importers.load_tool')
+@patch('data.importers.requests')
+class CWLDocumentSummaryTestCase(TestCase):
+    def setUp(self):
+        self.parsed = Mock(inputs_record_schema={'fields': [{'name': 'threads', 'type': 'int'}]},
+                           tool={'label': 'Exome', 'doc': 'Exome pipeline'},
+                           hints=[{'class': 'SoftwareRequirement', 'packages': []}, {'class': 'Other'}],
+                           requirements=[])
+        del self.parsed.steps
+
+    def test_summary_cached_by_content(self, mock_requests, mock_load_tool):
+        mock_load_tool.return_value = self.parsed
+        mock_requests.get.return_value.content = b'cwlVersion: v1.0'
+        with tempfile.TemporaryDirectory() as temp_dir:
+            with override_settings(BESPIN_CWL_CACHE_DIR=temp_dir):
+                cwl_document = CWLDocument('https://example.com/exome.cwl')
+                self.assertEqual(cwl_document.input_fields, [{'name': 'threads', 'type': 'int'}])
+                self.assertEqual(cwl_document.get('label'), 'Exome')
+                self.assertEqual(cwl_document.get('doc'), 'Exome pipeline')
+                self.assertEqual(cwl_document.extract_tool_hints('SoftwareRequirement'),
+                                 [{'class': 'SoftwareRequirement', 'packages': []}])
+                self.assertEqual(mock_load_tool.call_count, 1)
+                # cwltool parses the downloaded content instead of fetching the document again
+                fetcher_constructor = mock_load_tool.call_args[0][1].fetcher_constructor
+                fetcher = fetcher_constructor({}, None)
+                self.assertEqual(fetcher.fetch_text('https://example.com/exome.cwl'), 'cwlVersion: v1.0')
+
+                # re-importing the same content skips cwltool
+                cwl_document = CWLDocument('https://example.com/exome.cwl')
+                self.assertEqual(cwl_document.get('label'), 'Exome')
+                self.assertEqual(cwl_document.input_fields, [{'name': 'threads', 'type': 'int'}])
+                self.assertEqual(mock_load_tool.call_count, 1)
+
+                # changed content is parsed again
+                mock_requests.get.return_value.content = b'cwlVersion: v1.0\n'
+                cwl_document = CWLDocument('https://example.com/exome.cwl')
+                self.assertEqual(cwl_document.get('label'), 'Exome')
+                self.assertEqual(mock_load_tool.call_count, 2)
+
+    @override_settings(BESPIN_CWL_CACHE_DIR=None)
+    def test_summary_without_cache(self, mock_requests, mock_load_tool):
+        mock_load_tool.return_value = self.parsed
+        cwl_document = CWLDocument('https://example.com/exome.cwl')
+        self.assertEqual(cwl_document.get('label'), 'Exome')
+        CWLDocument('https://example.com/exome.cwl').get('label')
+        self.assertEqual(mock_load_tool.call_count, 2)
+        self.assertFalse(mock_requests.get.called)
+
+
 class MethodsDocumentContentsTestCase(TestCase):
+    def setUp(self):
+        methods_template_cache.clear()
+
     @patch('data.importers.requests')
     @patch('data.importers.cn')
     def test_get_content(self, mock_cn, mock_requests):
@@ -84,6 +205,158 @@ othertool version: 3 citation: Dr Man 2017"""
         self.assertEqual(expected_content, method_document_contents.get_content())
 
 
+class MethodsTemplateCacheTestCase(TestCase):
+    @patch('data.importers.requests')
+    def test_revalidates_with_etag(self, mock_requests):
+        mock_requests.codes.not_modified = 304
+        mock_requests.get.return_value = Mock(status_code=200, text='{{description}}',
+                                              headers={'ETag': '"v1"', 'Last-Modified': 'Mon, 19 Oct 2026 10:00:00 GMT'})
+        cache = MethodsTemplateCache()
+        resolver = NetworkArtifactResolver()
+        self.assertEqual(cache.get_template_text('https://example.com/methods.j2', resolver), '{{description}}')
+        mock_requests.get.assert_called_with('https://example.com/methods.j2', headers={})
+
+        mock_requests.get.return_value = Mock(status_code=304)
+        self.assertEqual(cache.get_template_text('https://example.com/methods.j2', resolver), '{{description}}')
+        mock_requests.get.assert_called_with('https://example.com/methods.j2', headers={
+            'If-None-Match': '"v1"',
+            'If-Modified-Since': 'Mon, 19 Oct 2026 10:00:00 GMT',
+        })
+
+        mock_requests.get.return_value = Mock(status_code=200, text='{{description}}!', headers={})
+        self.assertEqual(cache.get_template_text('https://example.com/methods.j2', resolver), '{{description}}!')
+
+    def test_get_compiled_template(self):
+        cache = MethodsTemplateCache()
+        template = cache.get_compiled_template('desc: {{description}}')
+        self.assertEqual(template.render(description='Exome'), 'desc: Exome')
+        self.assertIs(cache.get_compiled_template('desc: {{description}}'), template)
+        self.assertIsNot(cache.get_compiled_template('{{description}}'), template)
+
+    def test_mirror_uses_content_hash_as_etag(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            mirror = ArtifactMirror(temp_dir)
+            content_hash = mirror.put('https://example.com/methods.j2', b'{{description}}')
+            resolver = MirrorArtifactResolver(mirror)
+            self.assertEqual(resolver.fetch_text_if_modified('https://example.com/methods.j2'),
+                             ('{{description}}', content_hash, None))
+            self.assertIsNone(resolver.fetch_text_if_modified('https://example.com/methods.j2', content_hash))
+
+
+class DOICitationResolverTestCase(TestCase):
+    @patch('data.importers.cn')
+    def test_resolve(self, mock_cn):
+        DOICitation.objects.create(doi='cached123', apa_citation='Cached 2016')
+
+        def content_negotiation(ids, format, style):
+            if ids == 'bad123':
+                raise ValueError('Not found')
+            return 'Citation for ' + ids
+        mock_cn.content_negotiation.side_effect = content_negotiation
+
+        citations = [HTTPS_DOI_URL + 'cached123', HTTPS_DOI_URL + 'new123', HTTPS_DOI_URL + 'bad123', 'someurl',
+                     HTTPS_DOI_URL + 'new123']
+        apa_citations = DOICitationResolver(max_workers=2).resolve(citations)
+        self.assertEqual(apa_citations, {
+            HTTPS_DOI_URL + 'cached123': 'Cached 2016',
+            HTTPS_DOI_URL + 'new123': 'Citation for new123',
+            HTTPS_DOI_URL + 'bad123': HTTPS_DOI_URL + 'bad123',
+            'someurl': 'someurl',
+        })
+        self.assertEqual(sorted(call[1]['ids'] for call in mock_cn.content_negotiation.call_args_list),
+                         ['bad123', 'new123'])
+        self.assertEqual(DOICitation.objects.get(doi='new123').apa_citation, 'Citation for new123')
+        self.assertFalse(DOICitation.objects.filter(doi='bad123').exists())
+
+        # stored citations are not fetched again
+        mock_cn.content_negotiation.reset_mock()
+        DOICitationResolver().resolve([HTTPS_DOI_URL + 'new123'])
+        self.assertFalse(mock_cn.content_negotiation.called)
+
+
+@patch('data.importers.DOICitationResolver')
+@patch('data.importers.get_artifact_resolver')
+class WorkflowImporterTestCase(TestCase):
+    def setUp(self):
+        methods_template_cache.clear()
+        self.cwl_document = Mock(url='https://example.com/exome.cwl', content_hash='cwlhash', input_fields=[])
+        self.cwl_document.get.side_effect = {'label': 'Exome', 'doc': 'Exome pipeline'}.get
+        self.cwl_document.extract_tool_hints.return_value = []
+        self.cwl_document.extract_steps.return_value = [
+            {'step_id': '#main/sort', 'tool_id': '#samtools-sort.cwl', 'tool_class': 'CommandLineTool',
+             'docker_image': 'samtools:1.8',
+             'packages': [{'package': 'samtools', 'version': ['1.7', '1.8'], 'citation': 'samtoolsurl'}]},
+        ]
+
+    def import_workflow(self):
+        importer = WorkflowImporter(self.cwl_document, version_number=1,
+                                    methods_jinja_template_url='https://example.com/exome.md.j2', tag='exome',
+                                    stdout=Mock(), stderr=Mock())
+        importer.run()
+        return importer
+
+    def test_skips_unchanged_version(self, mock_get_artifact_resolver, mock_doi_citation_resolver):
+        mock_get_artifact_resolver.return_value.fetch_text_if_modified.return_value = \
+            ('Methods: {{description}}', None, None)
+        mock_doi_citation_resolver.return_value.resolve.return_value = {}
+        importer = self.import_workflow()
+        self.assertFalse(importer.skipped)
+        workflow_version = WorkflowVersion.objects.get()
+        self.assertEqual(workflow_version.content_hash, 'cwlhash')
+        methods_document = WorkflowMethodsDocument.objects.get()
+        self.assertEqual(methods_document.content, 'Methods: Exome pipeline')
+        self.assertEqual(methods_document.template_hash, hashlib.sha256(b'Methods: {{description}}').hexdigest())
+        step = workflow_version.steps.get()
+        self.assertEqual(step.step_id, '#main/sort')
+        self.assertEqual(step.docker_image, 'samtools:1.8')
+        self.assertEqual([(package.package, package.version, package.step) for package in workflow_version.packages.all()],
+                         [('samtools', '1.7', step), ('samtools', '1.8', step)])
+
+        self.cwl_document.extract_tool_hints.reset_mock()
+        self.cwl_document.get.reset_mock()
+        importer = self.import_workflow()
+        self.assertTrue(importer.skipped)
+        self.assertEqual(importer.workflow_version, workflow_version)
+        self.assertFalse(self.cwl_document.get.called)
+        self.assertFalse(self.cwl_document.extract_tool_hints.called)
+
+    def test_changed_template_is_not_skipped(self, mock_get_artifact_resolver, mock_doi_citation_resolver):
+        mock_get_artifact_resolver.return_value.fetch_text_if_modified.return_value = \
+            ('Methods: {{description}}', None, None)
+        mock_doi_citation_resolver.return_value.resolve.return_value = {}
+        self.import_workflow()
+        mock_get_artifact_resolver.return_value.fetch_text_if_modified.return_value = \
+            ('Updated methods: {{ description }}', None, None)
+        importer = self.import_workflow()
+        self.assertFalse(importer.skipped)
+        self.assertTrue(self.cwl_document.extract_tool_hints.called)
+        methods_document = WorkflowMethodsDocument.objects.get()
+        self.assertEqual(methods_document.content, 'Updated methods: Exome pipeline')
+        self.assertEqual(methods_document.template_hash,
+                         hashlib.sha256(b'Updated methods: {{ description }}').hexdigest())
+
+    def test_changed_cwl_updates_fields_and_steps(self, mock_get_artifact_resolver, mock_doi_citation_resolver):
+        mock_get_artifact_resolver.return_value.fetch_text_if_modified.return_value = \
+            ('Methods: {{description}}', None, None)
+        mock_doi_citation_resolver.return_value.resolve.return_value = {}
+        self.import_workflow()
+        self.cwl_document.content_hash = 'cwlhash2'
+        self.cwl_document.input_fields = [{'name': 'threads', 'type': 'int'}]
+        self.cwl_document.extract_steps.return_value = [
+            {'step_id': '#main/sort', 'tool_id': '#samtools-sort.cwl', 'tool_class': 'CommandLineTool',
+             'docker_image': 'samtools:1.9',
+             'packages': [{'package': 'samtools', 'version': ['1.9'], 'citation': 'samtoolsurl'}]},
+        ]
+        importer = self.import_workflow()
+        self.assertFalse(importer.skipped)
+        workflow_version = WorkflowVersion.objects.get()
+        self.assertEqual(workflow_version.content_hash, 'cwlhash2')
+        self.assertEqual(workflow_version.fields, [{'name': 'threads', 'type': 'int'}])
+        # the step and package index is rebuilt from the changed document
+        self.assertEqual(workflow_version.steps.get().docker_image, 'samtools:1.9')
+        self.assertEqual([package.version for package in workflow_version.packages.all()], ['1.9'])
+
+
 class JobQuestionnaireImporterTestCase(TestCase):
 
     def setUp(self):
@@ -160,7 +433,7 @@ class JobQuestionnaireImporterTestCase(TestCase):
                                 self.data['workflow_version_number'],
                                 self.data['methods_template_url'],
                                 self.data['workflow_tag'],))
-        self.assertEqual(kwargs, {})
+        self.assertEqual(kwargs, {'methods_document_content': None, 'methods_template_hash': None})
         self.assertTrue(mock_wfi_run.called)
 
         # Check that the Job Questionnaire Importer was called
@@ -178,10 +451,22 @@ class JobQuestionnaireImporterTestCase(TestCase):
             self.data['volume_size_factor'],
             mock_doc
         ))
-        self.assertEqual(kwargs, {})
+        self.assertEqual(kwargs, {'reuse_existing': mock_workflow_importer.return_value.skipped})
         self.assertTrue(mock_jqi_run.called)
 
 
+    @patch('data.importers.WorkflowImporter')
+    @patch('data.importers.CWLDocument')
+    def test_parses_cwl_in_load_stage(self, mock_cwl_document, mock_workflow_importer):
+        add_vm_settings(self, settings_name=self.vm_settings_name)
+        self.share_group = ShareGroup.objects.create(name=self.share_group_name)
+        type(mock_cwl_document.return_value).summary = PropertyMock(side_effect=ValueError('bad cwl'))
+        importer = WorkflowQuestionnaireImporter(self.data)
+        with self.assertRaises(ImporterException) as cm:
+            importer.run()
+        self.assertIn('Unable to load CWL Document', cm.exception.message)
+        self.assertFalse(mock_workflow_importer.called)
+
     @patch('data.importers.WorkflowImporter')
     @patch('data.importers.JobQuestionnaireImporter')
     @patch('data.importers.CWLDocument')
@@ -206,3 +491,283 @@ class JobQuestionnaireImporterTestCase(TestCase):
             importer.run()
         self.assertIn('Unable to import questionnaire', cm.exception.message)
 
+
+@patch('data.importers.get_artifact_resolver')
+@patch('data.importers.connections')
+@patch('data.importers.ProcessPoolExecutor', ThreadPoolExecutor)
+@patch('data.importers.DOICitationResolver')
+@patch('data.importers.WorkflowQuestionnaireImporter')
+@patch('data.importers.prepare_workflow_import')
+class BulkWorkflowImporterTestCase(TestCase):
+    def make_spec(self, workflow_tag, version, cwl_url):
+        return {'workflow_tag': workflow_tag, 'workflow_version_number': version, 'cwl_url': cwl_url,
+                'methods_template_url': 'https://example.com/methods.j2', 'name': 'Questionnaire'}
+
+    @staticmethod
+    def make_summary(citation):
+        return {
+            'doc': 'A workflow',
+            'label': 'Workflow',
+            'input_fields': [],
+            'hints': {'SoftwareRequirement': [
+                {'packages': [{'package': 'tool', 'version': ['1'], SCHEMA_ORG_CITATION: citation}]}
+            ]},
+        }
+
+    def setUp(self):
+        methods_template_cache.clear()
+
+    def test_run(self, mock_prepare_workflow_import, mock_workflow_questionnaire_importer,
+                 mock_doi_citation_resolver, mock_connections, mock_get_artifact_resolver):
+        def prepare_workflow_import(spec):
+            if spec['cwl_url'] == 'bad.cwl':
+                raise ValueError('Bad CWL')
+            return self.make_summary(HTTPS_DOI_URL + spec['cwl_url']), 'hash-' + spec['cwl_url'], 1.5
+        mock_prepare_workflow_import.side_effect = prepare_workflow_import
+        mock_fetch_text_if_modified = mock_get_artifact_resolver.return_value.fetch_text_if_modified
+        mock_fetch_text_if_modified.return_value = ('{{tool.citation}}', '"abc"', None)
+        mock_doi_citation_resolver.return_value.resolve.side_effect = \
+            lambda citations: dict((citation, 'APA ' + citation) for citation in citations)
+        mock_workflow_questionnaire_importer.return_value.created_jobquestionnaire = True
+        specs = [
+            self.make_spec('exome', 1, 'exome1.cwl'),
+            self.make_spec('exome', 2, 'exome2.cwl'),
+            self.make_spec('rnaseq', 1, 'bad.cwl'),
+        ]
+        importer = BulkWorkflowImporter(specs, max_workers=2)
+        results = importer.run()
+
+        self.assertTrue(mock_connections.close_all.called)
+        self.assertEqual([result.succeeded for result in results], [True, True, False])
+        self.assertIn('Bad CWL', results[2].error)
+        self.assertEqual(results[0].prepare_seconds, 1.5)
+        citations = mock_doi_citation_resolver.return_value.resolve.call_args[0][0]
+        self.assertEqual(sorted(citations), [HTTPS_DOI_URL + 'exome1.cwl', HTTPS_DOI_URL + 'exome2.cwl'])
+        self.assertEqual(mock_workflow_questionnaire_importer.call_count, 2)
+        args, kwargs = mock_workflow_questionnaire_importer.call_args_list[0]
+        self.assertEqual(args, (specs[0],))
+        self.assertEqual(kwargs['methods_document_content'], 'APA ' + HTTPS_DOI_URL + 'exome1.cwl')
+        self.assertEqual(kwargs['cwl_document'].url, 'exome1.cwl')
+        self.assertEqual(kwargs['cwl_document'].get('label'), 'Workflow')
+        # the content hash from the worker process is used instead of downloading the document again
+        self.assertEqual(kwargs['cwl_document'].content_hash, 'hash-exome1.cwl')
+        self.assertEqual(set(importer.timings.keys()), {'prepare', 'templates', 'citations', 'save', 'total'})
+        # both versions share a methods template that is only fetched once
+        mock_fetch_text_if_modified.assert_called_once_with('https://example.com/methods.j2', None, None)
+        self.assertEqual(kwargs['methods_template_hash'], hashlib.sha256(b'{{tool.citation}}').hexdigest())
+
+    def test_run_failure_rolls_back_workflow(self, mock_prepare_workflow_import,
+                                             mock_workflow_questionnaire_importer, mock_doi_citation_resolver,
+                                             mock_connections, mock_get_artifact_resolver):
+        mock_prepare_workflow_import.return_value = (self.make_summary('someurl'), 'abc', 1.0)
+        mock_get_artifact_resolver.return_value.fetch_text_if_modified.return_value = ('methods', None, None)
+        mock_doi_citation_resolver.return_value.resolve.return_value = {'someurl': 'someurl'}
+        mock_workflow_questionnaire_importer.return_value.run.side_effect = [
+            None, ImporterException('Unable to import workflow', ValueError('oops')), None
+        ]
+        specs = [
+            self.make_spec('exome', 1, 'exome1.cwl'),
+            self.make_spec('exome', 2, 'exome2.cwl'),
+            self.make_spec('rnaseq', 1, 'rnaseq1.cwl'),
+        ]
+        results = BulkWorkflowImporter(specs).run()
+        self.assertIn('another version of workflow exome failed', results[0].error)
+        self.assertIn('oops', results[1].error)
+        self.assertTrue(results[2].succeeded)
+
+    def test_run_render_error_only_fails_workflow(self, mock_prepare_workflow_import,
+                                                  mock_workflow_questionnaire_importer, mock_doi_citation_resolver,
+                                                  mock_connections, mock_get_artifact_resolver):
+        def prepare_workflow_import(spec):
+            summary = self.make_summary('someurl')
+            summary['doc'] = spec['workflow_tag']
+            return summary, 'abc', 1.0
+
+        def render(methods_document, template_text, apa_citations):
+            if methods_document.workflow_version_description == 'exome':
+                raise ValueError('bad template')
+            return 'methods'
+        mock_prepare_workflow_import.side_effect = prepare_workflow_import
+        mock_get_artifact_resolver.return_value.fetch_text_if_modified.return_value = ('methods', None, None)
+        mock_doi_citation_resolver.return_value.resolve.return_value = {'someurl': 'someurl'}
+        specs = [
+            self.make_spec('exome', 1, 'exome1.cwl'),
+            self.make_spec('rnaseq', 1, 'rnaseq1.cwl'),
+        ]
+        with patch('data.importers.MethodsDocumentContents.render', autospec=True, side_effect=render):
+            results = BulkWorkflowImporter(specs).run()
+        self.assertIn('bad template', results[0].error)
+        self.assertTrue(results[1].succeeded)
+
+
+@patch('data.importers.WorkflowQuestionnaireImporter')
+class WorkflowImportTaskRunnerTestCase(TestCase):
+    def test_run_next_without_tasks(self, mock_importer):
+        self.assertIsNone(WorkflowImportTaskRunner().run_next())
+        self.assertFalse(mock_importer.called)
+
+    def test_run_next(self, mock_importer):
+        stages = []
+
+        def run():
+            listener = mock_importer.call_args[1]['stage_listener']
+            listener('validate')
+            stages.append(WorkflowImportTask.objects.get().stage)
+        mock_importer.return_value.run.side_effect = run
+        mock_importer.return_value.stage_timings = {'validate': 0.5}
+        mock_importer.return_value.job_questionnaire = None
+        task = WorkflowImportTask.objects.create(spec={'name': 'first'})
+        WorkflowImportTask.objects.create(spec={'name': 'second'})
+
+        self.assertEqual(WorkflowImportTaskRunner().run_next().id, task.id)
+        mock_importer.assert_called_with({'name': 'first'}, stage_listener=ANY)
+        self.assertEqual(stages, ['validate'])
+        task.refresh_from_db()
+        self.assertEqual(task.state, WorkflowImportTask.STATE_FINISHED)
+        self.assertEqual(task.stage_timings, {'validate': 0.5})
+        self.assertIsNotNone(task.started)
+        self.assertIsNotNone(task.finished)
+
+    def test_run_next_records_errors(self, mock_importer):
+        mock_importer.return_value.run.side_effect = ImporterException('Unable to import workflow', ValueError('oops'))
+        mock_importer.return_value.stage_timings = {'validate': 0.5, 'import_workflow': 1.0}
+        task = WorkflowImportTask.objects.create(spec={'name': 'first'})
+        WorkflowImportTaskRunner().run_next()
+        task.refresh_from_db()
+        self.assertEqual(task.state, WorkflowImportTask.STATE_ERROR)
+        self.assertEqual(task.error, 'Unable to import workflow: oops')
+        self.assertEqual(task.stage_timings, {'validate': 0.5, 'import_workflow': 1.0})
+
+
+    @override_settings(BESPIN_IMPORT_TASK_TIMEOUT_SECONDS=60)
+    def test_run_next_fails_stale_tasks(self, mock_importer):
+        started = timezone.now() - datetime.timedelta(seconds=120)
+        stale_task = WorkflowImportTask.objects.create(spec={'name': 'stale'}, state=WorkflowImportTask.STATE_RUNNING,
+                                                       started=started)
+        running_task = WorkflowImportTask.objects.create(spec={'name': 'running'},
+                                                         state=WorkflowImportTask.STATE_RUNNING,
+                                                         started=timezone.now())
+        self.assertIsNone(WorkflowImportTaskRunner().run_next())
+        stale_task.refresh_from_db()
+        self.assertEqual(stale_task.state, WorkflowImportTask.STATE_ERROR)
+        self.assertIn('did not finish within 60 seconds', stale_task.error)
+        self.assertIsNotNone(stale_task.finished)
+        running_task.refresh_from_db()
+        self.assertEqual(running_task.state, WorkflowImportTask.STATE_RUNNING)
+
+
+class ArtifactMirrorTestCase(TestCase):
+    def test_put_and_get(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            mirror = ArtifactMirror(temp_dir)
+            self.assertFalse(mirror.contains('https://example.com/exome.cwl'))
+            content_hash = mirror.put('https://example.com/exome.cwl', b'cwlVersion: v1.0')
+            self.assertEqual(content_hash, hashlib.sha256(b'cwlVersion: v1.0').hexdigest())
+            self.assertEqual(mirror.get('https://example.com/exome.cwl'), b'cwlVersion: v1.0')
+            self.assertEqual(mirror.get('sha256:' + content_hash), b'cwlVersion: v1.0')
+            with self.assertRaises(ArtifactNotFoundException):
+                mirror.get('https://example.com/other.cwl')
+            with self.assertRaises(ArtifactNotFoundException):
+                mirror.get('sha256:abc')
+
+    def test_apa_citations(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            mirror = ArtifactMirror(temp_dir)
+            self.assertIsNone(mirror.get_apa_citation('mydoi123'))
+            mirror.put_apa_citation('mydoi123', 'Dr Man 2017')
+            self.assertEqual(mirror.get_apa_citation('mydoi123'), 'Dr Man 2017')
+
+
+class MirrorArtifactResolverTestCase(TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.mirror = ArtifactMirror(self.temp_dir.name)
+        self.mirror.put('https://example.com/exome.cwl', b'cwlVersion: v1.0')
+        self.mirror.put_apa_citation('mydoi123', 'Dr Man 2017')
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_offline(self):
+        resolver = MirrorArtifactResolver(self.mirror)
+        self.assertEqual(resolver.fetch('https://example.com/exome.cwl'), b'cwlVersion: v1.0')
+        self.assertEqual(resolver.fetch_text('https://example.com/exome.cwl'), 'cwlVersion: v1.0')
+        self.assertEqual(resolver.fetch_apa_citation('mydoi123'), 'Dr Man 2017')
+        local_url = resolver.get_local_url('https://example.com/exome.cwl')
+        self.assertTrue(local_url.startswith('file://'))
+        self.assertEqual(resolver.fetch(local_url), b'cwlVersion: v1.0')
+        with self.assertRaises(ArtifactNotFoundException):
+            resolver.fetch('https://example.com/other.cwl')
+        with self.assertRaises(ArtifactNotFoundException):
+            resolver.get_local_url('https://example.com/other.cwl')
+        with self.assertRaises(ArtifactNotFoundException):
+            resolver.fetch_apa_citation('otherdoi')
+
+    def test_fallback(self):
+        fallback_resolver = Mock()
+        resolver = MirrorArtifactResolver(self.mirror, fallback_resolver)
+        self.assertEqual(resolver.fetch('https://example.com/exome.cwl'), b'cwlVersion: v1.0')
+        self.assertEqual(resolver.fetch('https://example.com/other.cwl'), fallback_resolver.fetch.return_value)
+        fallback_resolver.fetch.assert_called_with('https://example.com/other.cwl')
+        self.assertEqual(resolver.fetch_apa_citation('otherdoi'), fallback_resolver.fetch_apa_citation.return_value)
+
+    def test_get_artifact_resolver(self):
+        with override_settings(BESPIN_ARTIFACT_MIRROR_DIR=None, BESPIN_ARTIFACT_OFFLINE=False):
+            self.assertIsInstance(get_artifact_resolver(), NetworkArtifactResolver)
+        with override_settings(BESPIN_ARTIFACT_MIRROR_DIR=self.temp_dir.name, BESPIN_ARTIFACT_OFFLINE=False):
+            resolver = get_artifact_resolver()
+            self.assertIsInstance(resolver, MirrorArtifactResolver)
+            self.assertIsInstance(resolver.fallback_resolver, NetworkArtifactResolver)
+        with override_settings(BESPIN_ARTIFACT_MIRROR_DIR=self.temp_dir.name, BESPIN_ARTIFACT_OFFLINE=True):
+            self.assertIsNone(get_artifact_resolver().fallback_resolver)
+        with override_settings(BESPIN_ARTIFACT_MIRROR_DIR=None, BESPIN_ARTIFACT_OFFLINE=True):
+            with self.assertRaises(ArtifactNotFoundException):
+                get_artifact_resolver()
+
+    @override_settings(BESPIN_CWL_CACHE_DIR=None)
+    @patch('data.importers.load_tool')
+    @patch('data.importers.requests')
+    def test_cwl_document_loaded_from_mirror(self, mock_requests, mock_load_tool):
+        resolver = MirrorArtifactResolver(self.mirror)
+        CWLDocument('https://example.com/exome.cwl', artifact_resolver=resolver).parsed
+        local_url = resolver.get_local_url('https://example.com/exome.cwl')
+        self.assertEqual(mock_load_tool.call_args[0][0], local_url + '#main')
+        self.assertFalse(mock_requests.get.called)
+
+
+@override_settings(BESPIN_CWL_CACHE_DIR=None)
+@patch('data.importers.load_tool')
+class ArtifactPrefetcherTestCase(TestCase):
+    def setUp(self):
+        self.spec = {
+            'cwl_url': 'https://example.com/exome.cwl',
+            'methods_template_url': 'https://example.com/exome.md.j2',
+        }
+        self.parsed = Mock(inputs_record_schema={'fields': []}, tool={'label': 'Exome', 'doc': 'Exome pipeline'},
+                           requirements=[],
+                           hints=[{'class': 'SoftwareRequirement', 'packages': [
+                               {'package': 'sometool', 'version': ['1'], SCHEMA_ORG_CITATION: 'someurl'},
+                               {'package': 'othertool', 'version': ['3'],
+                                SCHEMA_ORG_CITATION: HTTPS_DOI_URL + 'mydoi123'},
+                           ]}])
+        del self.parsed.steps
+        self.network_resolver = Mock()
+        self.network_resolver.fetch.side_effect = lambda url: url.encode('utf-8')
+        self.network_resolver.fetch_apa_citation.return_value = 'Dr Man 2017'
+
+    def test_prefetch(self, mock_load_tool):
+        mock_load_tool.return_value = self.parsed
+        with tempfile.TemporaryDirectory() as temp_dir:
+            mirror = ArtifactMirror(temp_dir)
+            prefetcher = ArtifactPrefetcher(mirror, network_resolver=self.network_resolver)
+            fetched = prefetcher.prefetch(self.spec)
+            self.assertEqual(fetched, ['https://example.com/exome.cwl', 'https://example.com/exome.md.j2',
+                                       HTTPS_DOI_URL + 'mydoi123'])
+            self.assertEqual(mirror.get('https://example.com/exome.md.j2'), b'https://example.com/exome.md.j2')
+            self.assertEqual(mirror.get_apa_citation('mydoi123'), 'Dr Man 2017')
+            self.assertTrue(mock_load_tool.call_args[0][0].startswith('file://'))
+
+            # artifacts already in the mirror are skipped unless refreshing
+            self.assertEqual(prefetcher.prefetch(self.spec), [])
+            prefetcher = ArtifactPrefetcher(mirror, refresh=True, network_resolver=self.network_resolver)
+            self.assertEqual(len(prefetcher.prefetch(self.spec)), 3)
@@ -4,9 +4,10 @@ from django.test import override_settings
 from rest_framework.exceptions import ValidationError
 from unittest.mock import MagicMock, patch, Mock
 from data.models import DDSEndpoint, DDSUserCredential, Workflow, WorkflowVersion, JobFileStageGroup, ShareGroup, \
-    DDSJobInputFile, URLJobInputFile, VMFlavor, VMProject, VMSettings, CloudSettings, Job
+    DDSJobInputFile, URLJobInputFile, VMFlavor, VMProject, VMSettings, CloudSettings, Job, JobDDSOutputProject
 from data.jobfactory import JobFactory, JobFactoryException, JobVMStrategy, calculate_stage_group_size, \
-    calculate_volume_size
+    calculate_volume_size, calculate_stage_group_sizes, JobBatchFactory, VolumeSizePredictor, \
+    VOLUME_SIZING_MODE_PREDICTED, BYTES_TO_GB_DIVISOR, WorkerDDSUserCredentialCache, create_output_projects
 import json
 
 
@@ -112,6 +113,39 @@ class JobFactoryTests(TestCase):
             URLJobInputFile.objects.create(stage_group=stage_group, size=size)
         self.assertEqual(3.00977, round(calculate_stage_group_size(stage_group), 5))
 
+    def test_calculate_stage_group_sizes(self):
+        stage_group2 = JobFileStageGroup.objects.create(user=self.user)
+        DDSJobInputFile.objects.create(stage_group=self.stage_group, dds_user_credentials=self.worker_cred,
+                                       size=1024 * 1024 * 1024)
+        URLJobInputFile.objects.create(stage_group=self.stage_group, size=1024 * 1024 * 1024)
+        URLJobInputFile.objects.create(stage_group=stage_group2, size=512 * 1024 * 1024)
+        sizes = calculate_stage_group_sizes([self.stage_group, stage_group2])
+        self.assertEqual(sizes, {self.stage_group.id: 2.0, stage_group2.id: 0.5})
+
+    @override_settings(REQUIRE_JOB_TOKENS=False)
+    def test_batch_factory_creates_jobs(self):
+        stage_group2 = JobFileStageGroup.objects.create(user=self.user)
+        URLJobInputFile.objects.create(stage_group=stage_group2, size=2 * 1024 * 1024 * 1024)
+        self.job_vm_strategy.volume_size_base = 10
+        self.job_vm_strategy.volume_size_factor = 5
+        factory = JobBatchFactory(user=self.user, workflow_version=self.workflow_version,
+                                  system_job_order={'input2': 'system'}, job_vm_strategy=self.job_vm_strategy,
+                                  share_group=self.share_group)
+        jobs = factory.create_jobs([
+            ('Job 1', '123-4', self.stage_group, {'input1': 'one'}),
+            ('Job 2', '123-5', stage_group2, {'input1': 'two'}),
+        ])
+        self.assertEqual([job.name for job in jobs], ['Job 1', 'Job 2'])
+        job1, job2 = Job.objects.order_by('name')
+        self.assertEqual(json.loads(job1.job_order), {'input1': 'one', 'input2': 'system'})
+        self.assertEqual(job1.stage_group, self.stage_group)
+        self.assertEqual(job1.volume_size, 10)
+        self.assertEqual(job2.fund_code, '123-5')
+        self.assertEqual(job2.volume_size, 20)
+        self.assertEqual(job2.state, Job.JOB_STATE_AUTHORIZED)
+        self.assertEqual(job2.output_project.dds_user_credentials, self.worker_cred)
+        self.assertEqual([activity.state for activity in job2.job_activities.all()], [Job.JOB_STATE_AUTHORIZED])
+
     @patch('data.jobfactory.calculate_stage_group_size')
     def test_calculate_volume_size(self, mock_calculate_stage_group_size):
         mock_calculate_stage_group_size.return_value = 20
@@ -119,3 +153,164 @@ class JobFactoryTests(TestCase):
         volume_size_factor = 4
         stage_group = Mock()
         self.assertEqual(4 * 20 + 10, calculate_volume_size(volume_size_base, volume_size_factor, stage_group))
+
+
+class VolumeSizePredictorTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('test_user')
+        self.endpoint = DDSEndpoint.objects.create(name='app1', agent_key='abc123')
+        self.worker_cred = DDSUserCredential.objects.create(user=self.user, token='abc123', endpoint=self.endpoint)
+        workflow = Workflow.objects.create(name='RnaSeq')
+        self.workflow_version = WorkflowVersion.objects.create(workflow=workflow, object_name='#main', version='1',
+                                                               url=FLY_RNASEQ_URL, fields=[])
+        self.share_group = ShareGroup.objects.create(name='result data checkers')
+        vm_project = VMProject.objects.create(name='project1')
+        cloud_settings = CloudSettings.objects.create(name='cloud1', vm_project=vm_project)
+        self.vm_settings = VMSettings.objects.create(name='settings1', cloud_settings=cloud_settings)
+        self.vm_flavor = VMFlavor.objects.create(name='flavor1')
+        self.job_vm_strategy = JobVMStrategy(self.vm_settings, self.vm_flavor,
+                                             volume_size_base=100, volume_size_factor=10,
+                                             volume_mounts=json.dumps({'/dev/vdb1': '/work'}))
+
+    def create_job(self, data_size_in_gb, volume_size_used, state=Job.JOB_STATE_FINISHED, volume_size_predicted=False):
+        stage_group = JobFileStageGroup.objects.create(user=self.user)
+        URLJobInputFile.objects.create(stage_group=stage_group, size=data_size_in_gb * BYTES_TO_GB_DIVISOR)
+        return Job.objects.create(workflow_version=self.workflow_version, user=self.user, stage_group=stage_group,
+                                  vm_settings=self.vm_settings, vm_flavor=self.vm_flavor,
+                                  share_group=self.share_group, volume_size=500, volume_size_used=volume_size_used,
+                                  volume_size_predicted=volume_size_predicted, state=state)
+
+    def test_fit(self):
+        self.assertEqual(VolumeSizePredictor.fit([(1, 20), (2, 30), (3, 40)], min_jobs=3), (10.0, 10.0))
+        # the base covers the job that used the most space
+        self.assertEqual(VolumeSizePredictor.fit([(1, 20), (1, 30)], min_jobs=1), (30.0, 0.0))
+        self.assertEqual(VolumeSizePredictor.fit([(1, 20), (2, 35), (3, 40)], min_jobs=1), (15.0, 10.0))
+        # factor is never negative
+        self.assertEqual(VolumeSizePredictor.fit([(1, 40), (3, 20)], min_jobs=1), (40.0, 0.0))
+        self.assertEqual(VolumeSizePredictor.fit([(1, 20), (2, 30)], min_jobs=3), None)
+        self.assertEqual(VolumeSizePredictor.fit([], min_jobs=0), None)
+
+    def test_predict(self):
+        self.create_job(1, 20)
+        self.create_job(2, 30)
+        self.create_job(3, 40)
+        self.create_job(1, 500, state=Job.JOB_STATE_ERROR)
+        self.create_job(1, None)
+        self.create_job(1, 300, volume_size_predicted=True)
+        predictor = VolumeSizePredictor(self.workflow_version, margin=0.5, min_jobs=3, max_jobs=10)
+        self.assertEqual(sorted(predictor.get_finished_job_sizes()), [(1.0, 20), (2.0, 30), (3.0, 40)])
+        self.assertEqual(predictor.predict(4, default_volume_size=100), 75)
+        # never more than the vm strategy settings give the job
+        self.assertEqual(predictor.predict(4, default_volume_size=60), 60)
+
+    def test_predict_without_enough_jobs(self):
+        self.create_job(1, 20)
+        predictor = VolumeSizePredictor(self.workflow_version, margin=0.5, min_jobs=3, max_jobs=10)
+        self.assertEqual(predictor.predict(4, default_volume_size=100), None)
+
+    @override_settings(BESPIN_VOLUME_SIZING_MODE=VOLUME_SIZING_MODE_PREDICTED, BESPIN_VOLUME_SIZE_MARGIN=0,
+                       BESPIN_VOLUME_SIZE_MIN_JOBS=2, BESPIN_VOLUME_SIZE_MAX_JOBS=10)
+    def test_job_factory_predicted_mode(self):
+        self.create_job(1, 20)
+        self.create_job(3, 40)
+        stage_group = JobFileStageGroup.objects.create(user=self.user)
+        URLJobInputFile.objects.create(stage_group=stage_group, size=2 * BYTES_TO_GB_DIVISOR)
+        job_factory = JobFactory(user=self.user, workflow_version=self.workflow_version,
+                                 job_name='Test Job', fund_code='123-4', stage_group=stage_group,
+                                 system_job_order={}, user_job_order={},
+                                 job_vm_strategy=self.job_vm_strategy, share_group=self.share_group)
+        job = job_factory.create_job()
+        self.assertEqual(job.volume_size, 30)
+        self.assertEqual(job.volume_size_predicted, True)
+
+    @override_settings(BESPIN_VOLUME_SIZING_MODE=VOLUME_SIZING_MODE_PREDICTED, BESPIN_VOLUME_SIZE_MIN_JOBS=2)
+    def test_job_factory_predicted_mode_without_enough_jobs(self):
+        stage_group = JobFileStageGroup.objects.create(user=self.user)
+        URLJobInputFile.objects.create(stage_group=stage_group, size=2 * BYTES_TO_GB_DIVISOR)
+        job_factory = JobFactory(user=self.user, workflow_version=self.workflow_version,
+                                 job_name='Test Job', fund_code='123-4', stage_group=stage_group,
+                                 system_job_order={}, user_job_order={},
+                                 job_vm_strategy=self.job_vm_strategy, share_group=self.share_group)
+        job = job_factory.create_job()
+        self.assertEqual(job.volume_size, 120)
+        self.assertEqual(job.volume_size_predicted, False)
+
+    def test_job_factory_static_mode(self):
+        self.create_job(1, 20)
+        self.create_job(3, 40)
+        stage_group = JobFileStageGroup.objects.create(user=self.user)
+        URLJobInputFile.objects.create(stage_group=stage_group, size=2 * BYTES_TO_GB_DIVISOR)
+        job_factory = JobFactory(user=self.user, workflow_version=self.workflow_version,
+                                 job_name='Test Job', fund_code='123-4', stage_group=stage_group,
+                                 system_job_order={}, user_job_order={},
+                                 job_vm_strategy=self.job_vm_strategy, share_group=self.share_group)
+        job = job_factory.create_job()
+        self.assertEqual(job.volume_size, 120)
+        self.assertEqual(job.volume_size_predicted, False)
+
+
+class WorkerDDSUserCredentialCacheTests(TestCase):
+    def setUp(self):
+        WorkerDDSUserCredentialCache.clear()
+        self.endpoint = DDSEndpoint.objects.create(name='app1', agent_key='abc123')
+        self.user1 = User.objects.create_user('user1')
+        self.user2 = User.objects.create_user('user2')
+
+    def tearDown(self):
+        WorkerDDSUserCredentialCache.clear()
+
+    def test_get_first_credential(self):
+        cred1 = DDSUserCredential.objects.create(user=self.user1, token='abc123', endpoint=self.endpoint)
+        DDSUserCredential.objects.create(user=self.user2, token='def456', endpoint=self.endpoint, dds_id='2')
+        self.assertEqual(WorkerDDSUserCredentialCache.get(), cred1)
+        with self.assertNumQueries(0):
+            self.assertEqual(WorkerDDSUserCredentialCache.get(), cred1)
+
+    def test_get_configured_credential(self):
+        DDSUserCredential.objects.create(user=self.user1, token='abc123', endpoint=self.endpoint)
+        cred2 = DDSUserCredential.objects.create(user=self.user2, token='def456', endpoint=self.endpoint, dds_id='2')
+        with override_settings(BESPIN_WORKER_DDS_USER_CREDENTIAL_ID=cred2.id):
+            self.assertEqual(WorkerDDSUserCredentialCache.get(), cred2)
+        with override_settings(BESPIN_WORKER_DDS_USER_CREDENTIAL_ID=cred2.id + 100):
+            with self.assertRaises(JobFactoryException):
+                WorkerDDSUserCredentialCache.get()
+
+    @patch('data.jobfactory.time')
+    def test_expires(self, mock_time):
+        cred1 = DDSUserCredential.objects.create(user=self.user1, token='abc123', endpoint=self.endpoint)
+        mock_time.time.return_value = 100
+        self.assertEqual(WorkerDDSUserCredentialCache.get().token, 'abc123')
+        # queryset updates do not send signals, like changes made by another process
+        DDSUserCredential.objects.filter(pk=cred1.pk).update(token='def456')
+        with override_settings(BESPIN_WORKER_DDS_USER_CREDENTIAL_CACHE_SECONDS=60):
+            mock_time.time.return_value = 159
+            self.assertEqual(WorkerDDSUserCredentialCache.get().token, 'abc123')
+            mock_time.time.return_value = 160
+            self.assertEqual(WorkerDDSUserCredentialCache.get().token, 'def456')
+
+    def test_cleared_when_credentials_change(self):
+        cred1 = DDSUserCredential.objects.create(user=self.user1, token='abc123', endpoint=self.endpoint)
+        self.assertEqual(WorkerDDSUserCredentialCache.get(), cred1)
+        cred1.delete()
+        with self.assertRaises(JobFactoryException):
+            WorkerDDSUserCredentialCache.get()
+        cred2 = DDSUserCredential.objects.create(user=self.user2, token='def456', endpoint=self.endpoint, dds_id='2')
+        self.assertEqual(WorkerDDSUserCredentialCache.get(), cred2)
+
+    def test_create_output_projects(self):
+        cred1 = DDSUserCredential.objects.create(user=self.user1, token='abc123', endpoint=self.endpoint)
+        workflow = Workflow.objects.create(name='RnaSeq')
+        workflow_version = WorkflowVersion.objects.create(workflow=workflow, object_name='#main', version='1',
+                                                          url=FLY_RNASEQ_URL, fields=[])
+        cloud_settings = CloudSettings.objects.create(name='cloud1',
+                                                      vm_project=VMProject.objects.create(name='project1'))
+        job_fields = dict(workflow_version=workflow_version, user=self.user1,
+                          vm_settings=VMSettings.objects.create(name='settings1', cloud_settings=cloud_settings),
+                          vm_flavor=VMFlavor.objects.create(name='flavor1'),
+                          share_group=ShareGroup.objects.create(name='result data checkers'))
+        jobs = [Job.objects.create(name='Job 1', **job_fields), Job.objects.create(name='Job 2', **job_fields)]
+        WorkerDDSUserCredentialCache.get()
+        with self.assertNumQueries(1):
+            create_output_projects(jobs)
+        self.assertEqual(set(JobDDSOutputProject.objects.values_list('job', 'dds_user_credentials')),
+                         {(jobs[0].id, cred1.id), (jobs[1].id, cred1.id)})
@@ -4,7 +4,7 @@ from data.models import Job, JobActivity, Workflow, WorkflowVersion, ShareGroup,
     VMSettings
 import datetime
 from unittest.mock import Mock, patch
-from data.jobusage import JobUsage
+from data.jobusage import JobUsage, VMFlavorUsageReport, VMFlavorRecommendation, VMFlavorUsage
 from django.utils import timezone
 
 
@@ -187,3 +187,88 @@ class JobUsageTests(TestCase):
         mock_timezone.return_value = self.created_ts('14:30')
         usage = JobUsage(job)
         self.assertEqual(usage.vm_hours * 60, 35)  # 2(staging) + 8(running) + 20(running) + 5(store output)
+
+
+class VMFlavorUsageReportTests(TestCase):
+    def setUp(self):
+        workflow = Workflow.objects.create(name='RnaSeq')
+        self.workflow_version = WorkflowVersion.objects.create(workflow=workflow, object_name='#main', version='1',
+                                                               url='someurl', fields=[])
+        self.user = User.objects.create_user('test_user')
+        self.share_group = ShareGroup.objects.create(name='Results Checkers')
+        self.small_flavor = VMFlavor.objects.create(name='small', cpus=2)
+        self.large_flavor = VMFlavor.objects.create(name='large', cpus=8)
+        vm_project = VMProject.objects.create(name='project1')
+        cloud_settings = CloudSettings.objects.create(vm_project=vm_project)
+        self.vm_settings = VMSettings.objects.create(cloud_settings=cloud_settings)
+
+    def create_job(self, vm_flavor, running_hours, state=Job.JOB_STATE_FINISHED):
+        job = Job.objects.create(workflow_version=self.workflow_version, user=self.user, job_order='{}',
+                                 share_group=self.share_group, vm_settings=self.vm_settings, vm_flavor=vm_flavor)
+        JobActivity.objects.filter(job=job).delete()
+        start = datetime.datetime(2018, 1, 1, 12, 0, tzinfo=timezone.utc)
+        activity_values = [
+            (Job.JOB_STATE_RUNNING, Job.JOB_STEP_CREATE_VM, start),
+            (Job.JOB_STATE_RUNNING, Job.JOB_STEP_STAGING, start + datetime.timedelta(hours=1)),
+            (Job.JOB_STATE_RUNNING, Job.JOB_STEP_RUNNING, start + datetime.timedelta(hours=2)),
+            (state, '', start + datetime.timedelta(hours=1 + running_hours)),
+        ]
+        for activity_state, step, created in activity_values:
+            activity = JobActivity.objects.create(job=job, state=activity_state, step=step)
+            # override default auto_now_add behavior
+            activity.created = created
+            activity.save()
+        Job.objects.filter(pk=job.pk).update(state=state)
+        return job
+
+    def test_get_usages(self):
+        self.create_job(self.small_flavor, running_hours=2)
+        self.create_job(self.small_flavor, running_hours=4)
+        self.create_job(self.large_flavor, running_hours=1)
+        self.create_job(self.large_flavor, running_hours=20, state=Job.JOB_STATE_ERROR)
+        small_usage, large_usage = VMFlavorUsageReport(percentile=0.5).get_usages()
+        self.assertEqual(small_usage.workflow_version_id, self.workflow_version.id)
+        self.assertEqual(small_usage.vm_flavor_name, 'small')
+        self.assertEqual(small_usage.job_count, 2)
+        self.assertAlmostEqual(small_usage.median_vm_hours, 3.0)
+        self.assertAlmostEqual(small_usage.mean_cpu_hours, 6.0)
+        self.assertAlmostEqual(small_usage.total_cpu_hours, 12.0)
+        self.assertEqual(large_usage.vm_flavor_name, 'large')
+        self.assertEqual(large_usage.job_count, 1)
+        self.assertAlmostEqual(large_usage.percentile_vm_hours, 1.0)
+        self.assertAlmostEqual(large_usage.mean_cpu_hours, 8.0)
+
+    def test_get_usages_filters(self):
+        self.create_job(self.small_flavor, running_hours=2)
+        self.create_job(self.small_flavor, running_hours=4)
+        self.create_job(self.large_flavor, running_hours=1)
+        usages = VMFlavorUsageReport(min_jobs=2).get_usages()
+        self.assertEqual([usage.vm_flavor_name for usage in usages], ['small'])
+        self.assertEqual(VMFlavorUsageReport(workflow_version_ids=[self.workflow_version.id + 1]).get_usages(), [])
+
+    def test_get_recommendations(self):
+        self.create_job(self.small_flavor, running_hours=2)
+        self.create_job(self.small_flavor, running_hours=4)
+        self.create_job(self.large_flavor, running_hours=1)
+        report = VMFlavorUsageReport(percentile=1.0)
+        recommendation, = report.get_recommendations(target_vm_hours=4)
+        self.assertTrue(recommendation.meets_target)
+        self.assertEqual(recommendation.vm_flavor_id, self.small_flavor.id)
+        recommendation, = report.get_recommendations(target_vm_hours=2)
+        self.assertTrue(recommendation.meets_target)
+        self.assertEqual(recommendation.vm_flavor_id, self.large_flavor.id)
+        recommendation, = report.get_recommendations(target_vm_hours=0.5)
+        self.assertFalse(recommendation.meets_target)
+        self.assertEqual(recommendation.vm_flavor_id, self.large_flavor.id)
+
+
+class VMFlavorRecommendationTests(TestCase):
+    def test_picks_fewest_cpu_hours_meeting_target(self):
+        usages = [
+            VMFlavorUsage(1, 1, 'small', 2, 10, 5.0, 9.0, 10.0, 100.0),
+            VMFlavorUsage(1, 2, 'medium', 4, 10, 2.0, 3.0, 8.0, 80.0),
+            VMFlavorUsage(1, 3, 'large', 8, 10, 1.0, 2.0, 8.0, 80.0),
+        ]
+        recommendation = VMFlavorRecommendation(1, usages, target_vm_hours=4)
+        self.assertTrue(recommendation.meets_target)
+        self.assertEqual(recommendation.vm_flavor_name, 'medium')
@@ -1,6 +1,17 @@
 from django.test import TestCase
-from data.mailer import EmailMessageFactory, EmailMessageSender, JobMailer
-from data.models import EmailMessage, EmailTemplate, Job
+from data.mailer import EmailMessageFactory, EmailMessageSender, EmailMessageBatchSender, JobMailer, \
+    EmailTemplateCache, JobNotificationDigester, MailerClient, make_mailer_payload, \
+    queue_email_messages, publish_pending_email_messages
+from data.models import EmailMessage, EmailTemplate, Job, JobNotification, Workflow, WorkflowVersion, VMFlavor, \
+    ShareGroup
+from data.tests_api import add_vm_settings
+from django.contrib.auth.models import User
+from django.utils import timezone
+import datetime
+import json
+import pickle
+import time
+from django.template import Template
 from unittest.mock import MagicMock, patch, call
 from data.exceptions import EmailServiceException, EmailAlreadySentException
 from django.test.utils import override_settings
@@ -35,6 +46,48 @@ class EmailMessageFactoryTestCase(TestCase):
         self.assertEqual(message.to_email, self.to_email)
 
 
+@override_settings(BESPIN_MAILER_TEMPLATE_CACHE_SECONDS=60)
+class EmailTemplateCacheTestCase(TestCase):
+
+    def setUp(self):
+        self.email_template = EmailTemplate.objects.create(
+            name='template1',
+            body_template='Body {{ field1 }}',
+            subject_template='Subject {{ field2}}',
+        )
+
+    def test_get_email_template_reuses_lookup(self):
+        cache = EmailTemplateCache()
+        with self.assertNumQueries(1):
+            self.assertEqual(cache.get_email_template('template1').pk, self.email_template.pk)
+            self.assertEqual(cache.get_email_template('template1').pk, self.email_template.pk)
+
+    @override_settings(BESPIN_MAILER_TEMPLATE_CACHE_SECONDS=0)
+    def test_get_email_template_without_caching(self):
+        cache = EmailTemplateCache()
+        with self.assertNumQueries(2):
+            cache.get_email_template('template1')
+            cache.get_email_template('template1')
+
+    @patch('data.mailer.Template')
+    def test_get_compiled_template_compiles_changed_text(self, mock_template):
+        cache = EmailTemplateCache()
+        cache.get_compiled_template(self.email_template.pk, 'Body {{ field1 }}')
+        cache.get_compiled_template(self.email_template.pk, 'Body {{ field1 }}')
+        self.assertEqual(mock_template.call_count, 1)
+        cache.get_compiled_template(self.email_template.pk, 'New Body {{ field1 }}')
+        self.assertEqual(mock_template.call_count, 2)
+
+    def test_saving_template_invalidates_default_cache(self):
+        factory = EmailMessageFactory(self.email_template)
+        message = factory.make_message({'field1': 'abc', 'field2': 'def'}, 'sender@example.com', 'to@example.com')
+        self.assertEqual(message.body, 'Body abc')
+        self.email_template.body_template = 'Changed {{ field1 }}'
+        self.email_template.save()
+        message = factory.make_message({'field1': 'abc', 'field2': 'def'}, 'sender@example.com', 'to@example.com')
+        self.assertEqual(message.body, 'Changed abc')
+
+
 class EmailMessageSenderTestCase(TestCase):
 
     def setUp(self):
@@ -92,6 +145,103 @@ class EmailMessageSenderTestCase(TestCase):
         self.assertTrue(mock_send.call_args(self.subject, self.body, self.sender_email, [self.to_email], bcc=[bcc_emails]))
 
 
+class EmailMessageBatchSenderTestCase(TestCase):
+
+    def setUp(self):
+        self.email_messages = [
+            EmailMessage.objects.create(
+                body='Message Body {}'.format(i),
+                subject='Message Subject {}'.format(i),
+                sender_email='sender@example.com',
+                to_email='recipient{}@university.edu'.format(i)
+            ) for i in range(3)
+        ]
+        self.sent_message = EmailMessage.objects.create(
+            body='Already sent',
+            subject='Already sent',
+            sender_email='sender@example.com',
+            to_email='recipient@university.edu',
+            state=EmailMessage.MESSAGE_STATE_SENT,
+        )
+
+    def get_states(self):
+        return [EmailMessage.objects.get(pk=message.pk).state for message in self.email_messages]
+
+    @patch('data.mailer.get_connection')
+    def test_send_pending_uses_one_connection_per_batch(self, mock_get_connection):
+        sender = EmailMessageBatchSender(batch_size=2)
+        sent_count, error_count = sender.send_pending()
+        self.assertEqual(sent_count, 3)
+        self.assertEqual(error_count, 0)
+        self.assertEqual(self.get_states(), [EmailMessage.MESSAGE_STATE_SENT] * 3)
+        # two batches: one with two messages and one with a single message
+        self.assertEqual(mock_get_connection.return_value.open.call_count, 2)
+        self.assertEqual(mock_get_connection.return_value.close.call_count, 2)
+        self.assertEqual(mock_get_connection.return_value.send_messages.call_count, 3)
+        sent_to_emails = [args[0][0].to for args, kwargs in
+                          mock_get_connection.return_value.send_messages.call_args_list]
+        self.assertEqual(sent_to_emails, [[message.to_email] for message in self.email_messages])
+
+    @patch('data.mailer.get_connection')
+    def test_send_pending_records_errors(self, mock_get_connection):
+        mock_get_connection.return_value.send_messages.side_effect = [1, Exception('Rejected'), 1]
+        sender = EmailMessageBatchSender(batch_size=10)
+        sent_count, error_count = sender.send_pending()
+        self.assertEqual(sent_count, 2)
+        self.assertEqual(error_count, 1)
+        self.assertEqual(self.get_states(), [
+            EmailMessage.MESSAGE_STATE_SENT,
+            EmailMessage.MESSAGE_STATE_ERROR,
+            EmailMessage.MESSAGE_STATE_SENT,
+        ])
+        self.assertEqual(EmailMessage.objects.get(pk=self.email_messages[1].pk).errors, 'Rejected')
+
+    @patch('data.mailer.get_connection')
+    def test_send_batch_connection_failure_marks_batch_error(self, mock_get_connection):
+        mock_get_connection.return_value.open.side_effect = Exception('Connection refused')
+        sender = EmailMessageBatchSender(batch_size=10)
+        sent_count, error_count = sender.send_batch()
+        self.assertEqual(sent_count, 0)
+        self.assertEqual(error_count, 3)
+        self.assertEqual(self.get_states(), [EmailMessage.MESSAGE_STATE_ERROR] * 3)
+        self.assertFalse(mock_get_connection.return_value.send_messages.called)
+
+    @patch('data.mailer.get_connection')
+    def test_send_pending_retries_messages_that_are_due(self, mock_get_connection):
+        EmailMessage.objects.filter(pk=self.email_messages[0].pk).update(
+            state=EmailMessage.MESSAGE_STATE_ERROR, attempts=1,
+            next_attempt=timezone.now() - datetime.timedelta(seconds=1))
+        EmailMessage.objects.filter(pk=self.email_messages[1].pk).update(
+            state=EmailMessage.MESSAGE_STATE_ERROR, attempts=1,
+            next_attempt=timezone.now() + datetime.timedelta(seconds=600))
+        EmailMessage.objects.filter(pk=self.email_messages[2].pk).update(
+            state=EmailMessage.MESSAGE_STATE_DEAD, attempts=5)
+        sent_count, error_count = EmailMessageBatchSender(batch_size=10).send_pending()
+        self.assertEqual(sent_count, 1)
+        self.assertEqual(error_count, 0)
+        self.assertEqual(self.get_states(), [
+            EmailMessage.MESSAGE_STATE_SENT,
+            EmailMessage.MESSAGE_STATE_ERROR,
+            EmailMessage.MESSAGE_STATE_DEAD,
+        ])
+        self.assertIsNone(EmailMessage.objects.get(pk=self.email_messages[0].pk).next_attempt)
+
+    @override_settings(BESPIN_MAILER_MAX_ATTEMPTS=2)
+    @patch('data.mailer.get_connection')
+    def test_send_batch_moves_failed_messages_to_dead(self, mock_get_connection):
+        mock_get_connection.return_value.send_messages.side_effect = Exception('Rejected')
+        EmailMessage.objects.filter(pk=self.email_messages[0].pk).update(attempts=1)
+        sent_count, error_count = EmailMessageBatchSender(batch_size=10).send_batch()
+        self.assertEqual(error_count, 3)
+        self.assertEqual(self.get_states(), [
+            EmailMessage.MESSAGE_STATE_DEAD,
+            EmailMessage.MESSAGE_STATE_ERROR,
+            EmailMessage.MESSAGE_STATE_ERROR,
+        ])
+        # failed messages are not retried until their next attempt time
+        self.assertEqual(EmailMessageBatchSender(batch_size=10).send_batch(), (0, 0))
+
+
 FROM_EMAIL = 'sender@otherdomain.com'
 ADMIN_BCC = ['admin-bcc@domain.com']
 
@@ -218,3 +368,177 @@ class JobMailerTestCase(TestCase):
             call().send()
         ]
         self.assertEqual(MockSender.mock_calls, expected_calls)
+
+
+@override_settings(DEFAULT_FROM_EMAIL=FROM_EMAIL)
+@override_settings(BESPIN_MAILER_ADMIN_BCC=ADMIN_BCC)
+@override_settings(BESPIN_MAILER_DIGEST_SECONDS=300)
+class JobNotificationDigestTestCase(TestCase):
+    def setUp(self):
+        EmailTemplate.objects.create(
+            name='job-finished-user',
+            body_template='Finished {{ name }}',
+            subject_template='Job {{ id }} has completed'
+        )
+        EmailTemplate.objects.create(
+            name='job-finished-sharegroup',
+            body_template='Share Group: Finished {{ name }}',
+            subject_template='Share Group: Job {{ id }} has completed'
+        )
+        EmailTemplate.objects.create(
+            name='job-digest',
+            body_template='{% for n in notifications %}{{ n.id }}:{{ n.name }}:{{ n.state }}\n{% endfor %}',
+            subject_template='{{ count }} job updates'
+        )
+        user = User.objects.create_user('test_user', email='user@domain.com')
+        workflow = Workflow.objects.create(name='RnaSeq', tag='rnaseq')
+        workflow_version = WorkflowVersion.objects.create(workflow=workflow, version=1, url='', fields=[])
+        add_vm_settings(self)
+        vm_flavor = VMFlavor.objects.create(name='flavor1')
+        share_group = ShareGroup.objects.create(name='Results Checkers', email='sharegroup@domain.com')
+        self.jobs = [
+            Job.objects.create(workflow_version=workflow_version, user=user, name='Job & {}'.format(i),
+                               vm_settings=self.vm_settings, vm_flavor=vm_flavor, share_group=share_group,
+                               state=Job.JOB_STATE_FINISHED)
+            for i in range(3)
+        ]
+
+    def age_notifications(self, seconds):
+        JobNotification.objects.update(created=timezone.now() - datetime.timedelta(seconds=seconds))
+
+    def test_mail_current_state_buffers_notifications(self):
+        for job in self.jobs:
+            JobMailer(job).mail_current_state()
+        self.assertEqual(EmailMessage.objects.count(), 0)
+        notifications = JobNotification.objects.all()
+        self.assertEqual(len(notifications), 6)
+        self.assertEqual(set([n.to_email for n in notifications]), set(['user@domain.com', 'sharegroup@domain.com']))
+
+    def test_make_digests_waits_for_window(self):
+        for job in self.jobs:
+            JobMailer(job).mail_current_state()
+        self.assertEqual(JobNotificationDigester().make_digests(), [])
+        self.assertEqual(JobNotification.objects.count(), 6)
+
+    def test_make_digests_creates_one_message_per_recipient(self):
+        for job in self.jobs:
+            JobMailer(job).mail_current_state()
+        self.age_notifications(301)
+        messages = JobNotificationDigester().make_digests()
+        self.assertEqual(len(messages), 2)
+        self.assertEqual(JobNotification.objects.count(), 0)
+        user_message = EmailMessage.objects.get(to_email='user@domain.com')
+        self.assertEqual(user_message.subject, '3 job updates')
+        expected_body = ''.join(['{}:Job & {}:Finished\n'.format(job.id, i) for i, job in enumerate(self.jobs)])
+        self.assertEqual(user_message.body, expected_body)
+        self.assertEqual(user_message.sender_email, FROM_EMAIL)
+        self.assertEqual(user_message.bcc_email, ' '.join(ADMIN_BCC))
+        self.assertEqual(user_message.state, EmailMessage.MESSAGE_STATE_NEW)
+
+    def test_make_digests_single_notification_uses_job_template(self):
+        JobMailer(self.jobs[0]).mail_current_state()
+        JobNotification.objects.filter(to_email='sharegroup@domain.com').delete()
+        self.age_notifications(301)
+        messages = JobNotificationDigester().make_digests()
+        self.assertEqual(len(messages), 1)
+        self.assertEqual(messages[0].subject, 'Job {} has completed'.format(self.jobs[0].id))
+        self.assertEqual(messages[0].body, 'Finished Job & 0')
+
+    def test_make_digest_skips_recipient_claimed_by_another_digester(self):
+        self.assertIsNone(JobNotificationDigester()._make_digest('user@domain.com'))
+        self.assertEqual(EmailMessage.objects.count(), 0)
+
+
+@override_settings(DEFAULT_FROM_EMAIL=FROM_EMAIL)
+@override_settings(BESPIN_MAILER_ADMIN_BCC=ADMIN_BCC)
+@override_settings(BESPIN_MAILER_TEMPLATE_CACHE_SECONDS=60)
+class JobMailerRenderBenchmarkTestCase(TestCase):
+    """
+    Renders a burst of job-finished notifications, as sent when a large batch of jobs finishes together.
+    """
+    BURST_SIZE = 100
+    # generous upper bound so the test only fails when rendering becomes pathologically slow
+    MAX_BURST_SECONDS = 10
+
+    def setUp(self):
+        EmailTemplate.objects.create(
+            name='job-finished-user',
+            body_template='Finished {{ name }}',
+            subject_template='Job {{ id }} has completed'
+        )
+        EmailTemplate.objects.create(
+            name='job-finished-sharegroup',
+            body_template='Share Group: Finished {{ name }}',
+            subject_template='Share Group: Job {{ id }} has completed'
+        )
+        user = MagicMock(email='user@domain.com')
+        sharegroup = MagicMock(email='sharegroup@domain.com')
+        self.jobs = []
+        for job_id in range(self.BURST_SIZE):
+            job = MagicMock(state=Job.JOB_STATE_FINISHED, id=job_id, user=user, share_group=sharegroup)
+            job.name = 'Job{}'.format(job_id)
+            self.jobs.append(job)
+
+    @patch('data.mailer.DjangoEmailMessage')
+    def test_job_finished_burst(self, MockSender):
+        with patch('data.mailer.Template', wraps=Template) as mock_template:
+            start_time = time.time()
+            for job in self.jobs:
+                JobMailer(job, queue_messages=False).mail_current_state()
+            seconds = time.time() - start_time
+        timing = "Rendered {} job-finished notifications in {:.3f}s ({:.2f}ms per job)".format(
+            self.BURST_SIZE, seconds, seconds * 1000 / self.BURST_SIZE)
+        self.assertEqual(EmailMessage.objects.count(), self.BURST_SIZE * 2, timing)
+        # subject and body for each of the two templates are compiled a single time
+        self.assertEqual(mock_template.call_count, 4, timing)
+        self.assertLess(seconds, self.MAX_BURST_SECONDS, timing)
+
+
+def read_mailer_payload(body):
+    """
+    Read the email message ids from a JSON body published by MailerClient the way bespin-mailer does
+    """
+    payload = json.loads(body.decode('utf-8') if isinstance(body, bytes) else body)
+    assert payload['version'] == 2
+    return payload['send_emails']
+
+
+@override_settings(BESPIN_MAILER_BATCH_SIZE=2)
+class MailerClientTestCase(TestCase):
+    def test_make_mailer_payload(self):
+        body = make_mailer_payload([1, 2, 3])
+        self.assertEqual(json.loads(body), {'version': 2, 'send_emails': [1, 2, 3]})
+
+    @override_settings(BESPIN_MAILER_LEGACY_QUEUE_PAYLOAD=False)
+    @patch('data.mailer.MailerConfig')
+    @patch('data.mailer.WorkQueueConnection')
+    def test_send_many_publishes_batches_over_one_connection(self, mock_work_queue_connection, mock_config):
+        MailerClient().send_many([1, 2, 3])
+        self.assertEqual(mock_work_queue_connection.return_value.connect.call_count, 1)
+        channel = mock_work_queue_connection.return_value.connection.channel.return_value
+        bodies = [read_mailer_payload(c[2]['body']) for c in channel.basic_publish.mock_calls]
+        self.assertEqual(bodies, [[1, 2], [3]])
+        self.assertEqual(mock_work_queue_connection.return_value.close.call_count, 1)
+
+    @override_settings(BESPIN_MAILER_LEGACY_QUEUE_PAYLOAD=True)
+    @patch('data.mailer.MailerConfig')
+    @patch('data.mailer.WorkQueueConnection')
+    def test_send_many_legacy_payload(self, mock_work_queue_connection, mock_config):
+        MailerClient().send(5)
+        channel = mock_work_queue_connection.return_value.connection.channel.return_value
+        bodies = [pickle.loads(c[2]['body']) for c in channel.basic_publish.mock_calls]
+        self.assertEqual(bodies, [{'send_email': 5}])
+
+    @patch('data.mailer.MailerClient')
+    def test_queue_email_messages_waits_for_commit(self, mock_mailer_client):
+        messages = [EmailMessage.objects.create(body='body', subject='subject', sender_email='sender@example.com',
+                                                to_email='user{}@example.com'.format(i))
+                    for i in range(3)]
+        with patch('data.mailer.transaction.on_commit') as mock_on_commit:
+            queue_email_messages([messages[0].id])
+            queue_email_messages([messages[1].id, messages[2].id, 9999])
+        self.assertFalse(mock_mailer_client.return_value.send_many.called)
+        self.assertEqual(mock_on_commit.call_count, 2)
+        publish_pending_email_messages()
+        publish_pending_email_messages()
+        mock_mailer_client.return_value.send_many.assert_called_once_with([m.id for m in messages])
@@ -12,6 +12,9 @@ from data.models import VMStrategy, WorkflowConfiguration
 from django.db import IntegrityError
 from django.core.exceptions import ValidationError
 from django.contrib.auth.models import User
+from django.test.utils import override_settings
+from django.utils import timezone
+import datetime
 import json
 
 CWL_URL = 'https://raw.githubusercontent.com/johnbradley/iMADS-worker/master/predict_service/predict-workflow-packed.cwl'
@@ -449,6 +452,50 @@ class JobFileStageGroupTests(TestCase):
         self.assertEqual(10000, dds_file.size)
         self.assertEqual(1, dds_file.sequence)
 
+    def test_total_size_tracks_files(self):
+        stage_group = JobFileStageGroup.objects.create(user=self.user)
+        self.assertEqual(0, stage_group.total_size)
+        dds_file = DDSJobInputFile.objects.create(stage_group=stage_group,
+                                                  project_id='1234',
+                                                  file_id='5321',
+                                                  dds_user_credentials=self.user_credentials,
+                                                  destination_path='sample.fasta',
+                                                  size=10000,
+                                                  sequence=1)
+        url_file = URLJobInputFile.objects.create(stage_group=stage_group,
+                                                  url='https://data.org/sample.fasta',
+                                                  destination_path='sample2.fasta',
+                                                  size=20000,
+                                                  sequence=2)
+        self.assertEqual(30000, JobFileStageGroup.objects.get(pk=stage_group.pk).total_size)
+        self.assertEqual(30000, stage_group.calculate_total_size())
+        url_file.size = 5000
+        url_file.save()
+        self.assertEqual(15000, JobFileStageGroup.objects.get(pk=stage_group.pk).total_size)
+        dds_file.delete()
+        self.assertEqual(5000, JobFileStageGroup.objects.get(pk=stage_group.pk).total_size)
+
+    def test_total_size_tracks_reassigned_and_bulk_deleted_files(self):
+        stage_group = JobFileStageGroup.objects.create(user=self.user)
+        other_stage_group = JobFileStageGroup.objects.create(user=self.user)
+        url_file = URLJobInputFile.objects.create(stage_group=stage_group,
+                                                  url='https://data.org/sample.fasta',
+                                                  destination_path='sample.fasta',
+                                                  size=20000,
+                                                  sequence=1)
+        URLJobInputFile.objects.create(stage_group=other_stage_group,
+                                       url='https://data.org/sample2.fasta',
+                                       destination_path='sample2.fasta',
+                                       size=1000,
+                                       sequence=1)
+        url_file.stage_group = other_stage_group
+        url_file.sequence = 2
+        url_file.save()
+        self.assertEqual(0, JobFileStageGroup.objects.get(pk=stage_group.pk).total_size)
+        self.assertEqual(21000, JobFileStageGroup.objects.get(pk=other_stage_group.pk).total_size)
+        URLJobInputFile.objects.filter(stage_group=other_stage_group, sequence=2).delete()
+        self.assertEqual(1000, JobFileStageGroup.objects.get(pk=other_stage_group.pk).total_size)
+
     def test_dds_file_sequence_stage_group_unique(self):
         stage_group = JobFileStageGroup.objects.create(user=self.user)
         self.job.stage_group = stage_group
@@ -658,6 +705,30 @@ class JobQuestionnaireTests(TestCase):
         self.assertEqual(questionnaire.make_tag(), 'rna-seq/v1/human')
         self.assertEqual(JobQuestionnaire.split_tag_parts(questionnaire.make_tag()), ('rna-seq', 1, 'human'))
 
+    def test_tag_kept_in_sync(self):
+        questionnaire = JobQuestionnaire.objects.create(name='Ant RnaSeq',
+                                                        description='Uses reference genome xyz and gene index abc',
+                                                        workflow_version=self.workflow_version,
+                                                        system_job_order_json='{"system_input": "foo"}',
+                                                        share_group=self.share_group,
+                                                        vm_settings=self.settings1,
+                                                        vm_flavor=self.flavor1,
+                                                        type=self.questionnaire_type
+                                                        )
+        self.assertEqual(JobQuestionnaire.objects.get(tag='rna-seq/v1/human'), questionnaire)
+
+        self.workflow.tag = 'rnaseq'
+        self.workflow.save()
+        self.assertEqual(JobQuestionnaire.objects.get(pk=questionnaire.pk).tag, 'rnaseq/v1/human')
+
+        self.workflow_version.version = 2
+        self.workflow_version.save()
+        self.assertEqual(JobQuestionnaire.objects.get(pk=questionnaire.pk).tag, 'rnaseq/v2/human')
+
+        self.questionnaire_type.tag = 'ant'
+        self.questionnaire_type.save()
+        self.assertEqual(JobQuestionnaire.objects.get(pk=questionnaire.pk).tag, 'rnaseq/v2/ant')
+
     def test_split_tag_parts(self):
         data = {
             ("stuff", None),
@@ -849,6 +920,31 @@ class EmailMessageTests(TestCase):
         self.assertEqual(message.state, EmailMessage.MESSAGE_STATE_ERROR)
         self.assertEqual(message.errors, 'SMTP Error')
 
+    @override_settings(BESPIN_MAILER_MAX_ATTEMPTS=3, BESPIN_MAILER_RETRY_BASE_SECONDS=60,
+                       BESPIN_MAILER_RETRY_MAX_SECONDS=100)
+    def test_mark_error_schedules_retries_then_dead(self):
+        message = EmailMessage.objects.create()
+        before = timezone.now()
+        message.mark_error('SMTP Error')
+        self.assertEqual(message.attempts, 1)
+        self.assertEqual(message.state, EmailMessage.MESSAGE_STATE_ERROR)
+        self.assertGreaterEqual(message.next_attempt, before + datetime.timedelta(seconds=30))
+        self.assertLessEqual(message.next_attempt, timezone.now() + datetime.timedelta(seconds=60))
+        message.mark_error('SMTP Error')
+        self.assertEqual(message.attempts, 2)
+        self.assertEqual(message.state, EmailMessage.MESSAGE_STATE_ERROR)
+        message.mark_error('SMTP Error')
+        self.assertEqual(message.attempts, 3)
+        self.assertEqual(message.state, EmailMessage.MESSAGE_STATE_DEAD)
+        self.assertIsNone(message.next_attempt)
+
+    @override_settings(BESPIN_MAILER_RETRY_BASE_SECONDS=60, BESPIN_MAILER_RETRY_MAX_SECONDS=300)
+    def test_retry_delay_seconds_doubles_up_to_max(self):
+        for attempts, delay in [(1, 60), (2, 120), (3, 240), (4, 300), (10, 300)]:
+            retry_delay = EmailMessage.retry_delay_seconds(attempts)
+            self.assertGreaterEqual(retry_delay, delay / 2.0)
+            self.assertLessEqual(retry_delay, delay)
+
 
 class CloudSettingsTests(TestCase):
 
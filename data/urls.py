@@ -7,6 +7,8 @@ router.register(r'dds-projects', api.DDSProjectsViewSet, 'dds-projects')
 router.register(r'dds-resources', api.DDSResourcesViewSet, 'dds-resources')
 router.register(r'workflows', api.WorkflowsViewSet, 'workflow')
 router.register(r'workflow-versions', api.WorkflowVersionsViewSet, 'workflowversion')
+router.register(r'workflow-version-steps', api.WorkflowVersionStepViewSet, 'workflowversionstep')
+router.register(r'workflow-version-packages', api.WorkflowVersionPackageViewSet, 'workflowversionpackage')
 router.register(r'jobs', api.JobsViewSet, 'job')
 router.register(r'job-file-stage-groups', api.JobFileStageGroupViewSet, 'jobfilestagegroup')
 router.register(r'dds-job-input-files', api.DDSJobInputFileViewSet, 'ddsjobinputfile')
@@ -35,6 +37,9 @@ router.register(r'admin/workflow-methods-documents', api.WorkflowMethodsDocument
                 'admin_workflowmethodsdocument')
 router.register(r'admin/email-templates', api.AdminEmailTemplateViewSet, 'admin_emailtemplate')
 router.register(r'admin/email-messages', api.AdminEmailMessageViewSet, 'admin_emailmessage')
+router.register(r'admin/vm-flavor-recommendations', api.AdminVMFlavorRecommendationViewSet,
+                'admin_vmflavorrecommendation')
+router.register(r'admin/workflow-import-tasks', api.AdminWorkflowImportTaskViewSet, 'admin_workflowimporttask')
 router.register(r'admin/import-workflow-questionnaire', api.AdminImportWorkflowQuestionnaireViewSet, 'admin_importworkflowquestionnaire')
 
 urlpatterns = [
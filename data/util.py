@@ -6,7 +6,12 @@ from ddsc.core.ddsapi import DataServiceError
 from ddsc.core.ddsapi import ContentType
 from ddsc.config import Config
 from gcb_web_auth.utils import get_oauth_token, get_dds_token_from_oauth
+from concurrent.futures import ThreadPoolExecutor
 import requests
+import re
+
+DDS_FILE_KIND = 'dds-file'
+DDS_FOLDER_KIND = 'dds-folder'
 
 
 class DDSBase(object):
@@ -34,7 +39,7 @@ class DDSResource(DDSBase):
         self.kind = resource_dict.get('kind')
         self.project = resource_dict.get('project').get('id')
         parent = resource_dict.get('parent')
-        if parent.get('kind') == 'dds-folder':
+        if parent.get('kind') == DDS_FOLDER_KIND:
             self.folder = parent.get('id')
         else:
             self.folder = None
@@ -203,6 +208,66 @@ def get_user_folder_content(user, dds_folder_id, search_str=None):
         raise WrappedDataServiceException(dse)
 
 
+def get_user_project_files_by_path(user, project_names, max_workers):
+    """
+    Find all files in the user's Duke DS projects named project_names keyed by their path within the project.
+    Projects are listed once then the contents of the projects are fetched concurrently.
+    :param user: User who has DukeDS credentials
+    :param project_names: [str]: names of the projects to fetch files for
+    :param max_workers: int: maximum number of projects to fetch at the same time
+    :return: dict: for each project name found a dict of file path to DDSResource
+    """
+    try:
+        remote_store = get_remote_store(user)
+        projects = DDSProject.from_list(remote_store.data_service.get_projects().json()['results'])
+    except DataServiceError as dse:
+        raise WrappedDataServiceException(dse)
+    project_ids = {}
+    for project in projects:
+        if project.name in project_names:
+            project_ids.setdefault(project.name, project.id)
+    if not project_ids:
+        return {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = dict((project_name, executor.submit(get_project_files_by_path, remote_store.config, project_id))
+                       for project_name, project_id in project_ids.items())
+        return dict((project_name, future.result()) for project_name, future in futures.items())
+
+
+def get_project_files_by_path(config, dds_project_id):
+    """
+    Get all files in a project keyed by their path within the project (e.g. 'data/sample1.fastq').
+    Creates its own RemoteStore so it can be run on a worker thread.
+    :param config: ddsc.config.Config: settings to use with ddsclient
+    :param dds_project_id: str: duke data service project id
+    :return: dict: file path to DDSResource
+    """
+    try:
+        remote_store = RemoteStore(config)
+        # an empty name_contains fetches all nested files and folders
+        response = remote_store.data_service.get_project_children(dds_project_id, name_contains='')
+        resources = DDSResource.from_list(response.json()['results'])
+    except DataServiceError as dse:
+        raise WrappedDataServiceException(dse)
+    folders = dict((resource.id, resource) for resource in resources if resource.kind == DDS_FOLDER_KIND)
+    folder_paths = {}
+
+    def get_folder_path(folder_id):
+        # walk up to the first folder whose path is known then fill in paths on the way back down
+        unknown_folders = []
+        while folder_id and folder_id not in folder_paths:
+            unknown_folders.append(folders[folder_id])
+            folder_id = folders[folder_id].folder
+        path = folder_paths.get(folder_id, '')
+        for folder in reversed(unknown_folders):
+            path = path + folder.name + '/'
+            folder_paths[folder.id] = path
+        return path
+
+    return dict((get_folder_path(resource.folder) + resource.name, resource)
+                for resource in resources if resource.kind == DDS_FILE_KIND)
+
+
 def get_readme_file_url(job_output_project):
     """
     Get url info for the readme file associated with a job output project.
@@ -268,3 +333,13 @@ def give_download_permissions(user, project_id, target_dds_user_id):
         data_service.set_user_project_permission(project_id, target_dds_user_id, auth_role='file_downloader')
     except DataServiceError as dse:
         raise WrappedDataServiceException(dse)
+
+
+def make_version_key(version):
+    """
+    Create a key for comparing software version strings where numeric parts compare as numbers so '1.10' > '1.9'.
+    :param version: str: version such as '1.9' or '2.0.1'
+    :return: tuple: key that sorts in version order
+    """
+    parts = re.findall(r'\d+|[a-zA-Z]+', version)
+    return tuple((1, int(part), '') if part.isdigit() else (0, 0, part) for part in parts)